@@ -1,11 +1,16 @@
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import subprocess
-import os
-import signal
-import psutil
+import asyncio
 from .mylib.beacon import beacon_emulator
+from .mylib.beacon.beacon_rotator import BeaconRotator
+from .mylib.beacon.beacon_scanner import BeaconScanner
+from .mylib.beacon.beacon_decoder import to_profile
+from .mylib.apple_bleee.continuity_tracker import ContinuityTracker
+from .mylib.apple_bleee.continuity_advertiser import ContinuityAdvertiser, airpods_payload, DEFAULT_INTERVAL
+from .mylib.apple_bleee.utils.continuity_payloads import CATALOG, cycle
+from .mylib.apple_bleee.utils.hci_adapter import get_adapter
+from .WiFi import ssid_index
 import json
 from pathlib import Path
 
@@ -21,10 +26,38 @@ router = APIRouter(
     tags=["BLE"]
 )
 
-running_process = None
+# 背景持續掃描，/beacon-scanner/scan 直接回傳記憶體中的結果
+beacon_scanner = BeaconScanner(scan_duration=10)
 
 templates = Jinja2Templates(directory="templates")
 
+@router.get("/adapter")
+async def get_adapter_status():
+    """
+    hci0 的使用狀態：掃描訂閱數、讀取統計、錯誤與重置次數，以及目前的廣播
+    """
+    return {
+        **hci_adapter.status(),
+        "beacon_emulator": beacon_emulator.is_advertising(),
+        "beacon_rotation": beacon_rotation.is_running,
+        "continuity_advertiser": continuity_advertiser.is_running,
+        "continuity_tracker": continuity_tracker.is_running,
+        "beacon_scanner": beacon_scanner.is_scanning
+    }
+
+@router.post("/adapter/reset")
+async def reset_adapter():
+    """
+    手動重置 hci0（只在控制器卡住時使用）；掃描與廣播會自動恢復
+    """
+    try:
+        with hci_adapter.lock:
+            hci_adapter.reset_device()
+            hci_adapter.command_socket()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to reset: {str(e)}")
+    return {"status": "reset", **hci_adapter.status()}
+
 @router.get("/beacon-scanner", response_class=HTMLResponse)
 def read_airpods_emulator(request: Request):
     return templates.TemplateResponse(
@@ -32,6 +65,99 @@ def read_airpods_emulator(request: Request):
         {"request": request, "message": "Beacon Scanner"}
     )
 
+@router.get("/beacon-scanner/scan")
+async def scan_beacons():
+    beacons = await beacon_scanner.scan()
+    return {"beacons": beacons, "scanning": beacon_scanner.is_scanning}
+
+@router.post("/beacon-scanner/save")
+async def save_scanned_beacon(data: dict):
+    """
+    將掃描到的 iBeacon / AltBeacon 儲存為 beacon-storage 設定檔
+
+    data 範例: {"mac_address": "aa:bb:cc:dd:ee:ff", "name": "office beacon"}
+    """
+    device = beacon_scanner.get_device(data["mac_address"])
+    if not device:
+        raise HTTPException(status_code=404, detail="Beacon not found")
+    
+    try:
+        profile = to_profile(device, data.get("name") or device["mac_address"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    profiles = json.loads(PROFILES_FILE.read_text())
+    if any(p["name"] == profile["name"] for p in profiles):
+        raise HTTPException(status_code=409, detail="Profile name already exists")
+    profiles.append(profile)
+    PROFILES_FILE.write_text(json.dumps(profiles, indent=2))
+    return {"status": "success", "profile": profile}
+
+@router.post("/beacon-scanner/stop")
+async def stop_beacon_scanner():
+    beacon_scanner.stop()
+    return {"status": "stopped"}
+
+# Apple Continuity 裝置追蹤（ble_read_state 的 headless 版本，在 event loop 上執行）
+continuity_tracker = ContinuityTracker(ttl=15, ssid_index=ssid_index)
+
+@router.post("/continuity/start")
+async def start_continuity_tracker():
+    if continuity_tracker.is_running:
+        return {"status": "already_running"}
+    try:
+        await continuity_tracker.start()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to start: {str(e)}")
+    return {"status": "started"}
+
+@router.post("/continuity/stop")
+async def stop_continuity_tracker():
+    if not continuity_tracker.is_running:
+        return {"status": "not_running"}
+    continuity_tracker.stop()
+    return {"status": "stopped"}
+
+@router.get("/continuity/devices")
+async def get_continuity_devices():
+    return {
+        "devices": continuity_tracker.snapshot(),
+        "seq": continuity_tracker.seq,
+        "running": continuity_tracker.is_running
+    }
+
+@router.get("/continuity/stream")
+async def stream_continuity_devices(request: Request):
+    """
+    Server-Sent Events：先送一次 snapshot，之後只送變動（changed / removed）
+    """
+    queue = continuity_tracker.subscribe()
+
+    async def events():
+        try:
+            snapshot = {"seq": continuity_tracker.seq, "devices": continuity_tracker.snapshot()}
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    delta = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # 保持連線
+                    yield ": keepalive\n\n"
+                    continue
+                if delta is None:
+                    yield "event: stopped\ndata: {}\n\n"
+                    break
+                if "devices" in delta:
+                    # 落後太多：佇列被換成完整 snapshot，客戶端需整份重建
+                    yield f"event: snapshot\ndata: {json.dumps(delta)}\n\n"
+                    continue
+                yield f"event: delta\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            continuity_tracker.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
 @router.get("/beacon-storage", response_class=HTMLResponse)
 def read_beacon_storage(request: Request):
     return templates.TemplateResponse(
@@ -68,6 +194,15 @@ def read_beacon_emulator(request: Request):
 # 在文件頂部的 import 部分之後添加一個變量來跟踪 beacon 模擬器的狀態
 beacon_emulator_active = False
 
+# 多個 beacon 輪播
+beacon_rotation = BeaconRotator()
+
+# hci0 由 HCIAdapter 統一管理：掃描（beacon 掃描、Continuity 追蹤）與廣播可同時進行
+hci_adapter = get_adapter(beacon_emulator.DEV_ID)
+
+# AirPods 廣播與 Continuity 輪播在本程序內執行，與 beacon 模擬器共用 HCI socket 與 device_lock
+continuity_advertiser = ContinuityAdvertiser(adapter=hci_adapter)
+
 # 修改 start_beacon_emulator 函數來設置狀態標誌
 @router.post("/beacon-emulator/start")
 async def start_beacon_emulator(data: dict):
@@ -79,17 +214,29 @@ async def start_beacon_emulator(data: dict):
     if not profile:
         raise HTTPException(status_code=404, detail="Profile not found")
     
-    beacon_emulator.start_ibeacon(
+    # 單一 beacon、輪播與 AirPods 廣播共用 hci0
+    beacon_rotation.stop()
+    continuity_advertiser.stop()
+    
+    started = beacon_emulator.start_ibeacon(
         uuid=profile["uuid"],
         major=profile["major"],
         minor=profile["minor"],
         power=profile["power"]
     )
     
+    if not started:
+        beacon_emulator_active = False
+        raise HTTPException(status_code=500, detail="Failed to start beacon advertising")
+    
     # 設置 beacon 模擬器狀態為活動
     beacon_emulator_active = True
     
-    return {"status": "started", "profile": profile["name"]}
+    return {
+        "status": "started",
+        "profile": profile["name"],
+        "latency_ms": beacon_emulator.last_latency_ms["start"]
+    }
 
 # 修改 stop_beacon_emulator 函數來更新狀態標誌
 @router.post("/beacon-emulator/stop")
@@ -101,7 +248,7 @@ async def stop_beacon_emulator():
     # 設置 beacon 模擬器狀態為停止
     beacon_emulator_active = False
     
-    return {"status": "stopped"}
+    return {"status": "stopped", "latency_ms": beacon_emulator.last_latency_ms["stop"]}
 
 # 添加新的狀態檢查路由
 @router.get("/beacon-emulator/status")
@@ -109,10 +256,107 @@ async def get_beacon_emulator_status():
     global beacon_emulator_active
     
     if beacon_emulator_active:
-        return {"status": "running"}
+        return {"status": "running", **beacon_emulator.get_status()}
     else:
         return {"status": "not_running"}
 
+@router.post("/beacon-emulator/rotation/start")
+async def start_beacon_rotation(data: dict):
+    """
+    同時輪播多個 profile
+
+    data 範例: {"profiles": [{"name": "a", "duty": 1.0}, {"name": "b", "duty": 0.5}],
+               "slot_ms": 300, "extended": null}
+    """
+    global beacon_emulator_active
+    
+    profiles = {p["name"]: p for p in json.loads(PROFILES_FILE.read_text())}
+    entries = []
+    for item in data.get("profiles", []):
+        profile = profiles.get(item["name"])
+        if not profile:
+            raise HTTPException(status_code=404, detail=f"Profile not found: {item['name']}")
+        entries.append((profile, item.get("duty", 1.0)))
+    
+    if not entries:
+        raise HTTPException(status_code=400, detail="No profiles given")
+    
+    beacon_rotation.slot_ms = data.get("slot_ms", beacon_rotation.slot_ms)
+    continuity_advertiser.stop()
+    
+    try:
+        mode = beacon_rotation.start(entries, use_extended=data.get("extended"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to start rotation: {str(e)}")
+    
+    beacon_emulator_active = False
+    
+    return {"status": "started", "mode": mode, "profiles": [e[0]["name"] for e in entries]}
+
+@router.post("/beacon-emulator/rotation/stop")
+async def stop_beacon_rotation():
+    if beacon_rotation.stop():
+        return {"status": "stopped"}
+    return {"status": "not_running"}
+
+@router.get("/beacon-emulator/rotation/status")
+async def get_beacon_rotation_status():
+    return beacon_rotation.status()
+
+@router.get("/continuity-spoof/catalog")
+async def get_continuity_catalog():
+    return {"payloads": sorted(CATALOG)}
+
+@router.post("/continuity-spoof/start")
+async def start_continuity_spoof(data: dict):
+    """
+    輪播多種 Continuity 廣播，並可定期更換隨機靜態位址
+
+    data 範例: {"payloads": ["airpods", "beatsx", "nearby"], "rate": 20,
+               "address_rate": 2, "interval": 32, "fields": {"airpods": {"left": 100}}}
+    rate: 每秒更換幾次廣播內容；address_rate: 每秒更換幾次位址（0 表示不更換）
+    """
+    global beacon_emulator_active
+    
+    names = data.get("payloads") or []
+    rate = float(data.get("rate", 10))
+    address_rate = float(data.get("address_rate", 0))
+    if not names:
+        raise HTTPException(status_code=400, detail="No payloads given")
+    if rate <= 0 or address_rate < 0:
+        raise HTTPException(status_code=400, detail="rate must be > 0 and address_rate >= 0")
+    try:
+        next_payload = cycle(names, data.get("fields"))
+        first = next_payload()
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    beacon_rotation.stop()
+    beacon_emulator.stop_ibeacon()
+    beacon_emulator_active = False
+    
+    started = continuity_advertiser.start(first, interval=int(data.get("interval", 0x20)),
+                                          update=next_payload, update_every=1.0 / rate,
+                                          address_every=1.0 / address_rate if address_rate else None)
+    if not started:
+        raise HTTPException(status_code=500, detail="Failed to start advertising")
+    return {"status": "started", "payloads": names, **continuity_advertiser.status()}
+
+@router.post("/continuity-spoof/stop")
+async def stop_continuity_spoof():
+    if not continuity_advertiser.stop():
+        return {"status": "not_running"}
+    return {"status": "stopped"}
+
+@router.get("/continuity-spoof/status")
+async def get_continuity_spoof_status():
+    """
+    包含實際達到的速率：adverts_per_sec、payloads_per_sec、addresses_per_sec 與 max_jitter_ms
+    """
+    return continuity_advertiser.status()
+
 @router.get("/airpods-emulator", response_class=HTMLResponse)
 def read_airpods_emulator(request: Request):
     return templates.TemplateResponse(
@@ -121,89 +365,83 @@ def read_airpods_emulator(request: Request):
     )
 
 @router.post("/airpods-emulator/start")
-async def start_airpods_scan():
-    global running_process
+async def start_airpods_scan(random: bool = False, interval: int = DEFAULT_INTERVAL):
+    """
+    在本程序內開始 AirPods 廣播（與 beacon 模擬器共用 hci0 的 HCI socket）
+
+    random: 每 2 秒更換一次隨機電量
+    interval: 廣播間隔（單位 0.625 ms）
+    """
+    global beacon_emulator_active
     
-    if running_process and running_process.poll() is None:
-        return {"status": "already_running", "pid": running_process.pid}
+    if continuity_advertiser.is_running:
+        return {"status": "already_running", **continuity_advertiser.status()}
     
-    try:
-        # 獲取當前環境變數
-        env = os.environ.copy()
-        
-        # 使用 sudo -E 保留環境變數
-        cmd = ["sudo", "-E", "python3", "api/mylib/apple_bleee/adv_airpods.py"]
-        
-        # 啟動進程
-        with open("airpods_output.log", "w") as out_file, open("airpods_error.log", "w") as err_file:
-            process = subprocess.Popen(
-                cmd,
-                stdout=out_file,
-                stderr=err_file,
-                text=True,
-                env=env,
-                preexec_fn=os.setsid
-            )
-        
-        running_process = process
-        return {"status": "started", "pid": process.pid}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to start: {str(e)}")
+    # 控制器只有一個傳統廣播，先停止 beacon 模擬與輪播
+    beacon_rotation.stop()
+    beacon_emulator.stop_ibeacon()
+    beacon_emulator_active = False
+    
+    started = continuity_advertiser.start(airpods_payload(), interval=interval,
+                                       update=airpods_payload if random else None)
+    if not started:
+        raise HTTPException(status_code=500, detail="Failed to start AirPods advertising")
+    return {"status": "started", **continuity_advertiser.status()}
 
 @router.post("/airpods-emulator/stop")
 async def stop_airpods_scan():
-    global running_process
-    
-    if not running_process:
+    if not continuity_advertiser.stop():
         return {"status": "not_running"}
-    
-    try:
-        # 獲取進程 PID
-        pid = running_process.pid
-        
-        # 終止主進程及其子進程
-        parent = psutil.Process(pid)
-        children = parent.children(recursive=True)
-        
-        for child in children:
-            child.terminate()
-        
-        # 終止主進程
-        parent.terminate()
-        
-        # 確保進程已終止
-        gone, alive = psutil.wait_procs([parent], timeout=3)
-        for p in alive:
-            p.kill()
-        
-        running_process = None
-        return {"status": "stopped", "pid": pid}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to stop: {str(e)}")
+    return {"status": "stopped", "latency_ms": continuity_advertiser.last_latency_ms["stop"]}
 
 @router.get("/airpods-emulator/status")
 async def get_status():
-    global running_process
-    
-    if running_process and running_process.poll() is None:
-        return {"status": "running", "pid": running_process.pid}
+    if continuity_advertiser.is_running:
+        return {"status": "running", **continuity_advertiser.status()}
     else:
-        return {"status": "not_running"}
+        return {"status": "not_running", **continuity_advertiser.status()}
     
 @router.get("/airpods-emulator/logs")
-async def get_logs():
-    try:
-        error_content = ""
-        output_content = ""
-        
-        if os.path.exists("airpods_error.log"):
-            with open("airpods_error.log", "r") as error_file:
-                error_content = error_file.read()
-                
-        if os.path.exists("airpods_output.log"):
-            with open("airpods_output.log", "r") as output_file:
-                output_content = output_file.read()
-                
-        return {"output": output_content, "errors": error_content}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to read logs: {str(e)}")
\ No newline at end of file
+async def get_logs(since: int = 0, limit: int = 500):
+    """
+    回傳第 since 行之後的日誌；下次輪詢時帶入回傳的 next
+    """
+    lines, next_seq, truncated = continuity_advertiser.log.since(since, limit)
+    return {
+        "lines": lines,
+        "next": next_seq,
+        "truncated": truncated,
+        "output": "".join(l["msg"] + "\n" for l in lines if l["level"] != "error"),
+        "errors": "".join(l["msg"] + "\n" for l in lines if l["level"] == "error")
+    }
+
+@router.get("/airpods-emulator/logs/stream")
+async def stream_airpods_logs(request: Request, since: int = 0):
+    """
+    Server-Sent Events：先送出 since 之後已有的日誌，之後逐行推送
+    """
+    log = continuity_advertiser.log
+    queue = log.subscribe()
+
+    async def events():
+        try:
+            lines, last, _ = log.since(since)
+            for line in lines:
+                yield f"id: {line['seq']}\ndata: {json.dumps(line)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    line = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # 保持連線
+                    yield ": keepalive\n\n"
+                    continue
+                if line["seq"] <= last:
+                    # 訂閱後、讀取歷史前寫入的行已經送過
+                    continue
+                last = line["seq"]
+                yield f"id: {line['seq']}\ndata: {json.dumps(line)}\n\n"
+        finally:
+            log.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
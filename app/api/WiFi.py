@@ -10,6 +10,8 @@ import uuid
 import json
 from .mylib.WeakPasswordGenerater.main import PasswordGenerator
 from .mylib.ap_scan import scan_wifi_networks
+from .mylib.wordlist_merge import merge_wordlists, load_index
+from .mylib.apple_bleee.utils.ssid_index import SSIDHashIndex
 import random
 import asyncio
 import csv
@@ -36,6 +38,13 @@ connected_clients = []
 # 全域網卡名稱列表
 network_adapters = []
 
+# 字典合併工作狀態 (job_id -> 狀態)
+merge_jobs = {}
+
+# 掃描過的 SSID 與匯入的 SSID 清單，讓 BLE 的 Wi-Fi join 請求可以反查 SSID hash
+SSID_CORPORA_DIR = "data/ssid_corpora"
+ssid_index = SSIDHashIndex("data/ssid_hashes.bin")
+
 # 定義 AP 配置模型
 class APConfig(BaseModel):
     ssid: str
@@ -99,6 +108,17 @@ class WordlistRequest(BaseModel):
     output_filename: str
     info_data: Dict[str, List[str]]
 
+# 定義字典合併請求模型
+class WordlistMergeRequest(BaseModel):
+    sources: List[str]  # 與 /wordlists/list 回傳的 path 相同，例如 wordlists/standard/xxx.txt
+    output_filename: str
+    wpa_filter: bool = True
+    preserve_frequency: bool = True
+
+# 定義 SSID 清單匯入請求模型
+class SSIDImportRequest(BaseModel):
+    sources: List[str]  # data/ssid_corpora 底下的檔名（每行一個 SSID，或含 SSID/ESSID 欄位的 CSV）
+
 # 定義頻道設定請求模型
 class ChannelRequest(BaseModel):
     interface: str
@@ -360,6 +380,10 @@ async def scan_wifi(request: ScanWifiRequest):
             request.timeout
         )
         
+        # 記錄到 SSID hash 索引（寫檔放到執行緒池）
+        if ssid_index.add(ap["ESSID"] for ap in nearby_ap):
+            await loop.run_in_executor(None, ssid_index.flush)
+        
         return {
             "success": True,
             "ap_list": nearby_ap,
@@ -375,6 +399,46 @@ async def scan_wifi(request: ScanWifiRequest):
             "count": 0
         }
     
+@router.post("/ssid-index/import")
+async def import_ssid_corpora(request: SSIDImportRequest):
+    """
+    匯入 SSID 清單到 SSID hash 索引
+    """
+    corpora_root = os.path.realpath(SSID_CORPORA_DIR)
+    sources = []
+    for source in request.sources:
+        source_path = os.path.realpath(os.path.join(SSID_CORPORA_DIR, source))
+        if not source_path.startswith(corpora_root + os.sep) or not os.path.isfile(source_path):
+            return {
+                "success": False,
+                "message": f"SSID list not found: {source}"
+            }
+        sources.append(source_path)
+
+    def run_import():
+        added = sum(ssid_index.import_file(path) for path in sources)
+        ssid_index.flush()
+        return added
+
+    loop = asyncio.get_event_loop()
+    added = await loop.run_in_executor(None, run_import)
+    return {"success": True, "added": added, **ssid_index.stats()}
+
+@router.get("/ssid-index")
+async def get_ssid_index(hash: Optional[str] = None):
+    """
+    SSID hash 索引狀態；帶 hash（SHA256(SSID) 前 3 bytes 的 hex）時回傳對應的 SSID
+    """
+    result = {"success": True, **ssid_index.stats()}
+    if hash is not None:
+        if not re.match(r'^[0-9a-fA-F]{6}$', hash):
+            return {
+                "success": False,
+                "message": "hash must be 6 hex digits"
+            }
+        result["ssids"] = ssid_index.lookup(hash)
+    return result
+
 @router.post('/interface/channel')
 async def set_interface_channel(request: ChannelRequest):
     """
@@ -823,10 +887,12 @@ async def list_wordlists():
                     file_path = os.path.join(wordlists_dir, file)
                     if os.path.isfile(file_path):  # 確保是檔案而不是目錄
                         file_stat = os.stat(file_path)
+                        index = load_index(file_path)
                         wordlists.append({
                             "filename": file,
                             "path": f"wordlists/{file}",
                             "size": file_stat.st_size,
+                            "lines": index["lines"] if index else None,
                             "category": "custom",
                             "modified": datetime.fromtimestamp(file_stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
                             "download_link": f"/static/wordlists/{file}"
@@ -840,10 +906,12 @@ async def list_wordlists():
                     file_path = os.path.join(standard_dir, file)
                     if os.path.isfile(file_path):  # 確保是檔案而不是目錄
                         file_stat = os.stat(file_path)
+                        index = load_index(file_path)
                         wordlists.append({
                             "filename": file,
                             "path": f"wordlists/standard/{file}",
                             "size": file_stat.st_size,
+                            "lines": index["lines"] if index else None,
                             "category": "standard",
                             "modified": datetime.fromtimestamp(file_stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
                             "download_link": f"/static/wordlists/standard/{file}"
@@ -866,6 +934,119 @@ async def list_wordlists():
             "count": 0
         }
 
+def run_merge_job(job_id: str, sources: List[str], output_path: str, wpa_filter: bool, preserve_frequency: bool):
+    """
+    背景執行字典合併，並將進度寫入 merge_jobs
+    """
+    job = merge_jobs[job_id]
+
+    def update_progress(phase, percent):
+        job["phase"] = phase
+        job["progress"] = round(percent, 1)
+
+    try:
+        stats = merge_wordlists(
+            sources,
+            output_path,
+            wpa_filter=wpa_filter,
+            preserve_frequency=preserve_frequency,
+            progress=update_progress
+        )
+        job["status"] = "completed"
+        job["lines"] = stats["lines"]
+        job["input_words"] = stats["input_words"]
+    except Exception as e:
+        job["status"] = "failed"
+        job["message"] = str(e)
+    finally:
+        job["finished"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+@router.post("/wordlists/merge")
+async def merge_wordlist_files(request: WordlistMergeRequest, background_tasks: BackgroundTasks):
+    """
+    合併多個字典檔並去除重複（背景執行，以 /wordlists/merge/{job_id} 查詢進度）
+    """
+    filename = request.output_filename
+    if not filename.endswith('.txt'):
+        filename += '.txt'
+    if not re.match(r'^[a-zA-Z0-9_.-]+\.txt$', filename):
+        return {
+            "success": False,
+            "message": "Invalid filename format"
+        }
+
+    if not request.sources:
+        return {
+            "success": False,
+            "message": "No source wordlists given"
+        }
+
+    # 只允許合併 static/wordlists 底下的檔案
+    wordlists_root = os.path.realpath("static/wordlists")
+    sources = []
+    for source in request.sources:
+        source_path = os.path.realpath(os.path.join("static", source))
+        if not source_path.startswith(wordlists_root + os.sep) or not os.path.isfile(source_path):
+            return {
+                "success": False,
+                "message": f"Wordlist file not found: {source}"
+            }
+        sources.append(source_path)
+
+    output_path = os.path.join("static/wordlists", filename)
+    if os.path.realpath(output_path) in sources:
+        return {
+            "success": False,
+            "message": "Output file cannot be one of the sources"
+        }
+
+    for job in merge_jobs.values():
+        if job["status"] == "running" and job["filename"] == filename:
+            return {
+                "success": False,
+                "message": f"{filename} is already being merged",
+                "job_id": job["job_id"]
+            }
+
+    job_id = str(uuid.uuid4())
+    merge_jobs[job_id] = {
+        "job_id": job_id,
+        "status": "running",
+        "phase": "queued",
+        "progress": 0.0,
+        "filename": filename,
+        "path": f"wordlists/{filename}",
+        "started": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+    background_tasks.add_task(
+        run_merge_job, job_id, sources, output_path,
+        request.wpa_filter, request.preserve_frequency
+    )
+
+    return {
+        "success": True,
+        "message": "Wordlist merge started",
+        "job_id": job_id
+    }
+
+@router.get("/wordlists/merge/{job_id}")
+async def get_merge_status(job_id: str):
+    """
+    查詢字典合併工作的進度
+    """
+    job = merge_jobs.get(job_id)
+    if not job:
+        return {
+            "success": False,
+            "message": f"Merge job not found: {job_id}"
+        }
+
+    return {
+        "success": True,
+        **job
+    }
+
 @router.delete("/wordlists/custom/{filename}")
 async def delete_custom_wordlist(filename: str):
     """
@@ -904,8 +1085,10 @@ async def delete_custom_wordlist(filename: str):
                 "message": f"Not a file: {filename}"
             }
         
-        # 刪除檔案
+        # 刪除檔案（連同合併工具產生的索引檔）
         os.remove(file_path)
+        if os.path.exists(file_path + ".idx"):
+            os.remove(file_path + ".idx")
         
         return {
             "success": True,
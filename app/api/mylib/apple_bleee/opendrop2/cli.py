@@ -19,22 +19,22 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import time
 
-import ipaddress
 import logging
 import argparse
 import sys
 import json
 import os
-import threading
 
 from .client import AirDropBrowser, AirDropClient
-from .config import AirDropConfig, AirDropReceiverFlags
+from .config import AirDropConfig
+from .discovery import AirDropDiscovery
 from .server import AirDropServer
 
 logger = logging.getLogger(__name__)
 
 
-devices=[]
+# receivers followed by the last 'find'
+discovery = None
 
 def main():
     AirDropCli(sys.argv[1:])
@@ -68,8 +68,6 @@ class AirDropCli:
         self.client = None
         self.browser = None
         self.sending_started = False
-        self.discover = []
-        self.lock = threading.Lock()
 
         try:
             if args.action == 'receive':
@@ -87,74 +85,22 @@ class AirDropCli:
                 self.receiver = args.receiver
                 self.send()
         except KeyboardInterrupt:
+            if discovery is not None:
+                discovery.stop()
             if self.browser is not None:
                 self.browser.stop()
             if self.server is not None:
                 self.server.stop()
 
     def find(self):
+        global discovery
         logger.info('Looking for receivers. Press enter to stop ...')
         self.browser = AirDropBrowser(self.config)
-        self.browser.start(callback_add=self._found_receiver)
-        # try:
-        #     # input()
-        #     while 1:
-        #         a=1
-        # except KeyboardInterrupt:
-        #     pass
-        # finally:
-        #     self.browser.stop()
-        #     logger.debug('Save discovery results to {}'.format(self.config.discovery_report))
-        #     with open(self.config.discovery_report, 'w') as f:
-        #         json.dump(self.discover, f)
-
-    def _found_receiver(self, info):
-        thread = threading.Thread(target=self._send_discover, args=(info,))
-        thread.start()
-
-    def _send_discover(self, info):
-        global devices
-        try:
-            address = ipaddress.ip_address(info.address).compressed
-        except ValueError:
-            return  # not a valid address
-        id = info.name.split('.')[0]
-        hostname = info.server
-        port = int(info.port)
-        logger.debug('AirDrop service found: {}, {}:{}, ID {}'.format(hostname, address, port, id))
-        client = AirDropClient(self.config, (address, int(port)))
-        flags = int(info.properties[b'flags'])
-
-        if flags & AirDropReceiverFlags.SUPPORTS_DISCOVER_MAYBE:
-            try:
-                reponse = client.send_discover()
-                receiver_name =reponse.get('ReceiverComputerName')
-                ReceiverMediaCapabilities = json.loads(reponse['ReceiverMediaCapabilities'])
-                os_info = "{} ({})".format('.'.join(map(str, ReceiverMediaCapabilities['Vendor']['com.apple']['OSVersion'])), ReceiverMediaCapabilities['Vendor']['com.apple']['OSBuildVersion'])
-            except TimeoutError:
-                pass
-        else:
-            receiver_name = None
-        discoverable = receiver_name is not None
-
-        index = len(self.discover)
-        node_info = {
-            'name': receiver_name,
-            'address': address,
-            'host': hostname,
-            'port': port,
-            'id': id,
-            'flags': flags,
-            'discoverable': discoverable,
-            'os': os_info,
-        }
-        self.lock.acquire()
-        self.discover.append(node_info)
-        if discoverable:
-            logger.info('Found  index {}  ID {}  name {}'.format(index, id, receiver_name))
-        # print (node_info)
-        devices = self.discover
-        self.lock.release()
+        if discovery is not None:
+            discovery.stop()
+        # receivers of the last run are listed until their TTL runs out
+        discovery = AirDropDiscovery(self.config)
+        discovery.start(self.browser)
 
     def receive(self):
         self.server = AirDropServer(self.config)
@@ -209,4 +155,7 @@ class AirDropCli:
         return None
 
 def get_devices():
-    return devices
+    """Receivers found so far; the same list until one of them changes"""
+    if discovery is None:
+        return []
+    return discovery.devices()
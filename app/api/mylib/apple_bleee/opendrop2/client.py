@@ -30,14 +30,23 @@ import socket
 from http import client
 
 from .util import AirDropUtil, AbsArchiveWrite
-from .zeroconf import ServiceBrowser, Zeroconf
+from .zeroconf import ServiceBrowser, ServiceInfo, Zeroconf
 
 logger = logging.getLogger(__name__)
 
+# /Discover request replayed to every receiver
+DISCOVER_REQUEST = '/root/.opendrop/debug/receive_discover_request.plist'
+# record data -> binary /Discover body, read and encoded once
+_discover_bodies = {}
+
 
 class AirDropBrowser:
 
-    def __init__(self, config):
+    def __init__(self, config, loop=None):
+        """
+        :param loop: running asyncio loop to browse from (e.g. the web app's)
+            instead of a zeroconf thread
+        """
         self.legacy_mode = config.legacy
         if self.legacy_mode:
             self.useIPv6 = False
@@ -51,9 +60,10 @@ class AirDropBrowser:
             raise RuntimeError('Interface {} does not have IP(v6) address'.format(self.ip_interface_name))
 
         if self.legacy_mode:
-            self.zeroconf = Zeroconf()
+            self.zeroconf = Zeroconf(loop=loop)
         else:
-            self.zeroconf = Zeroconf(interfaces=[self.ip_addr], ipv6_interface_name=self.ip_interface_name)
+            self.zeroconf = Zeroconf(interfaces=[self.ip_addr], ipv6_interface_name=self.ip_interface_name,
+                                     loop=loop)
 
         self.callback_add = None
         self.callback_remove = None
@@ -81,11 +91,23 @@ class AirDropBrowser:
             self.callback_add(info)
 
     def remove_service(self, zeroconf, type, name):
-        info = zeroconf.get_service_info(type, name)
+        # the service is gone: asking for its info would only time out
+        info = ServiceInfo(type, name)
         logger.debug('Remove service {}'.format(name))
         if self.callback_remove is not None:
             self.callback_remove(info)
 
+    def expiration(self, name):
+        """
+        Wall clock time (s) at which the PTR record of service ``name``
+        expires, or None if the browser does not know the service
+        """
+        browser = self.browser
+        record = browser.services.get(name.lower()) if browser is not None else None
+        if record is None:
+            return None
+        return record.get_expiration_time(100) / 1000.0
+
 
 class AirDropClient:
 
@@ -123,14 +145,25 @@ class AirDropClient:
             logger.debug('{} request successful'.format(url))
         return status, response_bytes
 
+    def close(self):
+        if self.http_conn is not None:
+            self.http_conn.close()
+            self.http_conn = None
+
+    def _discover_body(self):
+        record_data = self.config.record_data
+        discover_plist_binary = _discover_bodies.get(record_data)
+        if discover_plist_binary is None:
+            with open(DISCOVER_REQUEST, 'rb') as f:
+                discover_body = plistlib.load(f)
+            if record_data:
+                discover_body['SenderRecordData'] = record_data
+            discover_plist_binary = plistlib.dumps(discover_body, fmt=plistlib.FMT_BINARY)
+            _discover_bodies[record_data] = discover_plist_binary
+        return discover_plist_binary
+
     def send_discover(self):
-        # discover_body = {}
-        a = '/root/.opendrop/debug/receive_discover_request.plist'
-        discover_body = plistlib.readPlist(a)
-        if self.config.record_data:
-            discover_body['SenderRecordData'] = self.config.record_data
-        discover_plist_binary = plistlib.dumps(discover_body, fmt=plistlib.FMT_BINARY)
-        # print (discover_plist_binary)
+        discover_plist_binary = self._discover_body()
         success, response_bytes = self.send_POST('/Discover', discover_plist_binary)
         response = plistlib.loads(response_bytes)
         # print (response)
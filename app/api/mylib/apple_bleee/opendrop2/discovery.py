@@ -0,0 +1,238 @@
+"""
+Cache of the AirDrop receivers found by an AirDropBrowser.
+
+Receivers are kept by mDNS service name with the /Discover answer (name,
+OS, discoverability) and expire with the PTR record of their service. The
+record's TTL is followed while the browser refreshes it, and the cache is
+saved to the discovery report (``~/.opendrop/discover.last.json``, read
+by ``opendrop send``) so the receivers of the previous run are listed
+until their TTL runs out.
+
+/Discover requests are sent by one background worker: once when a
+receiver shows up (or moves) and again every ``refresh`` seconds.
+:meth:`AirDropDiscovery.devices` returns the same list object as long as
+nothing changed, so polling it costs nothing.
+"""
+
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from .client import AirDropClient
+from .config import AirDropReceiverFlags
+
+logger = logging.getLogger(__name__)
+
+# expiry of a receiver whose PTR record is not known (s)
+DEFAULT_TTL = 120
+# seconds between two /Discover requests to a receiver
+DEFAULT_REFRESH = 300
+
+
+class AirDropDiscovery:
+
+    def __init__(self, config, refresh=DEFAULT_REFRESH, path=None):
+        self.config = config
+        self.refresh = refresh
+        self.path = path or config.discovery_report
+        self.browser = None
+
+        self._lock = threading.Lock()
+        # service name -> receiver
+        self._receivers = {}
+        self._devices = None
+        self._next_expiry = None
+        self._queue = queue.Queue()
+        self._worker = None
+        self._stopped = threading.Event()
+        self.load()
+
+    def start(self, browser):
+        """Follows the services found by ``browser`` (an AirDropBrowser)."""
+        self.browser = browser
+        self._stopped.clear()
+        self._worker = threading.Thread(target=self._run, name='airdrop-discover', daemon=True)
+        self._worker.start()
+        browser.start(callback_add=self._added, callback_remove=self._removed)
+        # ask again the receivers loaded from the last run
+        for service in list(self._receivers):
+            self._queue.put(service)
+
+    def stop(self):
+        self._stopped.set()
+        self._queue.put(None)
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        self.save()
+
+    def devices(self):
+        """
+        Receivers that did not expire, in the format of the discovery
+        report. The same list is returned until a receiver changes.
+        """
+        now = time.time()
+        with self._lock:
+            if self._next_expiry is not None and self._next_expiry <= now:
+                self._expire(now)
+            if self._devices is None:
+                self._devices = [dict(receiver) for receiver in self._receivers.values()]
+                self._next_expiry = min(
+                    (receiver['expires'] for receiver in self._receivers.values()), default=None)
+            return self._devices
+
+    # ---- persistence ---------------------------------------------------------
+
+    def load(self):
+        """Loads the receivers of the last run that did not expire."""
+        try:
+            with open(self.path, 'r') as f:
+                infos = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            for info in infos:
+                if isinstance(info, dict) and info.get('service') and info.get('expires', 0) > now:
+                    self._receivers[info['service']] = info
+            self._changed()
+
+    def save(self):
+        with self._lock:
+            infos = list(self._receivers.values())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(infos, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning('Cannot save discovery report {}: {}'.format(self.path, e))
+
+    # ---- browser callbacks -----------------------------------------------------
+
+    def _expiration(self, service):
+        expires = self.browser.expiration(service) if self.browser is not None else None
+        return expires or time.time() + DEFAULT_TTL
+
+    def _added(self, info):
+        if info is None:
+            return  # no answer to the service info request
+        try:
+            address = ipaddress.ip_address(info.address).compressed
+        except ValueError:
+            return  # not a valid address
+        try:
+            flags = int(info.properties[b'flags'])
+        except (KeyError, ValueError):
+            flags = 0
+        port = int(info.port)
+        with self._lock:
+            receiver = self._receivers.get(info.name)
+            moved = receiver is None or (receiver['address'], receiver['port']) != (address, port)
+            if moved:
+                receiver = {'name': None, 'os': None, 'discoverable': False, 'discovered': 0}
+            receiver.update({
+                'service': info.name,
+                'id': info.name.split('.')[0],
+                'address': address,
+                'host': info.server,
+                'port': port,
+                'flags': flags,
+                'expires': self._expiration(info.name),
+            })
+            self._receivers[info.name] = receiver
+            self._changed()
+        logger.debug('AirDrop service found: {}, {}:{}, ID {}'.format(info.server, address, port, receiver['id']))
+        if moved:
+            self._queue.put(info.name)
+
+    def _removed(self, info):
+        with self._lock:
+            if self._receivers.pop(info.name, None) is not None:
+                self._changed()
+        self.save()
+
+    def _changed(self):
+        # called with the lock held
+        self._devices = None
+        self._next_expiry = None
+
+    def _expire(self, now):
+        # called with the lock held
+        for service, receiver in list(self._receivers.items()):
+            if receiver['expires'] <= now:
+                expires = self.browser.expiration(service) if self.browser is not None else None
+                if expires is not None and expires > now:
+                    # the browser refreshed the record
+                    receiver['expires'] = expires
+                else:
+                    del self._receivers[service]
+        self._changed()
+
+    # ---- /Discover worker ------------------------------------------------------
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                discovered = [receiver['discovered'] for receiver in self._receivers.values()]
+            timeout = None
+            if discovered:
+                timeout = max(min(discovered) + self.refresh - time.time(), 0)
+            try:
+                service = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                service = None
+            if self._stopped.is_set():
+                return
+
+            now = time.time()
+            with self._lock:
+                services = [s for s, receiver in self._receivers.items()
+                            if receiver['discovered'] + self.refresh <= now]
+            if service is not None and service not in services:
+                services.append(service)
+            for service in services:
+                try:
+                    self._discover(service)
+                except Exception:
+                    # a malformed answer must not stop the discovery of the others
+                    logger.exception('/Discover of {} failed'.format(service))
+            if services:
+                self.save()
+
+    def _discover(self, service):
+        with self._lock:
+            receiver = self._receivers.get(service)
+            if receiver is None:
+                return
+            address, port, flags = receiver['address'], receiver['port'], receiver['flags']
+            receiver['discovered'] = time.time()
+
+        name = os_info = None
+        if flags & AirDropReceiverFlags.SUPPORTS_DISCOVER_MAYBE:
+            client = AirDropClient(self.config, (address, port))
+            try:
+                response = client.send_discover()
+                name = response.get('ReceiverComputerName')
+                capabilities = json.loads(response['ReceiverMediaCapabilities'])
+                apple = capabilities['Vendor']['com.apple']
+                os_info = '{} ({})'.format('.'.join(map(str, apple['OSVersion'])), apple['OSBuildVersion'])
+            except (OSError, http.client.HTTPException, KeyError, ValueError) as e:
+                logger.debug('/Discover of {} failed: {!r}'.format(service, e))
+            finally:
+                client.close()
+
+        with self._lock:
+            receiver = self._receivers.get(service)
+            if receiver is None:
+                return
+            receiver.update({'name': name, 'os': os_info, 'discoverable': name is not None})
+            self._changed()
+        if name is not None:
+            logger.info('Found  ID {}  name {}'.format(receiver['id'], name))
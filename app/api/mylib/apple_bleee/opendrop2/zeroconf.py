@@ -20,18 +20,21 @@
     USA
 """
 
+import asyncio
+import collections
+import concurrent.futures
 import enum
 import errno
+import heapq
 import logging
 import re
-import select
 import socket
 import struct
 import sys
 import platform
+import random
 import threading
 import time
-from functools import reduce
 
 import netifaces
 
@@ -62,6 +65,14 @@ _CHECK_TIME = 175
 _REGISTER_TIME = 225
 _LISTENER_TIME = 200
 _BROWSER_TIME = 500
+# queries of browsers due within this time are sent in one packet
+_QUERY_COALESCE_TIME = 250
+# RFC 6762 6.3: shared answers are delayed 20-120 ms so answers to
+# several queries go out in one response
+_RESPONSE_DELAY_MIN = 20
+_RESPONSE_DELAY_MAX = 120
+# RFC 6762 6.2: a record is multicast at most once per second
+_RESPONSE_RATE_LIMIT = 1000
 
 # Some DNS constants
 
@@ -343,8 +354,12 @@ class DNSEntry:
 
     """A DNS entry"""
 
+    __slots__ = ('key', 'name', 'type', 'class_', 'unique')
+
     def __init__(self, name, type_, class_):
-        self.key = name.lower()
+        key = name.lower()
+        # most names are lower case already: share the string
+        self.key = name if key == name else key
         self.name = name
         self.type = type_
         self.class_ = class_ & _CLASS_MASK
@@ -361,6 +376,10 @@ class DNSEntry:
         """Non-equality test"""
         return not self.__eq__(other)
 
+    def __hash__(self):
+        """Hash on name, type, and class"""
+        return hash((self.key, self.type, self.class_))
+
     @staticmethod
     def get_class_(class_):
         """Class accessor"""
@@ -391,6 +410,8 @@ class DNSQuestion(DNSEntry):
 
     """A DNS question entry"""
 
+    __slots__ = ()
+
     def __init__(self, name, type_, class_):
         DNSEntry.__init__(self, name, type_, class_)
 
@@ -409,6 +430,8 @@ class DNSRecord(DNSEntry):
 
     """A DNS record - like a DNS entry, but has a TTL"""
 
+    __slots__ = ('ttl', 'created')
+
     def __init__(self, name, type_, class_, ttl):
         DNSEntry.__init__(self, name, type_, class_)
         self.ttl = ttl
@@ -422,13 +445,19 @@ class DNSRecord(DNSEntry):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    def __hash__(self):
+        """Hash on what __eq__ compares, so records can index the cache"""
+        return hash((self.key, self.type, self.class_, self.rdata()))
+
+    def rdata(self):
+        """Abstract method: the data compared by __eq__"""
+        raise AbstractMethodException
+
     def suppressed_by(self, msg):
         """Returns true if any answer in a message can suffice for the
         information held in this record."""
-        for record in msg.answers:
-            if self.suppressed_by_answer(record):
-                return True
-        return False
+        other = msg.known_answers.get(self)
+        return other is not None and self.suppressed_by_answer(other)
 
     def suppressed_by_answer(self, other):
         """Returns true if another record has same name, type and class,
@@ -473,6 +502,8 @@ class DNSAddress(DNSRecord):
 
     """A DNS address record"""
 
+    __slots__ = ('address',)
+
     def __init__(self, name, type_, class_, ttl, address):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         self.address = address
@@ -490,6 +521,12 @@ class DNSAddress(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSRecord.__hash__
+
+    def rdata(self):
+        """Data compared by __eq__"""
+        return self.address
+
     def __repr__(self):
         """String representation"""
         try:
@@ -502,6 +539,8 @@ class DNSHinfo(DNSRecord):
 
     """A DNS host information record"""
 
+    __slots__ = ('cpu', 'os')
+
     def __init__(self, name, type_, class_, ttl, cpu, os):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         try:
@@ -527,6 +566,12 @@ class DNSHinfo(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSRecord.__hash__
+
+    def rdata(self):
+        """Data compared by __eq__"""
+        return (self.cpu, self.os)
+
     def __repr__(self):
         """String representation"""
         return self.cpu + " " + self.os
@@ -536,6 +581,8 @@ class DNSPointer(DNSRecord):
 
     """A DNS pointer record"""
 
+    __slots__ = ('alias',)
+
     def __init__(self, name, type_, class_, ttl, alias):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         self.alias = alias
@@ -553,6 +600,12 @@ class DNSPointer(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSRecord.__hash__
+
+    def rdata(self):
+        """Data compared by __eq__"""
+        return self.alias
+
     def __repr__(self):
         """String representation"""
         return self.to_string(self.alias)
@@ -562,6 +615,8 @@ class DNSText(DNSRecord):
 
     """A DNS text record"""
 
+    __slots__ = ('text',)
+
     def __init__(self, name, type_, class_, ttl, text):
         assert isinstance(text, (bytes, type(None)))
         DNSRecord.__init__(self, name, type_, class_, ttl)
@@ -580,6 +635,12 @@ class DNSText(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSRecord.__hash__
+
+    def rdata(self):
+        """Data compared by __eq__"""
+        return self.text
+
     def __repr__(self):
         """String representation"""
         if len(self.text) > 10:
@@ -592,6 +653,8 @@ class DNSService(DNSRecord):
 
     """A DNS service record"""
 
+    __slots__ = ('priority', 'weight', 'port', 'server')
+
     def __init__(self, name, type_, class_, ttl,
                  priority, weight, port, server):
         DNSRecord.__init__(self, name, type_, class_, ttl)
@@ -620,14 +683,32 @@ class DNSService(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSRecord.__hash__
+
+    def rdata(self):
+        """Data compared by __eq__"""
+        return (self.priority, self.weight, self.port, self.server)
+
     def __repr__(self):
         """String representation"""
         return self.to_string("%s:%s" % (self.server, self.port))
 
 
+_HEADER = struct.Struct(b'!6H')
+_QUESTION = struct.Struct(b'!HH')
+_RECORD = struct.Struct(b'!HHiH')
+_RECORD_OUT = struct.Struct(b'!HHI')
+_SHORT = struct.Struct(b'!H')
+_SERVICE = struct.Struct(b'!HHH')
+
+
 class DNSIncoming(QuietLogger):
 
-    """Object representation of an incoming DNS packet"""
+    """Object representation of an incoming DNS packet
+
+    The packet is read in place with unpack_from(). Names are cached by
+    offset while parsing, so a compressed name pointing to a name (or a
+    suffix) read before is not decoded again."""
 
     def __init__(self, data):
         """Constructor from string holding bytes of packet"""
@@ -642,6 +723,9 @@ class DNSIncoming(QuietLogger):
         self.num_authorities = 0
         self.num_additionals = 0
         self.valid = False
+        # offset of a label -> name from that label to the end
+        self._names = {}
+        self._known_answers = None
 
         try:
             self.read_header()
@@ -654,22 +738,22 @@ class DNSIncoming(QuietLogger):
                 'Choked at offset %d while unpacking %r', self.offset, data))
 
     def unpack(self, format_):
-        length = struct.calcsize(format_)
-        info = struct.unpack(
-            format_, self.data[self.offset:self.offset + length])
-        self.offset += length
+        info = struct.unpack_from(format_, self.data, self.offset)
+        self.offset += struct.calcsize(format_)
         return info
 
     def read_header(self):
         """Reads header portion of packet"""
         (self.id, self.flags, self.num_questions, self.num_answers,
-         self.num_authorities, self.num_additionals) = self.unpack(b'!6H')
+         self.num_authorities, self.num_additionals) = _HEADER.unpack_from(self.data, 0)
+        self.offset = _HEADER.size
 
     def read_questions(self):
         """Reads questions section of packet"""
         for i in range(self.num_questions):
             name = self.read_name()
-            type_, class_ = self.unpack(b'!HH')
+            type_, class_ = _QUESTION.unpack_from(self.data, self.offset)
+            self.offset += _QUESTION.size
 
             question = DNSQuestion(name, type_, class_)
             self.questions.append(question)
@@ -686,13 +770,18 @@ class DNSIncoming(QuietLogger):
 
     def read_string(self, length):
         """Reads a string of a given length from the packet"""
-        info = self.data[self.offset:self.offset + length]
-        self.offset += length
+        end = self.offset + length
+        if end > len(self.data):
+            raise IncomingDecodeError("String past the end at %s" % (self.offset,))
+        info = self.data[self.offset:end]
+        self.offset = end
         return info
 
     def read_unsigned_short(self):
         """Reads an unsigned short from the packet"""
-        return self.unpack(b'!H')[0]
+        value = _SHORT.unpack_from(self.data, self.offset)[0]
+        self.offset += 2
+        return value
 
     def read_others(self):
         """Reads the answers, authorities and additionals section of the
@@ -700,7 +789,10 @@ class DNSIncoming(QuietLogger):
         n = self.num_answers + self.num_authorities + self.num_additionals
         for i in range(n):
             domain = self.read_name()
-            type_, class_, ttl, length = self.unpack(b'!HHiH')
+            type_, class_, ttl, length = _RECORD.unpack_from(self.data, self.offset)
+            self.offset += _RECORD.size
+            # the next record starts after the rdata, whatever was read of it
+            end = self.offset + length
 
             rec = None
             if type_ == _TYPE_A:
@@ -713,10 +805,11 @@ class DNSIncoming(QuietLogger):
                 rec = DNSText(
                     domain, type_, class_, ttl, self.read_string(length))
             elif type_ == _TYPE_SRV:
+                priority, weight, port = _SERVICE.unpack_from(self.data, self.offset)
+                self.offset += _SERVICE.size
                 rec = DNSService(
                     domain, type_, class_, ttl,
-                    self.read_unsigned_short(), self.read_unsigned_short(),
-                    self.read_unsigned_short(), self.read_name())
+                    priority, weight, port, self.read_name())
             elif type_ == _TYPE_HINFO:
                 rec = DNSHinfo(
                     domain, type_, class_, ttl,
@@ -724,15 +817,24 @@ class DNSIncoming(QuietLogger):
             elif type_ == _TYPE_AAAA:
                 rec = DNSAddress(
                     domain, type_, class_, ttl, self.read_string(16))
-            else:
-                # Try to ignore types we don't know about
-                # Skip the payload for the resource record so the next
-                # records can be parsed correctly
-                self.offset += length
+            # else: try to ignore types we don't know about, skipping the
+            # payload so the next records can be parsed correctly
+            self.offset = end
 
             if rec is not None:
                 self.answers.append(rec)
 
+    @property
+    def known_answers(self):
+        """The answers of the packet by record, with the longest TTL"""
+        if self._known_answers is None:
+            self._known_answers = {}
+            for record in self.answers:
+                known = self._known_answers.get(record)
+                if known is None or record.ttl > known.ttl:
+                    self._known_answers[record] = record
+        return self._known_answers
+
     def is_query(self):
         """Returns true if this is a query"""
         return (self.flags & _FLAGS_QR_MASK) == _FLAGS_QR_QUERY
@@ -747,28 +849,35 @@ class DNSIncoming(QuietLogger):
 
     def read_name(self):
         """Reads a domain name from the packet"""
-        result = ''
+        data = self.data
+        names = self._names
+        labels = []
         off = self.offset
         next_ = -1
         first = off
+        suffix = ''
 
         while True:
-            length = self.data[off]
-            off += 1
+            length = data[off]
             if length == 0:
+                off += 1
                 break
             t = length & 0xC0
             if t == 0x00:
-                result = ''.join((result, self.read_utf(off, length) + '.'))
-                off += length
+                labels.append((off, self.read_utf(off + 1, length)))
+                off += 1 + length
             elif t == 0xC0:
                 if next_ < 0:
-                    next_ = off + 1
-                off = ((length & 0x3F) << 8) | self.data[off]
+                    next_ = off + 2
+                off = ((length & 0x3F) << 8) | data[off + 1]
                 if off >= first:
                     raise IncomingDecodeError(
                         "Bad domain name (circular) at %s" % (off,))
                 first = off
+                cached = names.get(off)
+                if cached is not None:
+                    suffix = cached
+                    break
             else:
                 raise IncomingDecodeError("Bad domain name at %s" % (off,))
 
@@ -777,27 +886,39 @@ class DNSIncoming(QuietLogger):
         else:
             self.offset = off
 
-        return result
+        # build the name from its end, remembering every suffix
+        for label_offset, label in reversed(labels):
+            suffix = label + '.' + suffix
+            names[label_offset] = suffix
+        return suffix
 
 
 class DNSOutgoing:
 
-    """Object representation of an outgoing packet"""
+    """Object representation of an outgoing packet
+
+    The packet is packed into one preallocated buffer (the header is
+    filled in last, at its place), and names are compressed through a
+    dict of the offsets of every name suffix already written."""
 
     def __init__(self, flags, multicast=True):
         self.finished = False
         self.id = 0
         self.multicast = multicast
         self.flags = flags
+        # name suffix (without the final dot) -> offset in the packet
         self.names = {}
-        self.data = []
-        self.size = 12
+        self.data = bytearray(_MAX_MSG_ABSOLUTE)
+        self.size = _HEADER.size
         self.state = self.State.init
+        self._packet = None
 
         self.questions = []
         self.answers = []
         self.authorities = []
         self.additionals = []
+        # records already in the answers or additionals
+        self._records = set()
 
     def __repr__(self):
         return '<DNSOutgoing:{%s}>' % ', '.join([
@@ -824,8 +945,9 @@ class DNSOutgoing:
 
     def add_answer_at_time(self, record, now):
         """Adds an answer if it does not expire by a certain time"""
-        if record is not None:
+        if record is not None and record not in self._records:
             if now == 0 or not record.is_expired(now):
+                self._records.add(record)
                 self.answers.append((record, now))
 
     def add_authorative_answer(self, record):
@@ -868,24 +990,34 @@ class DNSOutgoing:
            o  All address records (type "A" and "AAAA") named in the SRV rdata.
 
         """
-        self.additionals.append(record)
+        if record not in self._records:
+            self._records.add(record)
+            self.additionals.append(record)
+
+    def _reserve(self, length):
+        """Returns the offset of length bytes at the end of the packet"""
+        offset = self.size
+        self.size += length
+        if self.size > len(self.data):
+            # over _MAX_MSG_ABSOLUTE: write_record() rolls the record back
+            self.data.extend(bytes(self.size - len(self.data)))
+        return offset
 
     def pack(self, format_, value):
-        self.data.append(struct.pack(format_, value))
-        self.size += struct.calcsize(format_)
+        format_ = struct.Struct(format_)
+        format_.pack_into(self.data, self._reserve(format_.size), value)
 
     def write_byte(self, value):
         """Writes a single byte to the packet"""
-        self.pack(b'!c', int2byte(value))
+        self.data[self._reserve(1)] = value
 
     def insert_short(self, index, value):
-        """Inserts an unsigned short in a certain position in the packet"""
-        self.data.insert(index, struct.pack(b'!H', value))
-        self.size += 2
+        """Writes an unsigned short at a certain position in the packet"""
+        _SHORT.pack_into(self.data, index, value)
 
     def write_short(self, value):
         """Writes an unsigned short to the packet"""
-        self.pack(b'!H', value)
+        _SHORT.pack_into(self.data, self._reserve(2), value)
 
     def write_int(self, value):
         """Writes an unsigned integer to the packet"""
@@ -894,8 +1026,8 @@ class DNSOutgoing:
     def write_string(self, value):
         """Writes a string to the packet"""
         assert isinstance(value, bytes)
-        self.data.append(value)
-        self.size += len(value)
+        offset = self._reserve(len(value))
+        self.data[offset:self.size] = value
 
     def write_utf(self, s):
         """Writes a UTF-8 string of a given length to the packet"""
@@ -926,45 +1058,37 @@ class DNSOutgoing:
         compact two-byte reference to an appearance of that data somewhere
         earlier in the message [RFC1035].
         """
-
-        # split name into each label
-        parts = name.split('.')
-        if not parts[-1]:
-            parts.pop()
-
-        # construct each suffix
-        name_suffices = ['.'.join(parts[i:]) for i in range(len(parts))]
-
-        # look for an existing name or suffix
-        for count, sub_name in enumerate(name_suffices):
-            if sub_name in self.names:
-                break
-        else:
-            count += 1
-
-        # note the new names we are saving into the packet
-        for suffix in name_suffices[:count]:
-            self.names[suffix] = self.size + len(name) - len(suffix) - 1
-
-        # write the new names out.
-        for part in parts[:count]:
-            self.write_utf(part)
-
-        # if we wrote part of the name, create a pointer to the rest
-        if count != len(name_suffices):
-            # Found substring in packet, create pointer
-            index = self.names[name_suffices[count]]
-            self.write_byte((index >> 8) | 0xC0)
-            self.write_byte(index & 0xFF)
-        else:
-            # this is the end of a name
-            self.write_byte(0)
+        if name.endswith('.'):
+            name = name[:-1]
+        names = self.names
+        data = self.data
+        start = 0
+        while start < len(name):
+            suffix = name[start:] if start else name
+            index = names.get(suffix)
+            if index is not None:
+                # the rest of the name is already in the packet
+                _SHORT.pack_into(data, self._reserve(2), 0xC000 | index)
+                return
+            end = name.find('.', start)
+            if end < 0:
+                end = len(name)
+            label = name[start:end].encode('utf-8')
+            if len(label) > 64:
+                raise NamePartTooLongException
+            offset = self._reserve(1 + len(label))
+            names[suffix] = offset
+            data[offset] = len(label)
+            data[offset + 1:self.size] = label
+            start = end + 1
+        # this is the end of a name
+        self.write_byte(0)
 
     def write_question(self, question):
         """Writes a question to the packet"""
         self.write_name(question.name)
-        self.write_short(question.type)
-        self.write_short(question.class_)
+        _QUESTION.pack_into(self.data, self._reserve(_QUESTION.size),
+                            question.type, question.class_)
 
     def write_record(self, record, now):
         """Writes a record (answer, authoritative answer, additional) to
@@ -972,33 +1096,28 @@ class DNSOutgoing:
         if self.state == self.State.finished:
             return 1
 
-        start_data_length, start_size = len(self.data), self.size
+        start_size, start_names = self.size, len(self.names)
         self.write_name(record.name)
-        self.write_short(record.type)
         if record.unique and self.multicast:
-            self.write_short(record.class_ | _CLASS_UNIQUE)
+            class_ = record.class_ | _CLASS_UNIQUE
         else:
-            self.write_short(record.class_)
+            class_ = record.class_
         if now == 0:
-            self.write_int(record.ttl)
+            ttl = record.ttl
         else:
-            self.write_int(record.get_remaining_ttl(now))
-        index = len(self.data)
-
-        # Adjust size for the short we will write before this record
-        self.size += 2
+            ttl = record.get_remaining_ttl(now)
+        _RECORD_OUT.pack_into(self.data, self._reserve(_RECORD_OUT.size),
+                              record.type, class_, int(ttl))
+        index = self._reserve(2)
         record.write(self)
-        self.size -= 2
-
-        length = sum((len(d) for d in self.data[index:]))
-        # Here is the short we adjusted for
-        self.insert_short(index, length)
+        self.insert_short(index, self.size - index - 2)
 
         # if we go over, then rollback and quit
         if self.size > _MAX_MSG_ABSOLUTE:
-            while len(self.data) > start_data_length:
-                self.data.pop()
             self.size = start_size
+            # forget the names written by this record (dicts pop LIFO)
+            for _ in range(len(self.names) - start_names):
+                self.names.popitem()
             self.state = self.State.finished
             return 1
         return 0
@@ -1009,9 +1128,9 @@ class DNSOutgoing:
         No further parts should be added to the packet once this
         is done."""
 
-        overrun_answers, overrun_authorities, overrun_additionals = 0, 0, 0
+        if self._packet is None:
+            overrun_answers, overrun_authorities, overrun_additionals = 0, 0, 0
 
-        if self.state != self.State.finished:
             for question in self.questions:
                 self.write_question(question)
             for answer, time_ in self.answers:
@@ -1022,61 +1141,106 @@ class DNSOutgoing:
                 overrun_additionals += self.write_record(additional, 0)
             self.state = self.State.finished
 
-            self.insert_short(0, len(self.additionals) - overrun_additionals)
-            self.insert_short(0, len(self.authorities) - overrun_authorities)
-            self.insert_short(0, len(self.answers) - overrun_answers)
-            self.insert_short(0, len(self.questions))
-            self.insert_short(0, self.flags)
-            if self.multicast:
-                self.insert_short(0, 0)
-            else:
-                self.insert_short(0, self.id)
-        return b''.join(self.data)
+            _HEADER.pack_into(
+                self.data, 0, 0 if self.multicast else self.id, self.flags,
+                len(self.questions), len(self.answers) - overrun_answers,
+                len(self.authorities) - overrun_authorities,
+                len(self.additionals) - overrun_additionals)
+            self._packet = bytes(self.data[:self.size])
+        return self._packet
 
 
 class DNSCache:
 
-    """A cache of DNS entries"""
+    """A cache of DNS entries
+
+    Records are indexed by identity (name, type, class and data) and by
+    name, so answering a packet costs O(1) per answer whatever the number of
+    cached records. Expirations are kept in a timer wheel of one second
+    slots: the reaper only looks at the records that are due instead of
+    walking the whole cache."""
+
+    _SLOT = 1000  # ms
 
     def __init__(self):
+        self._lock = threading.RLock()
+        # record -> record (the cached instance of an equal record)
+        self._records = {}
+        # name -> [record, ...], oldest first
         self.cache = {}
+        # slot end time -> records expiring in that slot
+        self._wheel = {}
+        # min-heap of the slot end times in _wheel
+        self._slots = []
+        self._scheduled = 0
+
+    def __len__(self):
+        return len(self._records)
 
     def add(self, entry):
-        """Adds an entry"""
-        # Insert first in list so get returns newest entry
-        self.cache.setdefault(entry.key, []).insert(0, entry)
+        """Adds an entry, replacing an equal one"""
+        with self._lock:
+            self._remove(entry)
+            self._records[entry] = entry
+            self.cache.setdefault(entry.key, []).append(entry)
+            self._schedule(entry)
+            # records removed early stay in their slot until it is due:
+            # rebuild the wheel when they outnumber the live ones
+            if self._scheduled > 2 * len(self._records) + 64:
+                self._wheel = {}
+                self._slots = []
+                self._scheduled = 0
+                for record in self._records:
+                    self._schedule(record)
 
     def remove(self, entry):
         """Removes an entry"""
-        try:
-            list_ = self.cache[entry.key]
-            list_.remove(entry)
-        except (KeyError, ValueError):
-            pass
+        with self._lock:
+            self._remove(entry)
+
+    def _remove(self, entry):
+        cached = self._records.pop(entry, None)
+        if cached is not None:
+            records = self.cache[cached.key]
+            if len(records) == 1:
+                del self.cache[cached.key]
+            else:
+                # by identity: list.remove() would call __eq__ on every
+                # record before it
+                del records[next(i for i, record in enumerate(records)
+                                 if record is cached)]
+
+    def _schedule(self, entry):
+        slot = (int(entry.get_expiration_time(100)) // self._SLOT + 1) * self._SLOT
+        records = self._wheel.get(slot)
+        if records is None:
+            records = self._wheel[slot] = []
+            heapq.heappush(self._slots, slot)
+        records.append(entry)
+        self._scheduled += 1
 
     def get(self, entry):
         """Gets an entry by key.  Will return None if there is no
         matching entry."""
-        try:
-            list_ = self.cache[entry.key]
-            for cached_entry in list_:
-                if entry.__eq__(cached_entry):
-                    return cached_entry
-        except (KeyError, ValueError):
-            return None
+        if isinstance(entry, DNSRecord):
+            return self._records.get(entry)
+        # a bare entry matches any record of the same name, type and class
+        return self.get_by_details(entry.name, entry.type, entry.class_)
 
     def get_by_details(self, name, type_, class_):
         """Gets an entry by details.  Will return None if there is
         no matching entry."""
-        entry = DNSEntry(name, type_, class_)
-        return self.get(entry)
+        class_ &= _CLASS_MASK
+        with self._lock:
+            for record in reversed(self.cache.get(name.lower(), [])):
+                if record.type == type_ and record.class_ == class_:
+                    return record
 
     def entries_with_name(self, name):
-        """Returns a list of entries whose key matches the name."""
-        try:
-            return self.cache[name.lower()]
-        except KeyError:
-            return []
+        """Returns a list of entries whose key matches the name,
+        newest first."""
+        with self._lock:
+            return self.cache.get(name.lower(), [])[::-1]
 
     def current_entry_with_name_and_alias(self, name, alias):
         now = current_time_millis()
@@ -1088,69 +1252,34 @@ class DNSCache:
 
     def entries(self):
         """Returns a list of all entries"""
-        if not self.cache:
-            return []
-        else:
-            # avoid size change during iteration by copying the cache
-            values = list(self.cache.values())
-            return reduce(lambda a, b: a + b, values)
-
-
-class Engine(threading.Thread):
-
-    """An engine wraps read access to sockets, allowing objects that
-    need to receive data from sockets to be called back when the
-    sockets are ready.
-
-    A reader needs a handle_read() method, which is called when the socket
-    it is interested in is ready for reading.
-
-    Writers are not implemented here, because we only send short
-    packets.
-    """
-
-    def __init__(self, zc):
-        threading.Thread.__init__(self, name='zeroconf-Engine')
-        self.daemon = True
-        self.zc = zc
-        self.readers = {}  # maps socket to reader
-        self.timeout = 5
-        self.condition = threading.Condition()
-        self.start()
-
-    def run(self):
-        while not self.zc.done:
-            with self.condition:
-                rs = self.readers.keys()
-                if len(rs) == 0:
-                    # No sockets to manage, but we wait for the timeout
-                    # or addition of a socket
-                    self.condition.wait(self.timeout)
-
-            if len(rs) != 0:
-                try:
-                    rr, wr, er = select.select(rs, [], [], self.timeout)
-                    if not self.zc.done:
-                        for socket_ in rr:
-                            reader = self.readers.get(socket_)
-                            if reader:
-                                reader.handle_read(socket_)
-
-                except (select.error, socket.error) as e:
-                    # If the socket was closed by another thread, during
-                    # shutdown, ignore it and exit
-                    if e.args[0] != socket.EBADF or not self.zc.done:
-                        raise
-
-    def add_reader(self, reader, socket_):
-        with self.condition:
-            self.readers[socket_] = reader
-            self.condition.notify()
-
-    def del_reader(self, socket_):
-        with self.condition:
-            del self.readers[socket_]
-            self.condition.notify()
+        with self._lock:
+            return list(self._records)
+
+    def next_expiration(self):
+        """Returns the end of the next timer wheel slot, or None."""
+        slots = self._slots
+        return slots[0] if slots else None
+
+    def expire(self, now):
+        """Removes the entries that have expired at now and returns them.
+
+        A record whose TTL was reset since it was scheduled is moved to the
+        slot of its new expiration time."""
+        expired = []
+        with self._lock:
+            while self._slots and self._slots[0] <= now:
+                records = self._wheel.pop(heapq.heappop(self._slots))
+                self._scheduled -= len(records)
+                for record in records:
+                    if self._records.get(record) is not record:
+                        # removed, or replaced by a newer equal record
+                        continue
+                    if record.is_expired(now):
+                        self._remove(record)
+                        expired.append(record)
+                    else:
+                        self._schedule(record)
+        return expired
 
 
 class Listener(QuietLogger):
@@ -1159,8 +1288,8 @@ class Listener(QuietLogger):
     group to which DNS messages are sent, allowing the implementation
     to cache information as it arrives.
 
-    It requires registration with an Engine object in order to have
-    the read() method called when a socket is available for reading."""
+    Its handle_read() method is called by the event loop of the Zeroconf
+    instance when the socket is available for reading."""
 
     def __init__(self, zc):
         self.zc = zc
@@ -1171,6 +1300,8 @@ class Listener(QuietLogger):
             data, addr = socket_.recvfrom(_MAX_MSG_ABSOLUTE)
             port = addr[1]
             addr = addr[0]
+        except BlockingIOError:
+            return
         except Exception as exc:
             self.log_exception_warning()
             print("Exception raised", exc)
@@ -1186,6 +1317,7 @@ class Listener(QuietLogger):
         elif msg.is_query():
             # Always multicast responses
             if port == _MDNS_PORT:
+                self.zc.handle_duplicate_questions(msg)
                 if self.zc.address_family is socket.AF_INET6: 
                     self.zc.handle_query(msg, _MDNS_ADDR_IPV6, _MDNS_PORT)
                 else: 
@@ -1205,29 +1337,6 @@ class Listener(QuietLogger):
             self.zc.handle_response(msg)
 
 
-class Reaper(threading.Thread):
-
-    """A Reaper is used by this module to remove cache entries that
-    have expired."""
-
-    def __init__(self, zc):
-        threading.Thread.__init__(self, name='zeroconf-Reaper')
-        self.daemon = True
-        self.zc = zc
-        self.start()
-
-    def run(self):
-        while True:
-            self.zc.wait(10 * 1000)
-            if self.zc.done:
-                return
-            now = current_time_millis()
-            for record in self.zc.cache.entries():
-                if record.is_expired(now):
-                    self.zc.update_record(now, record)
-                    self.zc.cache.remove(record)
-
-
 class Signal:
     def __init__(self):
         self._handlers = []
@@ -1255,28 +1364,35 @@ class SignalRegistrationInterface:
         return self
 
 
-class ServiceBrowser(threading.Thread):
+class ServiceBrowser:
 
     """Used to browse for a service of a specific type.
 
     The listener object will have its add_service() and
     remove_service() methods called when this browser
-    discovers changes in the services availability."""
+    discovers changes in the services availability.
+
+    The browser has no thread of its own: the event loop of the Zeroconf
+    instance sends its queries (together with those of the other browsers
+    due at the same time) and the handlers are called one at a time in the
+    loop's executor, so they may block (e.g. on get_service_info())."""
 
     def __init__(self, zc, type_, handlers=None, listener=None):
         """Creates a browser for a specific type"""
         assert handlers or listener, 'You need to specify at least one handler'
         if not type_.endswith(service_type_name(type_)):
             raise BadTypeInNameException
-        threading.Thread.__init__(
-            self, name='zeroconf-ServiceBrowser_' + type_)
-        self.daemon = True
+        self.name = 'zeroconf-ServiceBrowser_' + type_
         self.zc = zc
         self.type = type_
         self.services = {}
         self.next_time = current_time_millis()
         self.delay = _BROWSER_TIME
-        self._handlers_to_call = []
+        self.interval = 0
+        self.queried = False
+        self._handlers_to_call = collections.deque()
+        self._handlers_lock = threading.Lock()
+        self._calling_handlers = False
 
         self._service_state_changed = Signal()
 
@@ -1302,7 +1418,7 @@ class ServiceBrowser(threading.Thread):
         for h in handlers:
             self.service_state_changed.register_handler(h)
 
-        self.start()
+        zc.add_browser(self)
 
     @property
     def service_state_changed(self):
@@ -1314,13 +1430,15 @@ class ServiceBrowser(threading.Thread):
         Updates information required by browser in the Zeroconf cache."""
 
         def enqueue_callback(state_change, name):
-            self._handlers_to_call.append(
-                lambda zeroconf: self._service_state_changed.fire(
-                    zeroconf=zeroconf,
-                    service_type=self.type,
-                    name=name,
-                    state_change=state_change,
-                ))
+            with self._handlers_lock:
+                self._handlers_to_call.append(
+                    lambda zeroconf: self._service_state_changed.fire(
+                        zeroconf=zeroconf,
+                        service_type=self.type,
+                        name=name,
+                        state_change=state_change,
+                    ))
+            self._call_handlers_soon()
 
         if record.type == _TYPE_PTR and record.name == self.type:
             expired = record.is_expired(now)
@@ -1342,36 +1460,71 @@ class ServiceBrowser(threading.Thread):
             expires = record.get_expiration_time(75)
             if expires < self.next_time:
                 self.next_time = expires
+                zc.schedule_queries()
+
+    def add_query(self, out, now):
+        """Adds the question of this browser, with the known answers, to
+        an outgoing query and schedules the next one."""
+        question = DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN)
+        if question not in out.questions:
+            out.add_question(question)
+        for record in self.services.values():
+            if not record.is_stale(now):
+                out.add_answer_at_time(record, now)
+        self.queried = True
+        self.query_sent(now)
+
+    def due(self, now):
+        """Returns true if the next query is due within half an interval
+        (at least _QUERY_COALESCE_TIME)."""
+        return self.next_time <= now + max(self.interval / 2, _QUERY_COALESCE_TIME)
+
+    def known_by(self, known_answers, now):
+        """Returns true if the known answers of another host's query for
+        this browser's type hold no record this browser would not list
+        itself (RFC 6762 7.3). Never true before the browser's first query:
+        responders suppress the answers that query listed."""
+        if not self.queried:
+            return False
+        key = self.type.lower()
+        for other in known_answers.values():
+            if other.type != _TYPE_PTR or other.key != key:
+                continue
+            record = self.services.get(other.alias.lower())
+            if (record is None or record.is_stale(now) or
+                    not record.suppressed_by_answer(other)):
+                return False
+        return True
 
-    def cancel(self):
-        self.done = True
-        self.zc.remove_listener(self)
-        self.join()
+    def query_sent(self, now):
+        """Schedules the next query with exponential back-off."""
+        self.interval = self.delay
+        self.next_time = now + self.delay
+        self.delay = min(20 * 1000, self.delay * 2)
 
-    def run(self):
-        self.zc.add_listener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+    def _call_handlers_soon(self):
+        with self._handlers_lock:
+            if self._calling_handlers:
+                return
+            self._calling_handlers = True
+        self.zc.loop.run_in_executor(None, self._call_handlers)
 
+    def _call_handlers(self):
         while True:
-            now = current_time_millis()
-            if len(self._handlers_to_call) == 0 and self.next_time > now:
-                self.zc.wait(self.next_time - now)
-            if self.zc.done or self.done:
-                return
-            now = current_time_millis()
-            if self.next_time <= now:
-                out = DNSOutgoing(_FLAGS_QR_QUERY)
-                out.add_question(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-                for record in self.services.values():
-                    if not record.is_stale(now):
-                        out.add_answer_at_time(record, now)
-
-                self.zc.send(out)
-                self.next_time = now + self.delay
-                self.delay = min(20 * 1000, self.delay * 2)
-
-            if len(self._handlers_to_call) > 0 and not self.zc.done:
-                handler = self._handlers_to_call.pop(0)
+            with self._handlers_lock:
+                if not self._handlers_to_call or self.done or self.zc.done:
+                    self._calling_handlers = False
+                    return
+                handler = self._handlers_to_call.popleft()
+            try:
                 handler(self.zc)
+            except Exception:  # TODO stop catching all Exceptions
+                log.exception('Error in %s handler', self.name)
+
+    def cancel(self):
+        self.done = True
+        self.zc.remove_browser(self)
+        self.zc.remove_listener(self)
 
 
 class ServiceInfo:
@@ -1741,13 +1894,20 @@ class Zeroconf(QuietLogger):
         interfaces=InterfaceChoice.All,
         ipv6_interface_name=None,
         apple_mdns=False,
+        loop=None,
     ):
         """Creates an instance of the Zeroconf class, establishing
-        multicast communications, listening and reaping threads.
+        multicast communications. Reading, reaping and browsing all run
+        as callbacks of one asyncio event loop.
 
         :type interfaces: :class:`InterfaceChoice` or sequence of ip addresses
         :param ipv6_interface_name: string defining the name of the IPv6 interface that should be used. None if IPv4 should be used
         :param apple_mdns: For Apple's mdns services._dns-sd._udp.local. has to be included in an answer
+        :param loop: running event loop to use (e.g. the one of the web
+            app): no thread is started. The blocking methods
+            (get_service_info, register_service...) must then be called
+            from another thread, e.g. with loop.run_in_executor(). By
+            default the instance runs its own loop in one thread.
         """
         # hook for threads
         self._GLOBAL_DONE = False
@@ -1819,10 +1979,28 @@ class Zeroconf(QuietLogger):
 
         self.condition = threading.Condition()
 
-        self.engine = Engine(self)
+        self._browsers = []
+        self._query_timer = None
+        self._query_time = None
+        self._reap_timer = None
+        self._reap_time = None
+        self._pending_response = None
+        self._response_timer = None
+        # record -> time it was last multicast in a response
+        self._multicast_times = {}
+
         self.listener = Listener(self)
-        self.engine.add_reader(self.listener, self._listen_socket)
-        self.reaper = Reaper(self)
+        self._listen_socket.setblocking(False)
+
+        self._loop_thread = None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(
+                target=loop.run_forever, name='zeroconf-loop', daemon=True)
+            self._loop_thread.start()
+        self.loop = loop
+        self._call_in_loop(self.loop.add_reader, self._listen_socket,
+                           self.listener.handle_read, self._listen_socket)
 
         self.debug = None
 
@@ -1841,6 +2019,109 @@ class Zeroconf(QuietLogger):
         with self.condition:
             self.condition.notify_all()
 
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _call_in_loop(self, callback, *args):
+        """Runs callback in the event loop and waits for it."""
+        if self._in_loop():
+            return callback(*args)
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(callback(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def add_browser(self, browser):
+        """Starts browsing with a ServiceBrowser."""
+        def add():
+            if self.done or browser.done:
+                return
+            self._browsers.append(browser)
+            self.add_listener(browser, DNSQuestion(browser.type, _TYPE_PTR, _CLASS_IN))
+            self.schedule_queries()
+
+        if self._in_loop():
+            add()
+        else:
+            self.loop.call_soon_threadsafe(add)
+
+    def remove_browser(self, browser):
+        def remove():
+            if browser in self._browsers:
+                self._browsers.remove(browser)
+            self.schedule_queries()
+
+        if self._in_loop():
+            remove()
+        elif not self.done:
+            self.loop.call_soon_threadsafe(remove)
+
+    def schedule_queries(self):
+        """Sets the query timer to the first browser due (in the loop)."""
+        if not self._browsers or self.done:
+            next_time = None
+        else:
+            next_time = min(browser.next_time for browser in self._browsers)
+        if next_time == self._query_time:
+            return
+        if self._query_timer is not None:
+            self._query_timer.cancel()
+            self._query_timer = None
+        self._query_time = next_time
+        if next_time is not None:
+            delay = max(next_time - current_time_millis(), 0) / 1000.0
+            self._query_timer = self.loop.call_later(delay, self._send_queries)
+
+    def _send_queries(self):
+        """Sends one query for all the browsers that are due.
+
+        A browser is due within half of its query interval, so browsers
+        started at different times are pulled into the same packets and
+        end up following one shared back-off."""
+        self._query_timer = None
+        self._query_time = None
+        now = current_time_millis()
+        out = None
+        for browser in self._browsers:
+            if browser.due(now):
+                if out is None:
+                    out = DNSOutgoing(_FLAGS_QR_QUERY)
+                browser.add_query(out, now)
+        if out is not None:
+            self.send(out)
+        self.schedule_queries()
+
+    def _schedule_reaper(self):
+        """Sets the reaper timer to the next expiration of the cache."""
+        next_time = self.cache.next_expiration()
+        if next_time == self._reap_time or self.done:
+            return
+        if self._reap_timer is not None:
+            self._reap_timer.cancel()
+            self._reap_timer = None
+        self._reap_time = next_time
+        if next_time is not None:
+            delay = max(next_time - current_time_millis(), 0) / 1000.0
+            self._reap_timer = self.loop.call_later(delay, self._reap)
+
+    def _reap(self):
+        """Removes the cache entries that have expired."""
+        self._reap_timer = None
+        self._reap_time = None
+        now = current_time_millis()
+        for record in self.cache.expire(now):
+            self.update_record(now, record)
+        self._schedule_reaper()
+
     def get_service_info(self, type_, name, timeout=3000):
         """Returns network's service information for a particular
         name and type, or None if no service matches by the timeout,
@@ -2059,18 +2340,20 @@ class Zeroconf(QuietLogger):
         now = current_time_millis()
         for record in msg.answers:
             expired = record.is_expired(now)
-            if record in self.cache.entries():
+            entry = self.cache.get(record)
+            if entry is not None:
                 if expired:
-                    self.cache.remove(record)
+                    self.cache.remove(entry)
                 else:
-                    entry = self.cache.get(record)
-                    if entry is not None:
-                        entry.reset_ttl(record)
+                    # the cache notices the later expiration when the old
+                    # one is due
+                    entry.reset_ttl(record)
             else:
                 self.cache.add(record)
 
         for record in msg.answers:
             self.update_record(now, record)
+        self._schedule_reaper()
 
     def handle_query(self, msg, addr, port):
         """Deal with incoming query packets.  Provides a response if
@@ -2148,16 +2431,80 @@ class Zeroconf(QuietLogger):
                         address_type = _TYPE_A
                         if self.address_family == socket.AF_INET6:
                             address_type = _TYPE_AAAA
-                        out.add_additional_answer(DNSAddress(
+                        address = DNSAddress(
                             service.server, address_type, _CLASS_IN | _CLASS_UNIQUE,
-                            _DNS_TTL, service.address))
+                            _DNS_TTL, service.address)
+                        if not address.suppressed_by(msg):
+                            out.add_additional_answer(address)
 
                 except Exception:  # TODO stop catching all Exceptions
                     self.log_exception_warning()
 
         if out is not None and out.answers:
             out.id = msg.id
-            self.send(out, addr, port)
+            if out.multicast and port == _MDNS_PORT:
+                self._queue_response(out)
+            else:
+                self.send(out, addr, port)
+
+    def _queue_response(self, out):
+        """Adds the answers of a multicast response to the next one sent.
+
+        The response waits 20-120 ms (RFC 6762 6.3) unless it only holds
+        unique records, so the answers to several queries (e.g. every
+        AirDrop browser on the channel asking at once) share a packet, and
+        records multicast less than a second ago are left out (6.2)."""
+        now = current_time_millis()
+        pending = self._pending_response
+        if pending is None:
+            pending = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
+        for record, time_ in out.answers:
+            if now - self._multicast_times.get(record, -_RESPONSE_RATE_LIMIT) >= _RESPONSE_RATE_LIMIT:
+                pending.add_answer_at_time(record, time_)
+        if not pending.answers:
+            return
+        for record in out.additionals:
+            pending.add_additional_answer(record)
+        if self._pending_response is not None:
+            return
+
+        self._pending_response = pending
+        if all(record.unique for record, _ in pending.answers):
+            delay = 0
+        else:
+            delay = random.randint(_RESPONSE_DELAY_MIN, _RESPONSE_DELAY_MAX)
+        self._response_timer = self.loop.call_later(delay / 1000.0, self._send_response)
+
+    def _send_response(self):
+        out, self._pending_response = self._pending_response, None
+        self._response_timer = None
+        now = current_time_millis()
+        times = self._multicast_times
+        if len(times) > 1024:
+            for record, time_ in list(times.items()):
+                if now - time_ >= _RESPONSE_RATE_LIMIT:
+                    del times[record]
+        for record, _ in out.answers:
+            times[record] = now
+        self.send(out)
+
+    def handle_duplicate_questions(self, msg):
+        """RFC 6762 7.3: a query of another host asking the question of a
+        browser that is due soon, and listing no known answer the browser
+        would not list itself, is taken as the browser's own query."""
+        if not self._browsers or not msg.questions:
+            return
+        now = current_time_millis()
+        known = msg.known_answers
+        for question in msg.questions:
+            if question.unique or question.type not in (_TYPE_PTR, _TYPE_ANY):
+                # unicast responses were asked for: nobody else sees them
+                continue
+            for browser in self._browsers:
+                if (browser.type.lower() == question.key and
+                        browser.due(now) and browser.known_by(known, now)):
+                    browser.query_sent(now)
+        self.schedule_queries()
 
     def send(self, out, addr=None, port=_MDNS_PORT):
         """Sends an outgoing packet."""
@@ -2190,29 +2537,154 @@ class Zeroconf(QuietLogger):
                             bytes_sent, len(packet)), s)
 
     def close(self):
-        """Ends the background threads, and prevent this instance from
-        servicing further queries."""
+        """Ends the event loop callbacks (and thread), and prevent this
+        instance from servicing further queries."""
         if not self._GLOBAL_DONE:
             self._GLOBAL_DONE = True
             # remove service listeners
             self.remove_all_service_listeners()
             self.unregister_all_services()
 
-            # shutdown recv socket and thread
-            self.engine.del_reader(self._listen_socket)
+            # shutdown recv socket and timers
+            self._call_in_loop(self._close_sockets)
+            if self._loop_thread is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._loop_thread.join()
+                self.loop.close()
+
+            # shutdown the rest
+            self.notify_all()
+
+    def _close_sockets(self):
+        for timer in (self._query_timer, self._reap_timer, self._response_timer):
+            if timer is not None:
+                timer.cancel()
+        self._query_timer = self._reap_timer = self._response_timer = None
+        self._browsers = []
+        self.loop.remove_reader(self._listen_socket)
 
+        try:
             if self.address_family == socket.AF_INET:
                 self._listen_socket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP,
                     socket.inet_aton(_MDNS_ADDR) + socket.inet_aton('0.0.0.0'))
             else:
                 group = socket.inet_pton(socket.AF_INET6,_MDNS_ADDR_IPV6) + self.ifn
                 self._listen_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP,group)
-            
-            self._listen_socket.close()
-            self.engine.join()
+        except socket.error as e:
+            # closing the socket leaves the group anyway
+            log.debug('Cannot leave the multicast group: %r', e)
 
-            # shutdown the rest
-            self.notify_all()
-            self.reaper.join()
-            for s in self._respond_sockets:
-                s.close()
+        self._listen_socket.close()
+        for s in self._respond_sockets:
+            s.close()
+
+
+def read_pcap(path):
+    """Returns the mDNS payloads (UDP port 5353) of a pcap capture, e.g.
+    ``tcpdump -i awdl0 -w mdns.pcap udp port 5353``."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif data[:4] in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError('%s is not a pcap file' % path)
+    linktype = struct.unpack_from(endian + 'I', data, 20)[0] & 0xFFFF
+    # link type -> (offset of the ethertype or None, offset of the IP header)
+    layouts = {0: (None, 4), 1: (12, 14), 12: (None, 0), 101: (None, 0),
+               113: (14, 16), 276: (0, 20)}
+    if linktype not in layouts:
+        raise ValueError('unsupported pcap link type %d' % linktype)
+    ethertype_at, ip_at = layouts[linktype]
+
+    payloads = []
+    offset = 24
+    while offset + 16 <= len(data):
+        length = struct.unpack_from(endian + 'I', data, offset + 8)[0]
+        frame = data[offset + 16:offset + 16 + length]
+        offset += 16 + length
+        start = ip_at
+        if ethertype_at is not None and frame[ethertype_at:ethertype_at + 2] == b'\x81\x00':
+            start += 4  # 802.1Q tag
+        ip = frame[start:]
+        if not ip:
+            continue
+        if ip[0] >> 4 == 4:
+            protocol, udp = ip[9], ip[(ip[0] & 0x0F) * 4:]
+        elif ip[0] >> 4 == 6:
+            protocol, udp = ip[6], ip[40:]
+        else:
+            continue
+        if protocol == 17 and len(udp) > 8 and _MDNS_PORT in struct.unpack_from('!HH', udp):
+            payloads.append(udp[8:])
+    return payloads
+
+
+def sample_packets(services=8):
+    """AirDrop discovery traffic: a browse query with known answers and
+    the responses of ``services`` receivers (PTR, SRV, TXT and AAAA)."""
+    query = DNSOutgoing(_FLAGS_QR_QUERY)
+    query.add_question(DNSQuestion('_airdrop._tcp.local.', _TYPE_PTR, _CLASS_IN))
+    packets = []
+    for i in range(services):
+        instance = '%012x._airdrop._tcp.local.' % (0x5e1f00d00000 + i)
+        host = 'Phone-%d.local.' % i
+        query.add_answer_at_time(DNSPointer(
+            '_airdrop._tcp.local.', _TYPE_PTR, _CLASS_IN, 4500, instance), 0)
+        response = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
+        response.add_answer_at_time(DNSPointer(
+            '_airdrop._tcp.local.', _TYPE_PTR, _CLASS_IN, 4500, instance), 0)
+        response.add_answer_at_time(DNSService(
+            instance, _TYPE_SRV, _CLASS_IN | _CLASS_UNIQUE, 120, 0, 0, 8770, host), 0)
+        response.add_answer_at_time(DNSText(
+            instance, _TYPE_TXT, _CLASS_IN | _CLASS_UNIQUE, 4500, b'\x0aflags=1019'), 0)
+        response.add_answer_at_time(DNSAddress(
+            host, _TYPE_AAAA, _CLASS_IN | _CLASS_UNIQUE, 120,
+            socket.inet_pton(socket.AF_INET6, 'fe80::1c2d:%x' % i)), 0)
+        packets.append(response.packet())
+    packets.append(query.packet())
+    return packets
+
+
+def benchmark(packets, repeat=100):
+    """
+    Measure DNSIncoming parsing and DNSOutgoing packing of packets.
+
+    Each packet is parsed, then its questions and records are packed again
+    into a new packet (from the parsed objects, so only packing is timed).
+
+    :returns: ``dict`` with packets/sec for both directions.
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        messages = [DNSIncoming(packet) for packet in packets]
+    parse = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for msg in messages:
+            out = DNSOutgoing(msg.flags)
+            for question in msg.questions:
+                out.add_question(question)
+            for record in msg.answers:
+                out.add_answer_at_time(record, 0)
+            out.packet()
+    pack = time.perf_counter() - started
+
+    total = len(packets) * repeat
+    return {'packets': total,
+            'bytes': sum(len(packet) for packet in packets) * repeat,
+            'parse_per_sec': total / parse if parse else 0.0,
+            'pack_per_sec': total / pack if pack else 0.0}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'bench':
+        print('usage: python3 zeroconf.py bench [mdns.pcap] [repeat]')
+        sys.exit(1)
+    captured = sys.argv[2] if len(sys.argv) > 2 else None
+    result = benchmark(read_pcap(captured) if captured else sample_packets(),
+                       int(sys.argv[3]) if len(sys.argv) > 3 else 1000)
+    print('%(packets)d packets (%(bytes)d bytes): parse %(parse_per_sec).0f packets/sec, '
+          'pack %(pack_per_sec).0f packets/sec' % result)
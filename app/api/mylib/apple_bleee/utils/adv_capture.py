@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Record LE advertising reports to pcap and replay captures offline.
+
+Recording writes one Link Layer advertising PDU per report, using the
+``LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR`` (256) pcap link type so the files
+open directly in Wireshark (RSSI is kept in the pseudo header).
+
+Replay reads those files, as well as btsnoop captures of HCI traffic
+(``btmon -w``, Android ``btsnoop_hci.log``), and feeds every report to a
+handler with the same signature as the one given to
+:func:`.bluetooth_utils.parse_le_advertising_events`:
+``handler(mac, adv_type, data, rssi)``. It runs either with the original
+timing or as fast as possible, which makes parsers benchmarkable and
+debuggable without a bluetooth controller.
+
+This module does not need PyBluez.
+
+Command line::
+
+    python3 adv_capture.py dump capture.pcap
+    python3 adv_capture.py bench capture.pcap
+"""
+
+import struct
+import time
+
+__all__ = ('AdvRecorder', 'iter_capture', 'replay', 'benchmark',
+           'LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR')
+
+LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR = 256
+
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+BTSNOOP_MAGIC = b'btsnoop\x00'
+BTSNOOP_H4 = 1002
+BTSNOOP_MONITOR = 2001
+# btsnoop timestamps are microseconds since 0000-01-01
+BTSNOOP_EPOCH_DELTA_US = 0x00dcddb30f2f8000
+# btmon opcode for HCI event packets
+MONITOR_EVENT_PKT = 3
+
+ADV_ACCESS_ADDRESS = 0x8E89BED6
+ADV_CRC_INIT = 0x555555
+DEFAULT_CHANNEL = 37
+
+# pseudo header flags
+PHDR_SIGNAL_VALID = 0x0002
+PHDR_REF_AA_VALID = 0x0010
+PHDR_CRC_CHECKED = 0x0400
+PHDR_CRC_VALID = 0x0800
+
+# HCI advertising report event type <-> LL advertising PDU type
+_EVT_TO_PDU = {0x00: 0x0, 0x01: 0x1, 0x02: 0x6, 0x03: 0x2, 0x04: 0x4}
+_PDU_TO_EVT = dict((v, k) for k, v in _EVT_TO_PDU.items())
+PDU_ADV_DIRECT_IND = 0x1
+
+_PCAP_HEADER = struct.Struct('<IHHiIII')
+_PCAP_RECORD = struct.Struct('<IIII')
+_PHDR = struct.Struct('<BbbBIH')
+_LL_HEADER = struct.Struct('<IBB')
+_BTSNOOP_HEADER = struct.Struct('>8sII')
+_BTSNOOP_RECORD = struct.Struct('>IIIIq')
+
+
+def _ba2str(raw):
+    """Little endian address bytes -> 'AA:BB:CC:DD:EE:FF' (same as bluez.ba2str)."""
+    return ':'.join('%02X' % b for b in reversed(raw))
+
+
+def _str2ba(mac):
+    return bytes(reversed(bytes.fromhex(mac.replace(':', ''))))
+
+
+def _crc24(data, init=ADV_CRC_INIT):
+    """BLE Link Layer CRC (transmitted LSB first, as stored in captures)."""
+    # bit reflected LFSR: the register starts with the init value reversed
+    crc = int('{:024b}'.format(init)[::-1], 2)
+    for byte in data:
+        for _ in range(8):
+            bit = (crc ^ byte) & 1
+            crc >>= 1
+            byte >>= 1
+            if bit:
+                crc ^= 0xDA6000
+    return crc
+
+
+class AdvRecorder(object):
+    """
+    Write LE advertising reports to a pcap file.
+
+    The instance itself is a valid ``parse_le_advertising_events`` handler;
+    use :meth:`tee` to record while still feeding another handler.
+
+    :param path: Output pcap path (overwritten).
+    :param channel: RF channel stored in the pseudo header (HCI does not
+        report it).
+    """
+
+    def __init__(self, path, channel=DEFAULT_CHANNEL):
+        self.path = path
+        self.channel = channel
+        self.count = 0
+        self._f = open(path, 'wb')
+        self._f.write(_PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 65535,
+                                        LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR))
+
+    def __call__(self, mac, adv_type, data, rssi):
+        self.write(mac, adv_type, data, rssi)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, mac, adv_type, data, rssi, addr_type=0, ts=None):
+        """
+        Append one report.
+
+        :param mac: Advertiser address ('AA:BB:CC:DD:EE:FF').
+        :param adv_type: HCI advertising report event type (ADV_IND, ...).
+        :param data: Advertising data (``bytes``).
+        :param rssi: RSSI in dBm.
+        :param addr_type: 0 for public, 1 for random addresses.
+        :param ts: Reception time (``time.time()`` by default).
+        """
+        if ts is None:
+            ts = time.time()
+        pdu_type = _EVT_TO_PDU.get(adv_type, 0x2)
+        payload = _str2ba(mac)
+        if pdu_type == PDU_ADV_DIRECT_IND:
+            # the target address is not part of the HCI report
+            payload += b'\x00' * 6
+        else:
+            payload += bytes(data)
+        header = pdu_type | ((addr_type & 1) << 6)
+        pdu = struct.pack('<BB', header, len(payload)) + payload
+        crc = _crc24(pdu)
+        frame = (_PHDR.pack(self.channel, rssi, 0, 0, ADV_ACCESS_ADDRESS,
+                            PHDR_SIGNAL_VALID | PHDR_REF_AA_VALID | PHDR_CRC_CHECKED | PHDR_CRC_VALID) +
+                 struct.pack('<I', ADV_ACCESS_ADDRESS) + pdu +
+                 bytes((crc & 0xFF, (crc >> 8) & 0xFF, (crc >> 16) & 0xFF)))
+        sec = int(ts)
+        self._f.write(_PCAP_RECORD.pack(sec, int((ts - sec) * 1000000), len(frame), len(frame)))
+        self._f.write(frame)
+        self.count += 1
+
+    def tee(self, handler):
+        """Return a handler recording every report before passing it to ``handler``."""
+        def _handler(mac, adv_type, data, rssi):
+            self.write(mac, adv_type, data, rssi)
+            handler(mac, adv_type, data, rssi)
+        return _handler
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+
+
+def _iter_hci_event(pkt, ts):
+    """Reports of an HCI LE advertising report event (packet without H4 type byte)."""
+    if len(pkt) < 4 or pkt[0] != 0x3E or pkt[2] != 0x02:
+        return
+    end = len(pkt)
+    i = 4
+    for _ in range(pkt[3]):
+        if i + 9 > end:
+            return
+        data_end = i + 9 + pkt[i + 8]
+        if data_end >= end:
+            return
+        rssi = pkt[data_end]
+        yield ts, _ba2str(pkt[i + 2:i + 8]), pkt[i], pkt[i + 1], pkt[i + 9:data_end], \
+            rssi - 256 if rssi > 127 else rssi
+        i = data_end + 1
+
+
+def _iter_pcap(f, magic_bytes):
+    endian = '<' if struct.unpack('<I', magic_bytes)[0] in (PCAP_MAGIC, PCAP_MAGIC_NS) else '>'
+    header = struct.unpack(endian + 'HHiIII', f.read(20))
+    divisor = 1e9 if struct.unpack(endian + 'I', magic_bytes)[0] == PCAP_MAGIC_NS else 1e6
+    if header[5] != LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR:
+        raise ValueError('unsupported pcap link type %d' % header[5])
+    record = struct.Struct(endian + 'IIII')
+    while True:
+        raw = f.read(record.size)
+        if len(raw) < record.size:
+            return
+        sec, frac, incl_len, _ = record.unpack(raw)
+        frame = f.read(incl_len)
+        if len(frame) < incl_len:
+            return
+        if incl_len < _PHDR.size + _LL_HEADER.size + 6:
+            continue
+        rssi = struct.unpack_from('b', frame, 1)[0]
+        _, header, length = _LL_HEADER.unpack_from(frame, _PHDR.size)
+        pdu_type = header & 0x0F
+        if pdu_type not in _PDU_TO_EVT:
+            continue
+        start = _PHDR.size + _LL_HEADER.size
+        payload = frame[start:start + length]
+        data = b'' if pdu_type == PDU_ADV_DIRECT_IND else payload[6:]
+        yield sec + frac / divisor, _ba2str(payload[:6]), _PDU_TO_EVT[pdu_type], \
+            (header >> 6) & 1, data, rssi
+
+
+def _iter_btsnoop(f):
+    _, version, datalink = _BTSNOOP_HEADER.unpack(BTSNOOP_MAGIC + f.read(8))
+    if datalink not in (BTSNOOP_H4, BTSNOOP_MONITOR):
+        raise ValueError('unsupported btsnoop datalink %d' % datalink)
+    while True:
+        raw = f.read(_BTSNOOP_RECORD.size)
+        if len(raw) < _BTSNOOP_RECORD.size:
+            return
+        _, incl_len, flags, _, ts = _BTSNOOP_RECORD.unpack(raw)
+        pkt = f.read(incl_len)
+        if len(pkt) < incl_len:
+            return
+        ts = (ts - BTSNOOP_EPOCH_DELTA_US) / 1e6
+        if datalink == BTSNOOP_H4:
+            if not pkt or pkt[0] != 0x04:
+                continue
+            pkt = pkt[1:]
+        elif flags >> 16 != MONITOR_EVENT_PKT:
+            continue
+        for report in _iter_hci_event(pkt, ts):
+            yield report
+
+
+def iter_capture(path):
+    """
+    Iterate over the advertising reports of a pcap or btsnoop capture.
+
+    :returns: a generator of ``(timestamp, mac, adv_type, addr_type, data, rssi)``
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+        if magic == BTSNOOP_MAGIC:
+            for report in _iter_btsnoop(f):
+                yield report
+        else:
+            f.seek(4)
+            for report in _iter_pcap(f, magic[:4]):
+                yield report
+
+
+def replay(path, handler, realtime=False, speed=1.0, repeat=1, stop_event=None):
+    """
+    Feed a capture to a ``parse_le_advertising_events`` style handler.
+
+    :param path: pcap or btsnoop file.
+    :param handler: ``handler(mac, adv_type, data, rssi)``
+    :param realtime: Reproduce the original inter-arrival times, otherwise
+        run as fast as possible.
+    :param speed: Time scale factor in real time mode (2.0 = twice as fast).
+    :param repeat: How many times to play the file.
+    :param stop_event: Optional ``threading.Event`` to interrupt the replay.
+    :returns: number of reports delivered.
+    """
+    count = 0
+    for _ in range(repeat):
+        started = None
+        first_ts = None
+        for ts, mac, adv_type, _, data, rssi in iter_capture(path):
+            if stop_event is not None and stop_event.is_set():
+                return count
+            if realtime:
+                if started is None:
+                    started, first_ts = time.monotonic(), ts
+                delay = started + (ts - first_ts) / speed - time.monotonic()
+                if delay > 0:
+                    if stop_event is not None:
+                        if stop_event.wait(delay):
+                            return count
+                    else:
+                        time.sleep(delay)
+            try:
+                handler(mac, adv_type, data, rssi)
+            except Exception as e:
+                print('Exception when calling handler with a BLE advertising event: %r' % (e,))
+            count += 1
+    return count
+
+
+def benchmark(path, handler, repeat=1):
+    """
+    Replay a capture as fast as possible through ``handler``.
+
+    The capture is loaded in memory first so file parsing is not measured.
+
+    :returns: ``dict`` with the number of reports and reports per second.
+    """
+    reports = [(mac, adv_type, data, rssi) for _, mac, adv_type, _, data, rssi in iter_capture(path)]
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for report in reports:
+            handler(*report)
+    elapsed = time.perf_counter() - started
+    total = len(reports) * repeat
+    return {'reports': total, 'seconds': elapsed,
+            'reports_per_sec': total / elapsed if elapsed else 0.0}
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ('dump', 'bench'):
+        print('usage: python3 adv_capture.py dump|bench <capture.pcap|btsnoop.log> [repeat]')
+        sys.exit(1)
+    if sys.argv[1] == 'dump':
+        for ts, mac, adv_type, addr_type, data, rssi in iter_capture(sys.argv[2]):
+            print('%.6f %s type=%02x addr_type=%d rssi=%d %s' % (ts, mac, adv_type, addr_type, rssi, data.hex()))
+    else:
+        result = benchmark(sys.argv[2], lambda *report: None,
+                           int(sys.argv[3]) if len(sys.argv) > 3 else 10)
+        print('%(reports)d reports in %(seconds).3f s: %(reports_per_sec).0f reports/sec' % result)
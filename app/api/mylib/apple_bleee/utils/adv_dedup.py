@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Ingest-side deduplication of LE advertisements.
+
+With duplicate filtering disabled in the controller (needed to see state
+changes and RSSI updates), a device advertising at 20-50 Hz delivers the
+same payload over and over. :class:`AdvDedup` remembers the last payload
+seen for each address so that the caller only has to run its (expensive)
+decoding when the payload actually changed; repeats only refresh the
+last-seen time, RSSI and counters.
+"""
+
+import time
+
+__all__ = ('AdvDedup',)
+
+
+class _Entry(object):
+    __slots__ = ('payload', 'rssi', 'last_seen', 'count')
+
+    def __init__(self, payload, rssi, now):
+        self.payload = payload
+        self.rssi = rssi
+        self.last_seen = now
+        self.count = 1
+
+
+class AdvDedup(object):
+    """
+    Track the last advertisement payload of every address.
+
+    :param max_entries: Upper bound of tracked addresses. When reached,
+        the least recently changed address is forgotten (random/private
+        addresses rotate, so the table would otherwise grow forever).
+    :type max_entries: ``int``
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, mac):
+        return mac in self._entries
+
+    def seen(self, mac, data, rssi=None):
+        """
+        Record an advertisement.
+
+        :param mac: Address of the advertiser.
+        :param data: Raw advertisement payload (``bytes``).
+        :param rssi: RSSI of this report.
+        :returns: ``True`` if the payload is identical to the previous one
+            from this address (decoding can be skipped), ``False`` if it is
+            new or changed.
+        """
+        now = time.time()
+        entry = self._entries.get(mac)
+        if entry is not None and entry.payload == data:
+            entry.rssi = rssi
+            entry.last_seen = now
+            entry.count += 1
+            self.hits += 1
+            return True
+
+        if entry is None:
+            if len(self._entries) >= self.max_entries:
+                # dicts keep insertion order: drop the oldest one
+                del self._entries[next(iter(self._entries))]
+            self._entries[mac] = _Entry(bytes(data), rssi, now)
+        else:
+            # re-insert so that insertion order follows the last change
+            del self._entries[mac]
+            entry.payload = bytes(data)
+            entry.rssi = rssi
+            entry.last_seen = now
+            entry.count += 1
+            self._entries[mac] = entry
+        self.misses += 1
+        return False
+
+    def get(self, mac):
+        """
+        :returns: ``(rssi, last_seen, count)`` of the address or ``None``.
+        """
+        entry = self._entries.get(mac)
+        if entry is None:
+            return None
+        return entry.rssi, entry.last_seen, entry.count
+
+    def forget(self, mac):
+        """Forget an address so that its next advertisement is decoded again."""
+        self._entries.pop(mac, None)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'tracked': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / total if total else 0.0,
+        }
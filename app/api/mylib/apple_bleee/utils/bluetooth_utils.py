@@ -10,7 +10,12 @@ Main functions:
   - set_scan : set scan type on a device ("noscan", "iscan", "pscan", "piscan")
   - enable/disable_le_scan : enable BLE scanning
   - parse_le_advertising_events : parse and read BLE advertisements packets
+  - iter_le_advertising_reports : decode every report of one HCI event
   - start/stop_le_advertising : advertise custom data using BLE
+  - *_ext_advertising* : LE extended advertising sets (Bluetooth 5.0)
+
+LE commands wait for their Command Complete event and raise
+:class:`HCICommandError` when the controller refuses them.
 
 Bluez : http://www.bluez.org/
 PyBluez : http://karulis.github.io/pybluez/
@@ -34,7 +39,12 @@ import bluetooth._bluetooth as bluez
 __all__ = ('toggle_device', 'set_scan',
            'enable_le_scan', 'disable_le_scan', 'parse_le_advertising_events',
            'start_le_advertising', 'stop_le_advertising',
-           'raw_packet_to_str')
+           'set_le_advertising_data', 'set_le_random_address',
+           'read_le_local_features', 'read_le_num_adv_sets',
+           'set_ext_advertising_parameters', 'set_ext_advertising_data',
+           'set_ext_advertising_enable', 'clear_ext_advertising_sets',
+           'iter_le_advertising_reports',
+           'HCICommandError', 'raw_packet_to_str')
 
 LE_META_EVENT = 0x3E
 LE_PUBLIC_ADDRESS = 0x00
@@ -44,9 +54,33 @@ OGF_LE_CTL = 0x08
 OCF_LE_SET_SCAN_PARAMETERS = 0x000B
 OCF_LE_SET_SCAN_ENABLE = 0x000C
 OCF_LE_CREATE_CONN = 0x000D
+OCF_LE_READ_LOCAL_SUPPORTED_FEATURES = 0x0003
+OCF_LE_SET_RANDOM_ADDRESS = 0x0005
 OCF_LE_SET_ADVERTISING_PARAMETERS = 0x0006
 OCF_LE_SET_ADVERTISE_ENABLE = 0x000A
 OCF_LE_SET_ADVERTISING_DATA = 0x0008
+OCF_LE_SET_EXT_ADVERTISING_PARAMETERS = 0x0036
+OCF_LE_SET_EXT_ADVERTISING_DATA = 0x0037
+OCF_LE_SET_EXT_ADVERTISE_ENABLE = 0x0039
+OCF_LE_READ_NUM_SUPPORTED_ADV_SETS = 0x003B
+OCF_LE_CLEAR_ADVERTISING_SETS = 0x003D
+
+EVT_CMD_COMPLETE = 0x0E
+
+# Command Complete status codes
+STATUS_SUCCESS = 0x00
+STATUS_COMMAND_DISALLOWED = 0x0C
+
+# Extended advertising event properties
+EXT_ADV_PROP_CONNECTABLE = 0x0001
+EXT_ADV_PROP_SCANNABLE = 0x0002
+EXT_ADV_PROP_LEGACY = 0x0010
+# Legacy ADV_NONCONN_IND PDUs sent through an advertising set, so that
+# receivers which only understand legacy advertising still see them
+EXT_ADV_LEGACY_NONCONN = EXT_ADV_PROP_LEGACY
+
+# LE supported features bits
+LE_FEATURE_EXTENDED_ADVERTISING = 1 << 12
 
 SCAN_TYPE_PASSIVE = 0x00
 SCAN_FILTER_DUPLICATES = 0x01
@@ -76,6 +110,37 @@ FILTER_POLICY_CONN_WHITELIST = 0x02
 FILTER_POLICY_SCAN_AND_CONN_WHITELIST = 0x03
 
 
+class HCICommandError(IOError):
+    """
+    An HCI command completed with a non-zero status, e.g.
+    ``STATUS_COMMAND_DISALLOWED`` for a legacy advertising or scan command
+    sent after extended advertising was used (until the controller is
+    reset).
+    """
+
+    def __init__(self, ocf, status):
+        super(HCICommandError, self).__init__(
+            "LE command 0x%04x failed with status 0x%02x" % (ocf, status))
+        self.ocf = ocf
+        self.status = status
+
+
+def _le_command(sock, ocf, cmd_pkt, timeout=1000):
+    """
+    Send an LE controller command and wait for its Command Complete event.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param timeout: Command timeout in milliseconds.
+    :raises HCICommandError: when the controller refuses the command.
+    """
+    resp = bluez.hci_send_req(sock, OGF_LE_CTL, ocf, EVT_CMD_COMPLETE, 1,
+                              cmd_pkt, timeout)
+    status = struct.unpack("<B", resp[:1])[0]
+    if status != STATUS_SUCCESS:
+        raise HCICommandError(ocf, status)
+
+
 def toggle_device(dev_id, enable):
     """
     Power ON or OFF a bluetooth device.
@@ -180,9 +245,11 @@ def enable_le_scan(sock, interval=0x0800, window=0x0800,
     """
     # print("Enable LE scan")
     own_bdaddr_type = LE_PUBLIC_ADDRESS  # does not work with LE_RANDOM_ADDRESS
+    # parameters are refused while scanning is enabled
+    disable_le_scan(sock)
     cmd_pkt = struct.pack("<BHHBB", SCAN_TYPE_PASSIVE, interval, window,
                           own_bdaddr_type, filter_policy)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_PARAMETERS, cmd_pkt)
+    _le_command(sock, OCF_LE_SET_SCAN_PARAMETERS, cmd_pkt)
     # print("scan params: interval=%.3fms window=%.3fms own_bdaddr=%s "
     #       "whitelist=%s" %
     #       (interval * 0.625, window * 0.625,
@@ -191,7 +258,7 @@ def enable_le_scan(sock, interval=0x0800, window=0x0800,
     #                                   FILTER_POLICY_SCAN_AND_CONN_WHITELIST)
     #        else 'no'))
     cmd_pkt = struct.pack("<BB", SCAN_ENABLE, SCAN_FILTER_DUPLICATES if filter_duplicates else 0x00)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
+    _le_command(sock, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
 
 
 def disable_le_scan(sock):
@@ -203,11 +270,12 @@ def disable_le_scan(sock):
     """
     # print("Disable LE scan")
     cmd_pkt = struct.pack("<BB", SCAN_DISABLE, 0x00)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
+    _le_command(sock, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
 
 
 def start_le_advertising(sock, min_interval=1000, max_interval=1000,
-                         adv_type=ADV_NONCONN_IND, data=()):
+                         adv_type=ADV_NONCONN_IND, data=(),
+                         own_bdaddr_type=LE_PUBLIC_ADDRESS):
     """
     Start LE advertising.
 
@@ -218,8 +286,9 @@ def start_le_advertising(sock, min_interval=1000, max_interval=1000,
     :param adv_type: Advertisement type (``ADV_NONCONN_IND`` by default).
     :param data: The advertisement data (maximum of 31 bytes).
     :type data: iterable
+    :param own_bdaddr_type: ``LE_RANDOM_ADDRESS`` to advertise from the
+        address set with :func:`set_le_random_address`.
     """
-    own_bdaddr_type = 0
     direct_bdaddr_type = 0
     direct_bdaddr = (0,) * 6
     chan_map = 0x07  # All channels: 37, 38, 39
@@ -230,20 +299,49 @@ def start_le_advertising(sock, min_interval=1000, max_interval=1000,
     struct_params.extend(direct_bdaddr)
     struct_params.extend((chan_map, filter))
 
+    # parameters are refused while advertising is enabled
+    stop_le_advertising(sock)
     cmd_pkt = struct.pack("<HHBBB6BBB", *struct_params)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_ADVERTISING_PARAMETERS,
-                       cmd_pkt)
+    _le_command(sock, OCF_LE_SET_ADVERTISING_PARAMETERS, cmd_pkt)
 
     cmd_pkt = struct.pack("<B", 0x01)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_ADVERTISE_ENABLE, cmd_pkt)
+    _le_command(sock, OCF_LE_SET_ADVERTISE_ENABLE, cmd_pkt)
+
+    set_le_advertising_data(sock, data)
+    # print("Advertising started data_length=%d data=%r" % (data_length, data))
+
+
+def set_le_advertising_data(sock, data):
+    """
+    Replace the LE advertisement data without touching the advertising
+    parameters or the enable state.
 
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param data: The advertisement data (maximum of 31 bytes).
+    :type data: iterable
+    """
     data_length = len(data)
     if data_length > 31:
-        raise ValueError("data is too long (%d but max is 31 bytes)",
+        raise ValueError("data is too long (%d but max is 31 bytes)" %
                          data_length)
     cmd_pkt = struct.pack("<B%dB" % data_length, data_length, *data)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_ADVERTISING_DATA, cmd_pkt)
-    # print("Advertising started data_length=%d data=%r" % (data_length, data))
+    _le_command(sock, OCF_LE_SET_ADVERTISING_DATA, cmd_pkt)
+
+
+def set_le_random_address(sock, address):
+    """
+    Set the LE random device address. The controller refuses it while
+    advertising is enabled.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param address: 6 bytes, most significant first (as printed).
+    """
+    if len(address) != 6:
+        raise ValueError("address must be 6 bytes")
+    cmd_pkt = bytes(reversed(bytes(address)))
+    _le_command(sock, OCF_LE_SET_RANDOM_ADDRESS, cmd_pkt)
 
 
 def stop_le_advertising(sock):
@@ -254,12 +352,177 @@ def stop_le_advertising(sock):
         ``hci_open_dev`` PyBluez function).
     """
     cmd_pkt = struct.pack("<B", 0x00)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_ADVERTISE_ENABLE, cmd_pkt)
+    _le_command(sock, OCF_LE_SET_ADVERTISE_ENABLE, cmd_pkt)
     # print("Advertising stopped")
 
 
+def read_le_local_features(sock, timeout=1000):
+    """
+    Read the LE features supported by the controller. Unlike
+    :func:`read_le_num_adv_sets`, this does not commit the controller to
+    the extended advertising commands.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param timeout: Command timeout in milliseconds.
+    :returns: The feature bits (e.g. ``LE_FEATURE_EXTENDED_ADVERTISING``),
+        or 0 when they cannot be read.
+    """
+    try:
+        resp = bluez.hci_send_req(sock, OGF_LE_CTL,
+                                  OCF_LE_READ_LOCAL_SUPPORTED_FEATURES,
+                                  EVT_CMD_COMPLETE, 9, b"", timeout)
+    except bluez.error:
+        return 0
+    status, features = struct.unpack("<BQ", resp[:9])
+    if status != 0:
+        return 0
+    return features
+
+
+def read_le_num_adv_sets(sock, timeout=1000):
+    """
+    Read the number of advertising sets supported by the controller. This
+    is an extended advertising command: the controller refuses the legacy
+    advertising and scan commands after it, until it is reset.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param timeout: Command timeout in milliseconds.
+    :returns: The number of supported advertising sets, or 0 when the
+        controller does not support LE extended advertising.
+    """
+    try:
+        resp = bluez.hci_send_req(sock, OGF_LE_CTL,
+                                  OCF_LE_READ_NUM_SUPPORTED_ADV_SETS,
+                                  EVT_CMD_COMPLETE, 2, b"", timeout)
+    except bluez.error:
+        return 0
+    status, num_sets = struct.unpack("<BB", resp[:2])
+    if status != 0:
+        return 0
+    return num_sets
+
+
+def set_ext_advertising_parameters(sock, handle, min_interval=1000,
+                                   max_interval=1000,
+                                   properties=EXT_ADV_LEGACY_NONCONN,
+                                   own_bdaddr_type=LE_PUBLIC_ADDRESS,
+                                   tx_power=0x7F, sid=0):
+    """
+    Configure an LE extended advertising set.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param handle: Advertising set handle (0 .. number of sets - 1).
+    :param min_interval: Minimum primary advertising interval.
+    :param max_interval: Maximum primary advertising interval.
+    :param properties: Advertising event properties
+        (legacy non-connectable PDUs by default).
+    :param own_bdaddr_type: ``LE_PUBLIC_ADDRESS`` or ``LE_RANDOM_ADDRESS``.
+    :param tx_power: Requested TX power in dBm (0x7F: no preference).
+    :param sid: Advertising SID.
+
+    .. note:: Intervals are 24 bits wide and are to multiply by 0.625 ms.
+    """
+    chan_map = 0x07  # All channels: 37, 38, 39
+    cmd_pkt = struct.pack("<BH", handle, properties)
+    cmd_pkt += struct.pack("<I", min_interval)[:3]
+    cmd_pkt += struct.pack("<I", max_interval)[:3]
+    cmd_pkt += struct.pack("<BBB6sBbBBBBB", chan_map, own_bdaddr_type, 0,
+                           b"\x00" * 6, FILTER_POLICY_NO_WHITELIST,
+                           tx_power if tx_power < 0x80 else tx_power - 0x100,
+                           0x01, 0x00, 0x01, sid, 0x00)
+    _le_command(sock, OCF_LE_SET_EXT_ADVERTISING_PARAMETERS, cmd_pkt)
+
+
+def set_ext_advertising_data(sock, handle, data):
+    """
+    Set the advertisement data of an LE extended advertising set.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param handle: Advertising set handle.
+    :param data: The advertisement data (maximum of 31 bytes for sets
+        using legacy PDUs).
+    :type data: iterable
+    """
+    data_length = len(data)
+    if data_length > 251:
+        raise ValueError("data is too long (%d but max is 251 bytes)" %
+                         data_length)
+    # operation 0x03: complete data, fragment preference 0x01: no fragmenting
+    cmd_pkt = struct.pack("<BBBB%dB" % data_length, handle, 0x03, 0x01,
+                          data_length, *data)
+    _le_command(sock, OCF_LE_SET_EXT_ADVERTISING_DATA, cmd_pkt)
+
+
+def set_ext_advertising_enable(sock, enable, handles):
+    """
+    Enable or disable LE extended advertising sets.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    :param enable: Whether to enable or disable the given sets.
+    :param handles: Advertising set handles. An empty list together with
+        ``enable=False`` disables every set.
+    """
+    cmd_pkt = struct.pack("<BB", 0x01 if enable else 0x00, len(handles))
+    for handle in handles:
+        # no duration limit, no maximum number of events
+        cmd_pkt += struct.pack("<BHB", handle, 0, 0)
+    _le_command(sock, OCF_LE_SET_EXT_ADVERTISE_ENABLE, cmd_pkt)
+
+
+def clear_ext_advertising_sets(sock):
+    """
+    Remove every LE extended advertising set from the controller.
+
+    :param sock: A bluetooth HCI socket (retrieved using the
+        ``hci_open_dev`` PyBluez function).
+    """
+    _le_command(sock, OCF_LE_CLEAR_ADVERTISING_SETS, b"")
+
+
+def iter_le_advertising_reports(pkt):
+    """
+    Decode every LE advertising report carried by one HCI event packet.
+
+    A single ``EVT_LE_ADVERTISING_REPORT`` event may hold several reports
+    (``num_reports`` > 1); each one is laid out as event_type, address_type,
+    address (6), data_length, data, rssi.
+
+    :param pkt: Raw HCI event packet as read from the socket (starting with
+        the packet type byte).
+    :type pkt: ``bytes``
+    :returns: a generator of ``(mac, adv_type, data, rssi)`` tuples, the same
+        values the ``parse_le_advertising_events`` handler receives. Packets
+        that are not advertising reports yield nothing; a truncated report
+        stops the iteration.
+    """
+    if len(pkt) < 5 or pkt[1] != LE_META_EVENT or pkt[3] != EVT_LE_ADVERTISING_REPORT:
+        return
+    num_reports = pkt[4]
+    end = len(pkt)
+    i = 5
+    for _ in range(num_reports):
+        if i + 9 > end:
+            return
+        adv_type = pkt[i]
+        mac = bluez.ba2str(pkt[i + 2:i + 8])
+        data_length = pkt[i + 8]
+        data_end = i + 9 + data_length
+        if data_end >= end:
+            return
+        rssi = pkt[data_end]
+        if rssi > 127:
+            rssi -= 256
+        yield mac, adv_type, pkt[i + 9:data_end], rssi
+        i = data_end + 1
+
+
 def parse_le_advertising_events(sock, mac_addr=None, packet_length=None,
-                                handler=None, debug=False):
+                                handler=None, debug=False, stop_event=None):
     """
     Parse and report LE advertisements.
 
@@ -286,6 +549,10 @@ def parse_le_advertising_events(sock, mac_addr=None, packet_length=None,
         mac (``str``), adv_type (``int``), data (``bytes``) and rssi (``int``)
     :param debug: Enable debug prints.
     :type debug: ``bool``
+    :param stop_event: When given, the loop returns (restoring the previous
+        socket filter) once the event is set. The socket should have a
+        timeout so that ``recv`` wakes up to check it.
+    :type stop_event: ``threading.Event``
     """
     if not debug and handler is None:
         raise ValueError("You must either enable debug or give a handler !")
@@ -302,57 +569,53 @@ def parse_le_advertising_events(sock, mac_addr=None, packet_length=None,
     # print("Listening ...")
 
     try:
-        while True:
-            pkt = sock.recv(255)
-            ptype, event, plen = struct.unpack("BBB", pkt[:3])
-
-            if event != LE_META_EVENT:
-                # Should never occur because we filtered with this type of event
-                print("Not a LE_META_EVENT !")
+        while stop_event is None or not stop_event.is_set():
+            try:
+                pkt = sock.recv(255)
+            except bluez.timeout:
                 continue
 
-            sub_event, = struct.unpack("B", pkt[3:4])
-            if sub_event != EVT_LE_ADVERTISING_REPORT:
-                if debug:
+            if debug:
+                ptype, event = struct.unpack("BB", pkt[:2])
+                if event != LE_META_EVENT:
+                    # Should never occur because we filtered with this type of event
+                    print("Not a LE_META_EVENT !")
+                elif pkt[3] != EVT_LE_ADVERTISING_REPORT:
                     print("Not a EVT_LE_ADVERTISING_REPORT !")
-                continue
 
-            pkt = pkt[4:]
-            adv_type = struct.unpack("b", pkt[1:2])[0]
-            mac_addr_str = bluez.ba2str(pkt[3:9])
+            plen = pkt[2]
+            for mac_addr_str, adv_type, data, rssi in iter_le_advertising_reports(pkt):
+                if packet_length and plen != packet_length:
+                    # ignore this packet
+                    if debug:
+                        print("packet with non-matching length: mac=%s adv_type=%02x plen=%s" %
+                              (mac_addr_str, adv_type, plen))
+                        print(raw_packet_to_str(pkt))
+                    continue
+
+                if mac_addr and mac_addr_str not in mac_addr:
+                    if debug:
+                        print("packet with non-matching mac %s adv_type=%02x data=%s RSSI=%s" %
+                              (mac_addr_str, adv_type, raw_packet_to_str(data), rssi))
+                    continue
 
-            if packet_length and plen != packet_length:
-                # ignore this packet
                 if debug:
-                    print("packet with non-matching length: mac=%s adv_type=%02x plen=%s" %
-                          (mac_addr_str, adv_type, plen))
-                    print(raw_packet_to_str(pkt))
-                continue
-
-            data = pkt[9:-1]
-            rssi = struct.unpack("b", pkt[-2:-1])[0]
-
-            if mac_addr and mac_addr_str not in mac_addr:
-                if debug:
-                    print("packet with non-matching mac %s adv_type=%02x data=%s RSSI=%s" %
+                    print("LE advertisement: mac=%s adv_type=%02x data=%s RSSI=%d" %
                           (mac_addr_str, adv_type, raw_packet_to_str(data), rssi))
-                continue
 
-            if debug:
-                print("LE advertisement: mac=%s adv_type=%02x data=%s RSSI=%d" %
-                      (mac_addr_str, adv_type, raw_packet_to_str(data), rssi))
-
-            if handler is not None:
-                try:
-                    handler(mac_addr_str, adv_type, data, rssi)
-                except Exception as e:
-                    print('Exception when calling handler with a BLE advertising event: %r' % (e,))
+                if handler is not None:
+                    try:
+                        handler(mac_addr_str, adv_type, data, rssi)
+                    except Exception as e:
+                        print('Exception when calling handler with a BLE advertising event: %r' % (e,))
 
     except KeyboardInterrupt:
         print("\nRestore previous socket filter")
         sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, old_filter)
         raise
 
+    sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, old_filter)
+
 """
 def hci_le_add_white_list(int dd, const bdaddr_t *bdaddr, uint8_t type, int to)
 {
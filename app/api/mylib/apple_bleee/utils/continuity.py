@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Byte level decoder for Apple Continuity advertisements.
+
+Apple devices advertise manufacturer specific data (company id 0x004C)
+made of type/length/value messages (Nearby, Handoff, AirPods, ...).
+:func:`decode_continuity` walks the AD structures and the TLV messages
+directly on the raw bytes and dispatches each message type through
+:data:`MESSAGES`, a table of precompiled ``struct`` layouts, returning one
+typed record (a ``namedtuple``) per message. Numeric fields are ``int``,
+opaque fields (hashes, auth tags, encrypted payloads, ids) are hex strings.
+
+Run ``python3 continuity.py`` for a microbenchmark against the hex string
+parsing previously used by ble_read_state.
+"""
+
+import struct
+from collections import namedtuple
+
+__all__ = ('decode_continuity', 'MESSAGES',
+           'AIRPRINT', 'AIRDROP', 'HOMEKIT', 'AIRPODS', 'SIRI', 'AIRPLAY',
+           'NEARBY', 'WATCH_C', 'HANDOFF', 'WIFI_SET', 'HOTSPOT', 'WIFI_JOIN')
+
+AD_TYPE_MANUFACTURER_DATA = 0xFF
+APPLE_COMPANY_ID = b'\x4c\x00'
+
+# Continuity message types
+AIRPRINT = 0x03
+AIRDROP = 0x05
+HOMEKIT = 0x06
+AIRPODS = 0x07
+SIRI = 0x08
+AIRPLAY = 0x09
+NEARBY = 0x10
+WATCH_C = 0x0b
+HANDOFF = 0x0c
+WIFI_SET = 0x0d
+HOTSPOT = 0x0e
+WIFI_JOIN = 0x0f
+
+_TLV = struct.Struct('BB')
+
+
+class _Message(object):
+    """Layout of one message type: struct format plus field names."""
+    __slots__ = ('name', 'struct', 'record', 'sizes', 'hex_fields', 'tail')
+
+    def __init__(self, name, fmt, fields, tail=None):
+        self.name = name
+        self.struct = struct.Struct('>' + fmt)
+        names = [f for f, _ in fields] + ([tail] if tail else [])
+        self.record = namedtuple(name.title().replace('_', ''), names)
+        self.record.kind = name
+        self.sizes = [struct.calcsize('>' + code) for _, code in fields] + ([None] if tail else [])
+        # 's' fields are opaque and exposed as hex strings
+        self.hex_fields = tuple(i for i, (_, code) in enumerate(fields) if code.endswith('s'))
+        self.tail = tail
+
+    def parse(self, buf, start, end):
+        st = self.struct
+        if end - start < st.size:
+            return None
+        values = st.unpack_from(buf, start)
+        if self.hex_fields or self.tail:
+            values = list(values)
+            for i in self.hex_fields:
+                values[i] = values[i].hex()
+            if self.tail:
+                values.append(bytes(buf[start + st.size:end]).hex())
+        return self.record._make(values)
+
+
+def _message(name, fields, tail=None):
+    return _Message(name, ''.join(code for _, code in fields), fields, tail)
+
+
+# message type -> layout (offsets and sizes from the hexway research notes
+# kept next to each parser in ble_read_state.py)
+MESSAGES = {
+    AIRPRINT: _message('airprint', [('addrType', 'B'), ('resPathType', 'B'), ('secType', 'B'),
+                                    ('port', 'H'), ('IP', '16s'), ('power', 'b')]),
+    AIRDROP: _message('airdrop', [('zeros', '8s'), ('st', 'B'), ('appleID_hash', '2s'),
+                                  ('phone_hash', '2s'), ('email_hash', '2s'),
+                                  ('email2_hash', '2s'), ('zero', 'B')]),
+    HOMEKIT: _message('homekit', [('statusFlag', 'B'), ('devID', '6s'), ('category', 'H'),
+                                  ('globalStateNumber', 'H'), ('configurationNumber', 'B'),
+                                  ('compatibleVersion', 'B')]),
+    AIRPODS: _message('airpods', [('fix1', 'B'), ('model', 'H'), ('utp', 'B'), ('battery1', 'B'),
+                                  ('battery2', 'B'), ('lid_counter', 'B'), ('color', 'B'),
+                                  ('fix2', 'B'), ('encr_data', '16s')]),
+    SIRI: _message('siri', [('hash', '2s'), ('SNR', 'B'), ('confidence', 'B'),
+                            ('devClass', 'H'), ('random', 'B')]),
+    AIRPLAY: _message('airplay', [('flags', 'B'), ('configSeeds', 'B'), ('ipV4', '4s')]),
+    NEARBY: _message('nearby', [('status', 'B'), ('wifi', 'B')], tail='authTag'),
+    WATCH_C: _message('watch_c', [('data', '2s'), ('wrist', 'B')]),
+    HANDOFF: _message('handoff', [('clipboard', 'B'), ('s_nbr', 'H'), ('authTag', 'B'),
+                                  ('encryptedData', '10s')]),
+    WIFI_SET: _message('wifi_set', [('icloudID', '4s')]),
+    HOTSPOT: _message('hotspot', [('version', 'B'), ('flags', 'B'), ('battery', 'H'),
+                                  ('cell_srv', 'B'), ('cell_bars', 'B')]),
+    WIFI_JOIN: _message('wifi_join', [('flags', 'B'), ('type', 'B'), ('tag', '3s'),
+                                      ('appleID_hash', '3s'), ('phone_hash', '3s'),
+                                      ('email_hash', '3s'), ('ssid_hash', '3s')]),
+}
+
+
+def decode_continuity(data):
+    """
+    Decode the Apple Continuity messages of an advertisement.
+
+    :param data: Raw advertising data (``bytes``), as given to the
+        ``parse_le_advertising_events`` handler.
+    :returns: ``(header, records)`` where ``header`` is the raw data before
+        the Apple manufacturer data (flags etc.) and ``records`` maps each
+        known message type to its record, or ``None`` when the advertisement
+        carries no Apple manufacturer data. Unknown or truncated messages
+        are skipped.
+    """
+    end = len(data)
+    i = 0
+    while i + 1 < end:
+        length = data[i]
+        if length == 0:
+            return None
+        stop = i + 1 + length
+        if stop > end:
+            return None
+        if data[i + 1] == AD_TYPE_MANUFACTURER_DATA and data[i + 2:i + 4] == APPLE_COMPANY_ID:
+            break
+        i = stop
+    else:
+        return None
+
+    header = data[:i]
+    records = {}
+    j = i + 4
+    while j + 2 <= stop:
+        msg_type, msg_len = _TLV.unpack_from(data, j)
+        j += 2
+        msg_end = min(j + msg_len, stop)
+        message = MESSAGES.get(msg_type)
+        if message is not None:
+            record = message.parse(data, j, msg_end)
+            if record is not None:
+                records[msg_type] = record
+        j = msg_end
+    return header, records
+
+
+def _legacy_decode(data):
+    """Hex string decoding formerly done by ble_read_state (benchmark reference only)."""
+    data_str = ''.join('%02x' % struct.unpack("B", bytes([x]))[0] for x in data)
+    if 'ff4c00' not in data_str:
+        return None
+    header = data_str[:data_str.find('ff4c00')]
+    body = data_str[data_str.find('ff4c00') + 6:]
+    packet = {}
+    i = 0
+    while i < len(body):
+        tag = body[i:i + 2]
+        val_len = int(body[i + 2:i + 4], 16)
+        packet[tag] = body[i + 4:i + 4 + val_len * 2]
+        i = i + 4 + val_len * 2
+    result = {}
+    for tag, value in packet.items():
+        message = MESSAGES.get(int(tag, 16))
+        if message is None:
+            continue
+        fields = {}
+        pos = 0
+        for name, size in zip(message.record._fields, message.sizes):
+            fields[name] = value[pos:] if size is None else value[pos:pos + size * 2]
+            pos += 0 if size is None else size * 2
+        result[tag] = fields
+    return header, result
+
+
+def benchmark(iterations=100000):
+    """
+    Compare packets/sec of :func:`decode_continuity` with the former hex
+    string decoding on typical advertisements.
+    """
+    import time
+
+    samples = [
+        # Nearby info (iPhone)
+        bytes.fromhex('02011a0aff4c0010050b1c2c6f1a'),
+        # Nearby + Handoff
+        bytes.fromhex('02011a1aff4c000c0e00c1d8d7a8ec3d15bf4a3bdd6d1d10050b1c2c6f1a'),
+        # AirPods
+        bytes.fromhex('1eff4c0007190102202b990f01000000b0d1a8a9fb0b5b6a4b9bbf30e4c7e5'),
+        # WiFi join request
+        bytes.fromhex('02011a16ff4c000f1108080a0b0c1a2b3c4d5e6f7a8b9cadbecf'),
+        # not an Apple advertisement
+        bytes.fromhex('0201061aff590002150112233445566778899aabbccddeeff0000100'),
+    ]
+    result = {}
+    for name, func in (('hex string', _legacy_decode), ('struct', decode_continuity)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for sample in samples:
+                func(sample)
+        result[name] = iterations * len(samples) / (time.perf_counter() - started)
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rates = benchmark(count)
+    for name, rate in rates.items():
+        print('%12s: %12.0f packets/sec' % (name, rate))
+    print('%12s: %11.1fx' % ('speedup', rates['struct'] / rates['hex string']))
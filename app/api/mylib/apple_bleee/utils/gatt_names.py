@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Background resolution of device model names over GATT.
+
+Reading the Model Number String characteristic (0x2a24) with one
+``gatttool --char-read`` process per device costs a process start, an HCI
+setup and a blocking wait of up to a few seconds per lookup.
+:class:`GattNameResolver` instead keeps a small pool of interactive
+``gatttool -I`` sessions (one per worker thread) and feeds them from a
+queue, so callers only :meth:`~GattNameResolver.submit` addresses and get
+the result through a callback. Results are cached by address and, when the
+caller knows one, by a Continuity fingerprint so that a device keeps its
+name when its random address rotates. Failed lookups are retried with an
+exponential back-off instead of on every refresh.
+"""
+
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ('GattNameResolver', 'GattError')
+
+MODEL_NUMBER_UUID = '0x2a24'
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*[A-Za-z]|\x1b[()][0-9A-Za-z]|[\x01\x02]')
+_CONNECTED = re.compile(r'Connection successful')
+_VALUE = re.compile(r'value: ((?:[0-9a-fA-F]{2} )*[0-9a-fA-F]{2}) ?\r?\n')
+_ERROR = re.compile(r'Error: ([^\r\n]*)\r?\n')
+
+
+class GattError(Exception):
+    pass
+
+
+class _GattSession(object):
+    """One ``gatttool -I`` process, used by a single worker thread."""
+
+    def __init__(self, gatttool, hci, addr_type):
+        self.cmd = [gatttool, '-i', hci, '-t', addr_type, '-I']
+        self.proc = None
+        self._chunks = queue.Queue()
+        self._buffer = ''
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, bufsize=0)
+        self._chunks = queue.Queue()
+        self._buffer = ''
+        reader = threading.Thread(target=self._read, args=(self.proc.stdout, self._chunks))
+        reader.daemon = True
+        reader.start()
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.send('exit')
+            self.proc.wait(1)
+        except Exception:
+            self.proc.kill()
+        self.proc = None
+
+    @staticmethod
+    def _read(stream, chunks):
+        fd = stream.fileno()
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                data = b''
+            if not data:
+                chunks.put(None)
+                return
+            chunks.put(data)
+
+    def send(self, line):
+        self.proc.stdin.write(line.encode('ascii') + b'\n')
+        self.proc.stdin.flush()
+
+    def expect(self, patterns, timeout):
+        """
+        Wait for output matching one of ``patterns``.
+
+        :returns: ``(index, match)`` of the first pattern that matched.
+        :raises GattError: on timeout or when gatttool exited.
+        """
+        deadline = time.time() + timeout
+        while True:
+            for i, pattern in enumerate(patterns):
+                match = pattern.search(self._buffer)
+                if match:
+                    self._buffer = self._buffer[match.end():]
+                    return i, match
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise GattError('timeout')
+            try:
+                data = self._chunks.get(timeout=remaining)
+            except queue.Empty:
+                raise GattError('timeout')
+            if data is None:
+                raise GattError('gatttool exited')
+            self._buffer += _ANSI.sub('', data.decode('utf-8', 'replace'))
+
+    def read_string(self, mac, uuid, timeout):
+        """
+        Connect to ``mac``, read the characteristic ``uuid`` and disconnect.
+
+        :returns: The value decoded as a string, or ``None`` if the device
+            answered with an error (no such characteristic, refused, ...).
+        :raises GattError: when the session is in an unknown state (timeout).
+        """
+        if not self.alive:
+            self.start()
+        self._buffer = ''
+        self.send('connect %s' % mac)
+        i, match = self.expect((_CONNECTED, _ERROR), timeout)
+        if i == 1:
+            return None
+        try:
+            self.send('char-read-uuid %s' % uuid)
+            i, match = self.expect((_VALUE, _ERROR), timeout)
+        finally:
+            self.send('disconnect')
+        if i == 1:
+            return None
+        value = bytes.fromhex(match.group(1).replace(' ', ''))
+        return value.decode('utf-8', 'replace').strip('\x00 ')
+
+
+class GattNameResolver(object):
+    """
+    Bounded pool of workers reading the model name of LE devices.
+
+    :param on_resolved: ``callback(mac, name)`` called from a worker thread
+        when a lookup succeeds.
+    :param on_idle: Optional ``callback()`` called once the queue is drained
+        after some lookups were done (e.g. to re-enable LE scanning, which
+        connecting may have stopped).
+    :param workers: Number of concurrent lookups (``gatttool`` sessions).
+    :param timeout: Seconds to wait for each step (connect, read).
+    :param retry_base: Back-off after the first failure, doubled on every
+        further failure of the same device up to ``retry_max`` seconds.
+    :param cache_size: Number of addresses / fingerprints kept in the cache,
+        and of failed addresses whose back-off is remembered.
+    """
+
+    def __init__(self, on_resolved=None, on_idle=None, workers=2, timeout=5.0, uuid=MODEL_NUMBER_UUID,
+                 hci='hci0', addr_type='random', gatttool='gatttool', retry_base=30.0, retry_max=600.0,
+                 cache_size=1024):
+        self.on_resolved = on_resolved
+        self.on_idle = on_idle
+        self.workers = workers
+        self.timeout = timeout
+        self.uuid = uuid
+        self.hci = hci
+        self.addr_type = addr_type
+        self.gatttool = gatttool
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._names = OrderedDict()
+        self._fingerprints = OrderedDict()
+        # mac -> (failures, retry time), least recently failed first
+        self._failures = OrderedDict()
+        self._busy = 0
+        self._worked = False
+        self._threads = []
+        self._sessions = []
+        self._running = False
+
+        self.lookups = 0
+        self.resolved = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.lookup_time = 0.0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        for _ in range(self.workers):
+            session = _GattSession(self.gatttool, self.hci, self.addr_type)
+            thread = threading.Thread(target=self._work, args=(session,))
+            thread.daemon = True
+            thread.start()
+            self._sessions.append(session)
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the workers; each one closes its gatttool session after its
+        current lookup. Does not wait for them.
+        """
+        if not self._running:
+            return
+        self._running = False
+        for _ in self._threads:
+            self._queue.put(None)
+        self._threads = []
+        self._sessions = []
+
+    def cached(self, mac, fingerprint=None):
+        """Return the known name of ``mac`` (or of ``fingerprint``), or ``None``."""
+        with self._lock:
+            return self._cached(mac, fingerprint)
+
+    def _cached(self, mac, fingerprint):
+        name = self._names.get(mac)
+        if name is None and fingerprint is not None:
+            name = self._fingerprints.get(fingerprint)
+            if name is not None:
+                # same device under a new address
+                self._remember(self._names, mac, name)
+        if name is not None:
+            self._names.move_to_end(mac)
+        return name
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def submit(self, mac, fingerprint=None, force=False):
+        """
+        Ask for the name of ``mac`` without blocking.
+
+        :param fingerprint: Optional stable identifier of the device (e.g.
+            Continuity hashes) shared between its rotating addresses.
+        :param force: Ignore the back-off of a previous failed lookup.
+        :returns: The cached name if known (no lookup is queued), else
+            ``None``; the lookup result is then given to ``on_resolved``.
+        """
+        with self._lock:
+            name = self._cached(mac, fingerprint)
+            if name is not None:
+                self.cache_hits += 1
+                return name
+            if mac in self._pending:
+                if fingerprint is not None:
+                    self._pending[mac] = fingerprint
+                return None
+            failure = self._failures.get(mac)
+            if failure is not None and not force and time.time() < failure[1]:
+                return None
+            self._pending[mac] = fingerprint
+        if not self._running:
+            self.start()
+        self._queue.put(mac)
+        return None
+
+    def forget(self, mac):
+        with self._lock:
+            self._names.pop(mac, None)
+            self._failures.pop(mac, None)
+
+    def _work(self, session):
+        try:
+            while True:
+                mac = self._queue.get()
+                if mac is None:
+                    return
+                with self._lock:
+                    self._busy += 1
+                try:
+                    self._lookup(session, mac)
+                finally:
+                    with self._lock:
+                        self._busy -= 1
+                        idle = self._busy == 0 and not self._pending and self._worked
+                        if idle:
+                            self._worked = False
+                if idle and self.on_idle is not None:
+                    # a failing callback must not kill the worker
+                    try:
+                        self.on_idle()
+                    except Exception as e:
+                        print('on_idle failed: %r' % (e,))
+        finally:
+            session.close()
+
+    def _lookup(self, session, mac):
+        started = time.time()
+        try:
+            name = session.read_string(mac, self.uuid, self.timeout)
+        except GattError:
+            # unknown session state: start a fresh gatttool next time
+            session.close()
+            name = None
+        except OSError as e:
+            print('gatttool failed: %r' % (e,))
+            session.close()
+            name = None
+        elapsed = time.time() - started
+
+        with self._lock:
+            self.lookups += 1
+            self.lookup_time += elapsed
+            self._worked = True
+            fingerprint = self._pending.pop(mac, None)
+            if name:
+                self.resolved += 1
+                self._failures.pop(mac, None)
+                self._remember(self._names, mac, name)
+                if fingerprint is not None:
+                    self._remember(self._fingerprints, fingerprint, name)
+            else:
+                self.failed += 1
+                count = self._failures.get(mac, (0, 0))[0] + 1
+                delay = min(self.retry_base * 2 ** (count - 1), self.retry_max)
+                # rotating addresses never come back: forget the oldest failures
+                self._remember(self._failures, mac, (count, time.time() + delay))
+        if name and self.on_resolved is not None:
+            try:
+                self.on_resolved(mac, name)
+            except Exception as e:
+                print('on_resolved failed for %s: %r' % (mac, e))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._running,
+                'workers': self.workers,
+                'pending': len(self._pending),
+                'lookups': self.lookups,
+                'resolved': self.resolved,
+                'failed': self.failed,
+                'cache_hits': self.cache_hits,
+                'cached': len(self._names),
+                'backing_off': sum(1 for _, retry in self._failures.values() if retry > time.time()),
+                'avg_lookup_ms': self.lookup_time * 1000.0 / self.lookups if self.lookups else 0.0,
+            }
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Shared owner of one HCI controller (linux only).
+
+Scanning and advertising are controller wide: a feature that opens its own
+socket and disables the scan (or resets the device) when it stops tears
+down every other feature using hci0. :class:`HCIAdapter` is the single
+owner of the controller inside the app:
+
+* advertisers (beacon emulator, beacon rotator, Continuity advertiser)
+  send their commands through :meth:`~HCIAdapter.command_socket` while
+  holding :attr:`~HCIAdapter.lock`;
+* scanners register a report handler with
+  :meth:`~HCIAdapter.add_scan_handler`. The first handler enables a
+  passive scan read by one :class:`.hci_async.AsyncLEReader`, every
+  report is given to every handler, and the scan is only disabled when the
+  last handler is removed.
+
+Passive scanning and non-connectable advertising are allowed at the same
+time by the controller, so both run concurrently; advertising sets keep
+running while scanners come and go.
+
+Once an LE extended advertising command was sent, the controller refuses
+the legacy advertising and scan commands (Command Disallowed) until it is
+reset, and the other way round. Advertisers therefore declare the command
+set they use with :meth:`~HCIAdapter.claim_advertising`: the controller
+is committed to one set at a time, the scan always uses the legacy one,
+and switching sets (a reset) is only done when nobody uses the other set.
+
+The device is never reset on a normal start or stop. A command error only
+drops the command socket (reopened on next use); the controller is taken
+down and up only when it cannot be opened any more, after which the scan
+is re-enabled and the reset listeners re-apply their advertising.
+"""
+
+import asyncio
+import threading
+
+__all__ = ('HCIAdapter', 'get_adapter')
+
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+def get_adapter(dev_id=0):
+    """The process wide :class:`HCIAdapter` of hci<dev_id>."""
+    with _adapters_lock:
+        adapter = _adapters.get(dev_id)
+        if adapter is None:
+            adapter = _adapters[dev_id] = HCIAdapter(dev_id)
+        return adapter
+
+
+def _bluetooth_utils():
+    # needs PyBluez, so only imported once the controller is used
+    from . import bluetooth_utils
+    return bluetooth_utils
+
+
+class HCIAdapter(object):
+    """
+    :param dev_id: Controller id (0 for hci0).
+    :param retry_delay: First delay before restarting a scan whose socket
+        failed, doubled on each further failure up to ``retry_max``.
+    """
+
+    def __init__(self, dev_id=0, retry_delay=1.0, retry_max=30.0):
+        self.dev_id = dev_id
+        self.retry_delay = retry_delay
+        self.retry_max = retry_max
+        # held while sending commands; shared with the advertisers
+        self.lock = threading.RLock()
+        self.loop = None
+        self.reader = None
+        self._cmd_sock = None
+        self._scan_sock = None
+        self._handlers = []
+        self._reset_listeners = []
+        self._retry = None
+        self._failures = 0
+        self._restored = 0
+        # command set used since the last reset: None (none yet), False
+        # (legacy) or True (extended advertising)
+        self.extended = None
+        # advertiser -> command set it uses
+        self._advertisers = {}
+        self._features = 0
+
+        self.opens = 0
+        self.command_errors = 0
+        self.scan_errors = 0
+        self.resets = 0
+        self.last_error = None
+
+    # ---- controller ----------------------------------------------------------
+
+    def _open(self):
+        """Open a socket on the controller; reset it only if it cannot be opened."""
+        import bluetooth._bluetooth as bluez
+        bt = _bluetooth_utils()
+        try:
+            bt.toggle_device(self.dev_id, True)
+            sock = bluez.hci_open_dev(self.dev_id)
+        except Exception as e:
+            self.last_error = repr(e)
+            print('Cannot open hci%d (%r), resetting it' % (self.dev_id, e))
+            self.reset_device()
+            sock = bluez.hci_open_dev(self.dev_id)
+        self.opens += 1
+        return sock
+
+    def reset_device(self):
+        """Take the controller down and up (loses scan and advertising state)."""
+        bt = _bluetooth_utils()
+        with self.lock:
+            self._close_command()
+            try:
+                bt.toggle_device(self.dev_id, False)
+            except OSError:
+                pass
+            bt.toggle_device(self.dev_id, True)
+            self.resets += 1
+            self.extended = None
+
+    def command_socket(self):
+        """Socket for HCI commands; call with :attr:`lock` held."""
+        with self.lock:
+            if self._cmd_sock is None:
+                self._cmd_sock = self._open()
+            if self._restored != self.resets:
+                self._restored = self.resets
+                self._restore()
+            return self._cmd_sock
+
+    def command_failed(self, error=None):
+        """
+        Report a failed command: the command socket is dropped and reopened
+        on next use. The controller itself is left alone.
+        """
+        with self.lock:
+            self.command_errors += 1
+            if error is not None:
+                self.last_error = repr(error)
+            self._close_command()
+
+    def _close_command(self):
+        if self._cmd_sock is not None:
+            try:
+                self._cmd_sock.close()
+            except OSError:
+                pass
+            self._cmd_sock = None
+
+    def claim_advertising(self, owner, extended=False):
+        """
+        ``owner`` is about to advertise with the legacy (or the extended)
+        command set; call with :attr:`lock` held, before its commands.
+
+        :raises RuntimeError: if the other command set is in use (by
+            another advertiser, or by the scan for the extended one).
+        """
+        extended = bool(extended)
+        with self.lock:
+            conflict = self._conflict(owner, extended)
+            if conflict is not None:
+                raise RuntimeError(conflict)
+            self._advertisers[owner] = extended
+            try:
+                self._commit(extended)
+            except Exception:
+                del self._advertisers[owner]
+                raise
+
+    def can_claim(self, owner, extended=False):
+        """Whether :meth:`claim_advertising` would accept ``owner`` now."""
+        with self.lock:
+            return self._conflict(owner, bool(extended)) is None
+
+    def _conflict(self, owner, extended):
+        if extended and self._handlers:
+            return 'hci%d is scanning: extended advertising is not available' % self.dev_id
+        for other, other_extended in self._advertisers.items():
+            if other != owner and other_extended != extended:
+                return 'hci%d is used for %s advertising' % (self.dev_id, 'extended' if other_extended else 'legacy')
+        return None
+
+    def supports_extended_advertising(self):
+        """Whether the controller has LE extended advertising (asked without committing to it)."""
+        bt = _bluetooth_utils()
+        with self.lock:
+            if not self._features:
+                self._features = bt.read_le_local_features(self.command_socket())
+            return bool(self._features & bt.LE_FEATURE_EXTENDED_ADVERTISING)
+
+    def release_advertising(self, owner):
+        """``owner`` stopped advertising."""
+        with self.lock:
+            self._advertisers.pop(owner, None)
+
+    def _commit(self, extended):
+        # the controller refuses the other command set until it is reset
+        if self.extended is not None and self.extended != extended:
+            self.reset_device()
+        self.extended = extended
+
+    def add_reset_listener(self, callback):
+        """``callback(sock)`` re-applies its controller state after a reset."""
+        self._reset_listeners.append(callback)
+
+    def _restore(self):
+        sock = self._cmd_sock
+        if self._advertisers or self._handlers:
+            self.extended = any(self._advertisers.values())
+        if self.reader is not None:
+            # the scan socket did not survive the reset either: reopen it
+            # and re-enable the scan
+            self.loop.call_soon_threadsafe(self._restart_scan)
+        for callback in self._reset_listeners:
+            try:
+                callback(sock)
+            except Exception as e:
+                print('Cannot restore advertising after reset: %r' % (e,))
+
+    # ---- scanning ------------------------------------------------------------
+
+    @property
+    def scanning(self):
+        return self.reader is not None and self.reader.running
+
+    def add_scan_handler(self, handler):
+        """
+        Give every advertising report to ``handler(mac, adv_type, data, rssi)``,
+        enabling the scan if needed. Call from the event loop.
+        """
+        if handler in self._handlers:
+            return
+        self._handlers.append(handler)
+        if self.reader is not None:
+            self.reader.add_handler(handler)
+            return
+        try:
+            self._start_scan(asyncio.get_running_loop())
+        except Exception:
+            self._handlers.remove(handler)
+            raise
+
+    def remove_scan_handler(self, handler):
+        """Stop giving reports to ``handler``; the last one disables the scan."""
+        if handler not in self._handlers:
+            return
+        self._handlers.remove(handler)
+        if self.reader is not None:
+            self.reader.remove_handler(handler)
+        if not self._handlers:
+            self._stop_scan()
+
+    def resume_scan(self):
+        """Re-enable the scan if it is wanted (a GATT connection may have stopped it)."""
+        if not self._handlers:
+            return
+        with self.lock:
+            try:
+                _bluetooth_utils().enable_le_scan(self.command_socket(), filter_duplicates=False)
+            except Exception as e:
+                print('Cannot re-enable LE scan: %r' % (e,))
+                self.command_failed(e)
+
+    def _start_scan(self, loop):
+        from .hci_async import AsyncLEReader
+
+        self.loop = loop
+        with self.lock:
+            if any(self._advertisers.values()):
+                raise RuntimeError('hci%d is used for extended advertising: cannot scan' % self.dev_id)
+            self._commit(False)
+            sock = self._open()
+            reader = AsyncLEReader(sock, loop, on_error=self._on_scan_error)
+            for handler in self._handlers:
+                reader.add_handler(handler)
+            try:
+                reader.start()
+                _bluetooth_utils().enable_le_scan(self.command_socket(), filter_duplicates=False)
+            except Exception as e:
+                reader.stop()
+                sock.close()
+                self.command_failed(e)
+                raise
+            self._scan_sock = sock
+            self.reader = reader
+        self._failures = 0
+
+    def _stop_scan(self):
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        with self.lock:
+            if self.reader is not None:
+                self.reader.stop()
+                self.reader = None
+            if self._scan_sock is not None:
+                try:
+                    _bluetooth_utils().disable_le_scan(self.command_socket())
+                except Exception as e:
+                    self.command_failed(e)
+                try:
+                    self._scan_sock.close()
+                except OSError:
+                    pass
+                self._scan_sock = None
+
+    def _on_scan_error(self, error):
+        self.scan_errors += 1
+        self.last_error = repr(error)
+        self._drop_scan_socket()
+        self._schedule_restart()
+
+    def _drop_scan_socket(self):
+        self.reader = None
+        if self._scan_sock is not None:
+            try:
+                self._scan_sock.close()
+            except OSError:
+                pass
+            self._scan_sock = None
+
+    def _schedule_restart(self):
+        if self._retry is not None or not self._handlers:
+            return
+        delay = min(self.retry_delay * 2 ** self._failures, self.retry_max)
+        self._failures += 1
+        self._retry = self.loop.call_later(delay, self._retry_scan)
+
+    def _retry_scan(self):
+        self._retry = None
+        if self.reader is None:
+            self._restart_scan()
+
+    def _restart_scan(self):
+        """Reopen the scan socket (on the loop) for the registered handlers."""
+        if not self._handlers:
+            return
+        if self.reader is not None:
+            self.reader.stop()
+        self._drop_scan_socket()
+        try:
+            self._start_scan(self.loop)
+        except Exception as e:
+            print('Cannot restart LE scan on hci%d: %r' % (self.dev_id, e))
+            self._schedule_restart()
+
+    def status(self):
+        return {
+            'device': 'hci%d' % self.dev_id,
+            'scanning': self.scanning,
+            'scan_handlers': len(self._handlers),
+            'reader': self.reader.stats() if self.reader is not None else None,
+            'opens': self.opens,
+            'command_errors': self.command_errors,
+            'scan_errors': self.scan_errors,
+            'resets': self.resets,
+            'command_set': {None: None, False: 'legacy', True: 'extended'}[self.extended],
+            'last_error': self.last_error,
+        }
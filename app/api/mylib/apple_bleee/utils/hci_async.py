@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio-native reader for LE advertising reports (linux only).
+
+Instead of a thread blocked in ``sock.recv`` (see
+:func:`.bluetooth_utils.parse_le_advertising_events`), the HCI socket is
+switched to non-blocking mode and registered with ``loop.add_reader``.
+Every wakeup drains all pending events (up to ``batch_size``), decodes them
+with :func:`.bluetooth_utils.iter_le_advertising_reports` and publishes the
+reports from the event loop thread, so handlers and subscribers never race
+with each other or with request handling.
+
+Example::
+
+    reader = AsyncLEReader(sock)
+    reader.add_handler(lambda mac, adv_type, data, rssi: ...)
+    reader.start()
+    async for mac, adv_type, data, rssi in reader.reports():
+        ...
+"""
+
+import asyncio
+from errno import EAGAIN, EWOULDBLOCK
+
+import bluetooth._bluetooth as bluez
+
+from .bluetooth_utils import LE_META_EVENT, iter_le_advertising_reports
+
+__all__ = ('AsyncLEReader',)
+
+# HCI event packets are at most 3 + 255 bytes
+_RECV_SIZE = 258
+
+
+class AsyncLEReader(object):
+    """
+    Publish LE advertising reports read from an HCI socket on an asyncio loop.
+
+    :param sock: A bluetooth HCI socket on which LE scanning is enabled.
+    :param loop: Event loop to register with (defaults to the running loop).
+    :param batch_size: Maximum number of events read per wakeup before
+        yielding back to the loop.
+    :type batch_size: ``int``
+    :param on_error: Optional ``callback(error)`` called on the loop after a
+        socket error stopped the reader (e.g. to reopen the device).
+    """
+
+    def __init__(self, sock, loop=None, batch_size=64, on_error=None):
+        self.sock = sock
+        self.loop = loop
+        self.batch_size = batch_size
+        self.on_error = on_error
+        self._handlers = []
+        self._queues = []
+        self._old_filter = None
+        self._running = False
+        self.events = 0
+        self.reports_count = 0
+        self.dropped = 0
+        self.wakeups = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    def add_handler(self, handler):
+        """
+        Register a synchronous handler called for every report, with the same
+        signature as the ``parse_le_advertising_events`` handler:
+        ``handler(mac, adv_type, data, rssi)``. It runs on the loop thread and
+        must not block.
+        """
+        self._handlers.append(handler)
+
+    def remove_handler(self, handler):
+        if handler in self._handlers:
+            self._handlers.remove(handler)
+
+    def subscribe(self, maxsize=1024):
+        """
+        Create a subscriber queue receiving lists of reports (one list per
+        wakeup). When the subscriber is too slow and its queue is full, the
+        oldest batch is dropped so the reader never blocks.
+
+        :returns: an ``asyncio.Queue``; pass it to :meth:`unsubscribe` when done.
+        """
+        queue = asyncio.Queue(maxsize)
+        self._queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        if queue in self._queues:
+            self._queues.remove(queue)
+
+    async def reports(self, maxsize=1024):
+        """Async iterator over ``(mac, adv_type, data, rssi)`` reports."""
+        queue = self.subscribe(maxsize)
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    return
+                for report in batch:
+                    yield report
+        finally:
+            self.unsubscribe(queue)
+
+    def start(self):
+        """Set the socket filter and start reading on the event loop."""
+        if self._running:
+            return
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+        self._old_filter = self.sock.getsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, 14)
+        flt = bluez.hci_filter_new()
+        bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
+        bluez.hci_filter_set_event(flt, LE_META_EVENT)
+        self.sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, flt)
+        self.sock.setblocking(False)
+
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+        self._running = True
+
+    def stop(self):
+        """
+        Stop reading and restore the previous socket filter. Subscribers
+        waiting in :meth:`reports` are woken up and finish.
+        """
+        if not self._running:
+            return
+        self._running = False
+        try:
+            self.loop.remove_reader(self.sock.fileno())
+        except (OSError, ValueError):
+            # socket already closed
+            pass
+        try:
+            self.sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, self._old_filter)
+            self.sock.setblocking(True)
+        except (bluez.error, OSError):
+            pass
+        for queue in list(self._queues):
+            self._publish(queue, None)
+
+    def _read_batch(self):
+        """Read every pending event, at most ``batch_size`` of them."""
+        reports = []
+        recv = self.sock.recv
+        for _ in range(self.batch_size):
+            try:
+                pkt = recv(_RECV_SIZE)
+            except bluez.timeout:
+                break
+            except OSError as e:
+                if e.errno in (EAGAIN, EWOULDBLOCK):
+                    break
+                raise
+            if not pkt:
+                break
+            self.events += 1
+            reports.extend(iter_le_advertising_reports(pkt))
+        return reports
+
+    def _on_readable(self):
+        self.wakeups += 1
+        try:
+            reports = self._read_batch()
+        except OSError as e:
+            print('HCI socket error, stop reading: %r' % (e,))
+            self.stop()
+            if self.on_error is not None:
+                self.on_error(e)
+            return
+        if not reports:
+            return
+        self.reports_count += len(reports)
+
+        for handler in self._handlers:
+            for report in reports:
+                try:
+                    handler(*report)
+                except Exception as e:
+                    print('Exception when calling handler with a BLE advertising event: %r' % (e,))
+
+        for queue in self._queues:
+            self._publish(queue, reports)
+
+    def _publish(self, queue, item):
+        if queue.full():
+            try:
+                queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        queue.put_nowait(item)
+
+    def stats(self):
+        return {
+            'running': self._running,
+            'wakeups': self.wakeups,
+            'events': self.events,
+            'reports': self.reports_count,
+            'events_per_wakeup': float(self.events) / self.wakeups if self.wakeups else 0.0,
+            'dropped_batches': self.dropped,
+            'subscribers': len(self._queues),
+        }
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory log of a long running task, read by offset.
+
+:class:`LogRing` keeps the last ``size`` lines, each numbered with an
+increasing sequence number. Readers remember the last number they got and
+ask for what came after it (:meth:`~LogRing.since`), so a poll costs the
+number of new lines rather than the size of the whole log. Asyncio
+consumers can also :meth:`~LogRing.subscribe` and get every new line as it
+is written, from any thread.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+__all__ = ('LogRing',)
+
+
+class LogRing(object):
+    """
+    Bounded, thread-safe log.
+
+    :param size: Number of lines kept; older lines are dropped.
+    :param echo: Also print every line (like the scripts it replaces).
+    """
+
+    def __init__(self, size=1000, echo=False):
+        self.size = size
+        self.echo = echo
+        self._lines = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._queues = []
+
+    @property
+    def seq(self):
+        """Sequence number of the last line written (0: none yet)."""
+        return self._seq
+
+    def write(self, msg, level='info'):
+        """
+        Append one line.
+
+        :param level: ``'info'`` or ``'error'``.
+        :returns: The sequence number of the line.
+        """
+        with self._lock:
+            self._seq += 1
+            entry = {'seq': self._seq, 'time': time.time(), 'level': level, 'msg': msg}
+            self._lines.append(entry)
+            queues = list(self._queues)
+        if self.echo:
+            print(msg)
+        for loop, queue in queues:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, entry)
+            except RuntimeError:
+                # the subscriber's loop is closed
+                self.unsubscribe(queue)
+        return entry['seq']
+
+    def error(self, msg):
+        return self.write(msg, level='error')
+
+    def since(self, seq=0, limit=None):
+        """
+        Lines written after line ``seq``.
+
+        :param limit: Return at most this many lines (the oldest ones).
+        :returns: ``(lines, next_seq, truncated)``. Pass ``next_seq`` back
+            to get the following lines. ``truncated`` is ``True`` if lines
+            after ``seq`` were already dropped from the ring.
+        """
+        with self._lock:
+            new = self._seq - max(seq, 0)
+            if new <= 0:
+                return [], self._seq, False
+            truncated = new > len(self._lines)
+            new = min(new, len(self._lines))
+            # walk from the newest end: the cost is the number of new lines
+            lines = []
+            for entry in reversed(self._lines):
+                if len(lines) == new:
+                    break
+                lines.append(entry)
+        lines.reverse()
+        if limit is not None and len(lines) > limit:
+            lines = lines[:limit]
+        next_seq = lines[-1]['seq'] if lines else seq
+        return lines, next_seq, truncated
+
+    def clear(self):
+        """Drop the lines (sequence numbers keep increasing)."""
+        with self._lock:
+            self._lines.clear()
+
+    def subscribe(self, maxsize=256):
+        """
+        ``asyncio.Queue`` (of the running loop) receiving every new line.
+        """
+        queue = asyncio.Queue(maxsize)
+        with self._lock:
+            self._queues.append((asyncio.get_event_loop(), queue))
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._queues = [(l, q) for l, q in self._queues if q is not queue]
+
+    @staticmethod
+    def _put(queue, entry):
+        if queue.full():
+            # slow consumer: drop its oldest line rather than block writers
+            queue.get_nowait()
+        queue.put_nowait(entry)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous phone number enrichment (hash2phone web service, HLR status,
+region, iMessage).
+
+:class:`PhoneEnricher` runs its own asyncio loop on a background thread, so
+the sniffer (or the web app) only schedules work and never waits for the
+network. All requests go through one pooled ``requests.Session`` executed
+on a bounded thread pool; each endpoint has its own concurrency limit and
+minimum spacing between requests. Identical requests in flight are
+coalesced into one, and answers are kept in a TTL cache.
+
+The endpoints are plain URLs, so the whole pipeline can be exercised
+against a local stand-in service::
+
+    python3 phone_enrich.py selftest
+"""
+
+import asyncio
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ('PhoneEnricher', 'Endpoint', 'EnrichError')
+
+HLR_API_URL = 'https://www.hlrlookup.com/api/hlr/?apikey={}&password={}&msisdn='
+
+
+class EnrichError(Exception):
+    pass
+
+
+class Endpoint(object):
+    """
+    Limits of one remote service.
+
+    :param concurrency: Maximum number of requests in flight.
+    :param rate: Maximum requests per second (``None``: unlimited).
+    :param ttl: Seconds an answer stays cached (0: not cached).
+    """
+
+    def __init__(self, name, url, concurrency=2, rate=None, ttl=3600):
+        self.name = name
+        self.url = url
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate else 0.0
+        self.ttl = ttl
+        self.semaphore = None
+        self._next = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    async def slot(self, loop):
+        """Wait until the rate limit allows one more request."""
+        if not self.interval:
+            return
+        now = loop.time()
+        wait = self._next - now
+        self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class PhoneEnricher(object):
+    """
+    Schedule phone lookups from any thread.
+
+    :param limits: Optional ``{endpoint name: {'concurrency', 'rate', 'ttl'}}``
+        overriding the defaults of the ``hash2phone``, ``hlr``, ``region``
+        and ``imessage`` endpoints.
+    """
+
+    DEFAULT_LIMITS = {
+        'hash2phone': {'concurrency': 4, 'rate': None, 'ttl': 24 * 3600},
+        'hlr': {'concurrency': 2, 'rate': 5, 'ttl': 3600},
+        'region': {'concurrency': 2, 'rate': 2, 'ttl': 24 * 3600},
+        # the original sender waited 2s between messages
+        'imessage': {'concurrency': 1, 'rate': 0.5, 'ttl': 0},
+    }
+
+    def __init__(self, hash2phone_url='', hlr_api_url='', region_check_url='', imessage_url='',
+                 proxies=None, verify=False, timeout=10, limits=None):
+        urls = {'hash2phone': hash2phone_url, 'hlr': hlr_api_url, 'region': region_check_url,
+                'imessage': imessage_url}
+        self.endpoints = {}
+        for name, url in urls.items():
+            options = dict(self.DEFAULT_LIMITS[name])
+            options.update((limits or {}).get(name, {}))
+            self.endpoints[name] = Endpoint(name, url, **options)
+        self.proxies = proxies or {}
+        self.verify = verify
+        self.timeout = timeout
+
+        self.loop = None
+        self.session = None
+        self._thread = None
+        self._executor = None
+        self._cache = {}
+        self._inflight = {}
+        self.cache_hits = 0
+        self.coalesced = 0
+
+    # ---- loop thread ----------------------------------------------------------
+
+    def start(self):
+        if self.loop is not None:
+            return
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        workers = sum(e.concurrency for e in self.endpoints.values())
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.proxies.update(self.proxies)
+        self.session.verify = self.verify
+        self._executor = ThreadPoolExecutor(workers)
+
+        self.loop = asyncio.new_event_loop()
+        for endpoint in self.endpoints.values():
+            endpoint.semaphore = asyncio.Semaphore(endpoint.concurrency)
+        self._thread = threading.Thread(target=self.loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        self._thread.join(5)
+        self.loop.close()
+        self._executor.shutdown(wait=False)
+        self.session.close()
+        self.loop = None
+
+    async def _shutdown(self):
+        # drop lookups still waiting for a slot
+        tasks = [t for t in asyncio.all_tasks(self.loop) if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def submit(self, coro):
+        """
+        Run ``coro`` on the enrichment loop; returns at once.
+
+        :returns: a ``concurrent.futures.Future``.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._report)
+        return future
+
+    @staticmethod
+    def _report(future):
+        if not future.cancelled() and future.exception() is not None:
+            print('Phone enrichment failed: %r' % (future.exception(),))
+
+    async def run_in_executor(self, func, *args):
+        """Run a blocking call (e.g. a local database lookup) off the loop."""
+        return await self.loop.run_in_executor(self._executor, func, *args)
+
+    # ---- requests ------------------------------------------------------------
+
+    async def _call(self, name, key, func, *args):
+        endpoint = self.endpoints[name]
+        if not endpoint.url:
+            raise EnrichError('no URL configured for %s' % name)
+        cache_key = (name, key)
+        cached = self._cache.get(cache_key)
+        if cached is not None and cached[0] > time.time():
+            self.cache_hits += 1
+            return cached[1]
+        future = self._inflight.get(cache_key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self.loop.create_future()
+        self._inflight[cache_key] = future
+        try:
+            async with endpoint.semaphore:
+                await endpoint.slot(self.loop)
+                endpoint.requests += 1
+                value = await self.loop.run_in_executor(self._executor, func, endpoint.url, *args)
+        except Exception as e:
+            endpoint.errors += 1
+            future.set_exception(e)
+            # retrieved by the coalesced callers, if any
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if endpoint.ttl:
+                self._cache[cache_key] = (time.time() + endpoint.ttl, value)
+            return value
+        finally:
+            del self._inflight[cache_key]
+
+    def _get(self, url, **kwargs):
+        r = self.session.get(url, timeout=self.timeout, **kwargs)
+        if r.status_code != 200:
+            raise EnrichError('%s: status %d' % (url, r.status_code))
+        return r
+
+    def _fetch_candidates(self, url, hashp):
+        return list(self._get(url, params={'hash': hashp}).json()['candidates'])
+
+    def _fetch_hlr(self, url, phones):
+        result = self._get(url + ','.join(phones)).json()
+        return dict((phone, '{}'.format(info['error_text'])) for phone, info in result.items())
+
+    def _fetch_region(self, url, phone):
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(self._get(url + phone).content, 'html.parser')
+        text = str(soup.find("div", {"class": "itemprop_answer"}))
+        return re.findall(r'Region:(.*?)L', text, flags=re.DOTALL)[0].replace('<br/>', '').replace('\n', '')
+
+    def _post_imessage(self, url, phone, text):
+        # our own service to send iMessage
+        data = {"token": "",
+                "destination": "+{}".format(phone),
+                "text": text
+                }
+        r = self.session.post(url + '/imessage', data=json.dumps(data), timeout=self.timeout)
+        if r.status_code == 200:
+            return 'X'
+        elif r.status_code == 404:
+            return '-'
+        raise EnrichError('iMessage: status %d %r' % (r.status_code, r.content))
+
+    async def candidates(self, hashp):
+        """Phone numbers matching a 3 byte phone hash, from the hash2phone web service."""
+        return await self._call('hash2phone', hashp, self._fetch_candidates, hashp)
+
+    async def hlr_status(self, phones):
+        """
+        HLR status of ``phones``. Numbers without a cached status are asked
+        in one request.
+
+        :returns: ``{phone: status}``
+        """
+        status = {}
+        missing = []
+        for phone in phones:
+            cached = self._cache.get(('hlr1', phone))
+            if cached is not None and cached[0] > time.time():
+                self.cache_hits += 1
+                status[phone] = cached[1]
+            else:
+                missing.append(phone)
+        if missing:
+            missing = tuple(sorted(missing))
+            result = await self._call('hlr', missing, self._fetch_hlr, missing)
+            ttl = self.endpoints['hlr'].ttl
+            for phone, value in result.items():
+                if ttl:
+                    self._cache[('hlr1', phone)] = (time.time() + ttl, value)
+                status[phone] = value
+        return status
+
+    async def region(self, phone):
+        return await self._call('region', phone, self._fetch_region, phone)
+
+    async def send_imessage(self, phone, text):
+        """:returns: ``'X'`` if sent, ``'-'`` if the number has no iMessage."""
+        return await self._call('imessage', (phone, text), self._post_imessage, phone, text)
+
+    def stats(self):
+        return {
+            'cache_hits': self.cache_hits,
+            'coalesced': self.coalesced,
+            'cached': len(self._cache),
+            'in_flight': len(self._inflight),
+            'requests': dict((name, e.requests) for name, e in self.endpoints.items()),
+            'errors': dict((name, e.errors) for name, e in self.endpoints.items()),
+        }
+
+
+def _selftest():
+    """Run the pipeline against a local stand-in for the four services."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    hits = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body, status=200, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            hits[url.path] = hits.get(url.path, 0) + 1
+            time.sleep(0.05)
+            if url.path == '/hash2phone':
+                h = parse_qs(url.query)['hash'][0]
+                self._send(json.dumps({'candidates': ['1%s01' % h, '1%s02' % h]}).encode())
+            elif url.path == '/hlr/':
+                phones = parse_qs(url.query)['msisdn'][0].split(',')
+                self._send(json.dumps(dict((p, {'error_text': 'Live'}) for p in phones)).encode())
+            elif url.path.startswith('/region/'):
+                self._send(b'<div class="itemprop_answer">Region: Test<br/>L</div>', content_type='text/html')
+            else:
+                self._send(b'{}', status=404)
+
+        def do_POST(self):
+            hits[self.path] = hits.get(self.path, 0) + 1
+            self.rfile.read(int(self.headers['Content-Length']))
+            self._send(b'{}')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+
+    enricher = PhoneEnricher(hash2phone_url=base + '/hash2phone', hlr_api_url=base + '/hlr/?msisdn=',
+                             region_check_url=base + '/region/', imessage_url=base,
+                             limits={'imessage': {'rate': 20}})
+
+    async def victim(hashp):
+        phones = await enricher.candidates(hashp)
+        status = await enricher.hlr_status(phones)
+        regions = await asyncio.gather(*[enricher.region(p) for p in phones])
+        sent = [await enricher.send_imessage(p, 'Gotcha!') for p in phones if status[p] == 'Live']
+        return phones, regions, sent
+
+    started = time.time()
+    # 40 requests for 4 distinct hashes: duplicates are coalesced or cached
+    futures = [enricher.submit(victim('%06x' % (i % 4))) for i in range(40)]
+    results = [f.result(10) for f in futures]
+    print('%d victims enriched in %.2fs' % (len(results), time.time() - started))
+    print('server hits: %s' % hits)
+    print('stats: %s' % enricher.stats())
+    enricher.stop()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] == ['selftest']:
+        _selftest()
+    else:
+        print('Usage: %s selftest' % sys.argv[0])
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Phone number candidates for a 3 byte SHA256 prefix, from the sqlite
+database built by ``hash2phone/hashmap_gen_sqlite.py``.
+
+:class:`PhoneHashLookup` makes sure the ``map`` table has its index on
+``hash`` (databases built before the index was added get it on first use),
+then answers every lookup through one shared read-only connection with a
+large mmap window. Threads asking at the same time are served by a single
+``WHERE hash IN (...)`` query, and an LRU cache answers repeated hashes
+(the same devices keep advertising the same hashes) without touching the
+database at all.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ('PhoneHashLookup', 'HASH_INDEX_SQL', 'open_phone_db')
+
+HASH_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS map_hash ON map (hash)'
+
+# sqlite limits the number of host parameters per statement
+_MAX_BATCH = 500
+
+
+def open_phone_db(path, **kwargs):
+    """
+    Open ``path`` with :class:`PhoneHashLookup`, or with
+    :class:`.phone_table.PhoneHashTable` if it is a binary table built by
+    ``phone_table.py``.
+    """
+    try:
+        from .phone_table import PhoneHashTable, is_phone_table
+    except ImportError:
+        from phone_table import PhoneHashTable, is_phone_table
+    if is_phone_table(path):
+        return PhoneHashTable(path)
+    return PhoneHashLookup(path, **kwargs)
+
+
+class _Pending(object):
+    __slots__ = ('event', 'phones')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.phones = None
+
+
+class PhoneHashLookup(object):
+    """
+    Cached, batched ``hash -> [phone, ...]`` lookups.
+
+    :param db_path: Path of the phones sqlite database.
+    :param cache_size: Number of hashes kept in the LRU cache (hashes with
+        no candidate are cached too).
+    :param mmap_size: Bytes of the database file sqlite may memory map.
+    :param create_index: Create the ``hash`` index (and switch the database
+        to WAL) if it is missing. This needs write access once; it can take
+        a while on a large database, but only the first time.
+    """
+
+    def __init__(self, db_path, cache_size=4096, mmap_size=1 << 30, create_index=True):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.create_index = create_index
+
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.queried_hashes = 0
+        self.query_time = 0.0
+
+    def _connect(self):
+        if not os.path.isfile(self.db_path):
+            raise IOError('No such phones database: %s' % self.db_path)
+        if self.create_index:
+            self.ensure_index()
+        uri = 'file:%s?mode=ro' % os.path.abspath(self.db_path)
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+        conn.execute('PRAGMA cache_size=-%d' % (64 * 1024))
+        return conn
+
+    def ensure_index(self):
+        """Create the hash index and enable WAL if needed."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            indexes = [row[1] for row in conn.execute('PRAGMA index_list(map)')]
+            if 'map_hash' not in indexes:
+                print('Creating hash index on %s, this may take a while...' % self.db_path)
+                conn.execute(HASH_INDEX_SQL)
+                conn.commit()
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.OperationalError as e:
+            # read-only database file: use it as it is
+            print('Cannot index %s: %s' % (self.db_path, e))
+        finally:
+            conn.close()
+
+    def close(self):
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def lookup(self, hashp):
+        """
+        :param hashp: Hex string of the first 3 bytes of SHA256(phone number).
+        :returns: ``list`` of candidate phone numbers (``int``), possibly empty.
+        """
+        return self.lookup_many((hashp,))[hashp.lower()]
+
+    def lookup_many(self, hashes):
+        """:returns: ``dict`` mapping each of ``hashes`` (lower case) to its candidates."""
+        result = {}
+        waiting = {}
+        with self._lock:
+            for h in hashes:
+                h = h.lower()
+                phones = self._cache.get(h)
+                if phones is not None:
+                    self._cache.move_to_end(h)
+                    self.hits += 1
+                    result[h] = phones
+                    continue
+                self.misses += 1
+                pending = self._pending.get(h)
+                if pending is None:
+                    pending = self._pending[h] = _Pending()
+                waiting[h] = pending
+
+        if waiting:
+            # whoever holds the connection answers every pending hash at once:
+            # callers arriving meanwhile are served by the next single query
+            with self._db_lock:
+                if not all(p.event.is_set() for p in waiting.values()):
+                    self._run_pending()
+            for h, pending in waiting.items():
+                pending.event.wait()
+                result[h] = pending.phones
+        return result
+
+    def _run_pending(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+        if not batch:
+            return
+        found = dict((h, []) for h in batch)
+        ok = False
+        try:
+            if self._conn is None:
+                self._conn = self._connect()
+            started = time.time()
+            keys = list(batch)
+            for i in range(0, len(keys), _MAX_BATCH):
+                chunk = keys[i:i + _MAX_BATCH]
+                sql = 'SELECT hash, phone FROM map WHERE hash IN (%s)' % ','.join('?' * len(chunk))
+                for h, phone in self._conn.execute(sql, chunk):
+                    found[h].append(phone)
+                self.queries += 1
+            self.query_time += time.time() - started
+            self.queried_hashes += len(keys)
+            ok = True
+        finally:
+            with self._lock:
+                for h, pending in batch.items():
+                    pending.phones = found[h]
+                    if ok:
+                        self._cache[h] = found[h]
+                        self._cache.move_to_end(h)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            for pending in batch.values():
+                pending.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'queries': self.queries,
+                'hashes_per_query': float(self.queried_hashes) / self.queries if self.queries else 0.0,
+                'avg_query_ms': self.query_time * 1000.0 / self.queries if self.queries else 0.0,
+            }
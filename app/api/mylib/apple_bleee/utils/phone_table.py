@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary hash2phone table.
+
+Alternative to the ``phones.db`` sqlite database of
+``hash2phone/hashmap_gen_sqlite.py`` for one phone number mask. Each number
+of the mask is stored as its 3 byte SHA256 prefix plus its offset in the
+mask, sorted by prefix. The first two bytes of the prefix select one of
+2^16 buckets through an offset index, so an entry only keeps the third
+byte and the offset (5 bytes instead of a ~40 byte sqlite row plus
+index). Lookups memory map the file and binary search one bucket.
+
+Layout (little endian header, big endian entries)::
+
+    header   magic 'H2PT', version, base (first number), count, digits
+    index    (2^16 + 1) x uint64: first entry of each bucket
+    entries  count x (prefix[2]: uint8, offset: uint32), sorted
+
+The table is built in parallel: a process pool hashes slices of the mask
+and spreads the entries over 256 run files by the first prefix byte, then
+each run is sorted in memory (an external bucket sort, so memory stays at
+1/256 of the table) and appended to the output with its bucket counts.
+
+Usage::
+
+    python3 phone_table.py build 336XXXXXXXX phones.bin
+    python3 phone_table.py lookup phones.bin 56d5a1
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+from hashlib import sha256
+
+__all__ = ('PhoneHashTable', 'build_table', 'is_phone_table', 'MAGIC')
+
+MAGIC = b'H2PT'
+VERSION = 1
+_HEADER = struct.Struct('<4sBBHQQ')  # magic, version, digits, reserved, base, count
+_INDEX = struct.Struct('<%dQ' % (0x10000 + 1))
+_ENTRY_SIZE = 5
+_ENTRIES_START = _HEADER.size + _INDEX.size
+# run file record: prefix[1], prefix[2], offset
+_RUN_RECORD = 6
+_CHUNK = 1000000
+
+
+def is_phone_table(path):
+    """``True`` if ``path`` is a table written by :func:`build_table`."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def parse_mask(phonemask):
+    """``'336 XX-XX'`` -> ``(33600000, 33699999)``, like hashmap_gen_sqlite.py."""
+    phonemask = phonemask.replace(' ', '').replace('-', '')
+    return int(phonemask.replace('X', '0')), int(phonemask.replace('X', '9'))
+
+
+def _hash_slice(job):
+    """Worker: hash ``[start, stop)`` and split the records by first prefix byte."""
+    start, stop, base = job
+    runs = [bytearray() for _ in range(256)]
+    for num in range(start, stop):
+        digest = sha256(b'%d' % num).digest()
+        runs[digest[0]] += digest[1:3] + (num - base).to_bytes(4, 'big')
+    return [bytes(run) for run in runs]
+
+
+def _sort_run(path):
+    """Worker: sort one run file, return its entries and per-bucket counts."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    records = [data[i:i + _RUN_RECORD] for i in range(0, len(data), _RUN_RECORD)]
+    records.sort()
+    counts = [0] * 256
+    for record in records:
+        counts[record[0]] += 1
+    return b''.join(record[1:] for record in records), counts
+
+
+def build_table(phonemask, out_path, processes=None, tmp_dir=None, progress=True):
+    """
+    Build the table of every number matching ``phonemask`` (``'1213XXXXXXX'``).
+
+    :param processes: Size of the process pool (default: all cores).
+    :param tmp_dir: Where to put the 256 run files (about the size of the
+        final table). Defaults to a directory next to ``out_path``.
+    :returns: Number of entries written.
+    """
+    from multiprocessing import Pool
+
+    start, stop = parse_mask(phonemask)
+    count = stop - start + 1
+    if count > 1 << 32:
+        raise ValueError('mask too large: offsets are stored on 4 bytes')
+    digits = len(str(stop))
+
+    work_dir = tempfile.mkdtemp(prefix='phone_table.', dir=tmp_dir or os.path.dirname(os.path.abspath(out_path)))
+    run_paths = [os.path.join(work_dir, '%02x.run' % i) for i in range(256)]
+    try:
+        jobs = [(s, min(s + _CHUNK, stop + 1), start) for s in range(start, stop + 1, _CHUNK)]
+        with Pool(processes) as pool:
+            run_files = [open(p, 'wb') for p in run_paths]
+            try:
+                for done, runs in enumerate(pool.imap_unordered(_hash_slice, jobs), 1):
+                    for f, run in zip(run_files, runs):
+                        f.write(run)
+                    if progress:
+                        print('\rhashing: %d%%' % (done * 100 // len(jobs)), end='')
+            finally:
+                for f in run_files:
+                    f.close()
+
+            index = [0] * (0x10000 + 1)
+            position = 0
+            with open(out_path, 'wb') as out:
+                out.write(_HEADER.pack(MAGIC, VERSION, digits, 0, start, count))
+                out.write(_INDEX.pack(*index))
+                # runs come back in order (imap), each one is a contiguous range of buckets
+                for first, (entries, counts) in enumerate(pool.imap(_sort_run, run_paths)):
+                    out.write(entries)
+                    for second, n in enumerate(counts):
+                        index[(first << 8) | second] = position
+                        position += n
+                    os.remove(run_paths[first])
+                    if progress and first % 16 == 15:
+                        print('\rsorting: %d%%' % ((first + 1) * 100 // 256), end='')
+                index[0x10000] = position
+                out.seek(_HEADER.size)
+                out.write(_INDEX.pack(*index))
+        if progress:
+            print()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return position
+
+
+class PhoneHashTable(object):
+    """
+    Read-only view of a table written by :func:`build_table`, with the
+    same ``lookup``/``lookup_many`` interface as :class:`.phone_lookup.PhoneHashLookup`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.digits, _, self.base, self.count = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a phone table' % path)
+        self._index = _INDEX.unpack_from(self._mm, _HEADER.size)
+        self.lookups = 0
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def lookup(self, hashp):
+        """
+        :param hashp: Hex string of the first 3 bytes of SHA256(phone number).
+        :returns: ``list`` of candidate phone numbers (``int``), possibly empty.
+        """
+        self.lookups += 1
+        prefix = int(hashp, 16)
+        bucket, third = prefix >> 8, prefix & 0xff
+        lo, hi = self._index[bucket], self._index[bucket + 1]
+        mm = self._mm
+        # first entry of the bucket whose third prefix byte is >= third
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[_ENTRIES_START + mid * _ENTRY_SIZE] < third:
+                lo = mid + 1
+            else:
+                hi = mid
+        phones = []
+        end = self._index[bucket + 1]
+        pos = _ENTRIES_START + lo * _ENTRY_SIZE
+        while lo < end and mm[pos] == third:
+            phones.append(self.base + int.from_bytes(mm[pos + 1:pos + _ENTRY_SIZE], 'big'))
+            lo += 1
+            pos += _ENTRY_SIZE
+        return phones
+
+    def lookup_many(self, hashes):
+        return dict((h.lower(), self.lookup(h)) for h in hashes)
+
+    def stats(self):
+        return {'entries': self.count, 'lookups': self.lookups}
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) == 4 and sys.argv[1] == 'build':
+        started = time.time()
+        n = build_table(sys.argv[2], sys.argv[3])
+        print('%d entries, %d bytes in %.1fs' % (n, os.path.getsize(sys.argv[3]), time.time() - started))
+    elif len(sys.argv) == 4 and sys.argv[1] == 'lookup':
+        table = PhoneHashTable(sys.argv[2])
+        for phone in table.lookup(sys.argv[3]):
+            print(phone)
+    else:
+        print('Usage: %s build phonemask phones.bin\n       %s lookup phones.bin hash' % (sys.argv[0], sys.argv[0]))
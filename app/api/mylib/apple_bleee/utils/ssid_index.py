@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent SSID hash index.
+
+Wi-Fi join requests (Continuity type 0x0f) carry the first 3 bytes of
+SHA256(SSID) of the network the device wants to join. :class:`SSIDHashIndex`
+remembers every SSID it is given (Wi-Fi scans, imported SSID lists) so
+these hashes can be resolved against all the networks seen so far, not only
+the ones visible at start up.
+
+The index is a file sorted by hash with a 2^16-bucket offset table on the
+first two hash bytes, so a lookup reads one (almost always tiny) bucket::
+
+    header   magic 'SSIX', version, count
+    index    (2^16 + 1) x uint32: byte offset of each bucket in the records
+    records  hash[2]: uint8, len: uint8, ssid: utf-8 bytes, sorted by hash
+
+SSIDs added since the last :meth:`~SSIDHashIndex.flush` are kept in a dict
+and looked up first, so additions are visible immediately. A flush appends
+them to a journal next to the index (``<path>.new``, records
+``hash[3], len, ssid``); the sorted file is only rewritten when the journal
+grows past :data:`COMPACT_MIN` records or a quarter of the index. An
+unreadable index file is moved aside (``<path>.bad``) and the index starts
+empty.
+
+Usage::
+
+    python3 ssid_index.py import ssid_hashes.bin ssids.txt
+    python3 ssid_index.py lookup ssid_hashes.bin 1a2b3c
+"""
+
+import csv
+import os
+import struct
+import threading
+from hashlib import sha256
+
+__all__ = ('SSIDHashIndex', 'ssid_hash')
+
+MAGIC = b'SSIX'
+VERSION = 1
+_HEADER = struct.Struct('<4sBxxxI')
+_INDEX = struct.Struct('<%dI' % (0x10000 + 1))
+_RECORDS_START = _HEADER.size + _INDEX.size
+# 802.11 limit
+MAX_SSID_LEN = 32
+JOURNAL_SUFFIX = '.new'
+# journal records merged into the sorted file once there are more than
+# this (or a quarter of the stored SSIDs)
+COMPACT_MIN = 4096
+
+
+def ssid_hash(ssid):
+    """First 3 bytes of SHA256(ssid), as advertised in Wi-Fi join requests."""
+    if isinstance(ssid, str):
+        ssid = ssid.encode('utf-8')
+    return sha256(ssid).digest()[:3]
+
+
+class SSIDHashIndex(object):
+    """
+    ``hash -> SSID`` index, usable like the ``dictOfss`` dict it replaces
+    (``h in index``, ``index[h]``, ``index.get(h)`` with hex hashes).
+
+    :param path: Index file, created on the first :meth:`flush`. ``None``
+        keeps the index in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self._data = b''
+        self._index = (0,) * (0x10000 + 1)
+        self._count = 0
+        self._recent = {}
+        # flushed to the journal, not merged in the sorted file yet
+        self._journal = {}
+        self._journal_count = 0
+        if path:
+            self._load()
+
+    def _load(self):
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                magic, version, count = _HEADER.unpack_from(data, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError('not an SSID index')
+                index = _INDEX.unpack_from(data, _HEADER.size)
+                if _RECORDS_START + index[-1] != len(data) or index[0] != 0:
+                    raise ValueError('truncated SSID index')
+            except (OSError, ValueError, struct.error) as e:
+                print('Ignoring unreadable SSID index %s: %s' % (self.path, e))
+                try:
+                    os.replace(self.path, self.path + '.bad')
+                except OSError:
+                    pass
+            else:
+                self._index = index
+                self._data = data
+                self._count = count
+        self._load_journal()
+
+    def _load_journal(self):
+        try:
+            with open(self.path + JOURNAL_SUFFIX, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+        pos = 0
+        while pos + 4 <= len(data):
+            size = data[pos + 3]
+            end = pos + 4 + size
+            if end > len(data):
+                break
+            h = data[pos:pos + 3]
+            ssid = data[pos + 4:end].decode('utf-8', 'replace')
+            journal = self._journal.setdefault(h, set())
+            if ssid not in journal:
+                journal.add(ssid)
+                self._journal_count += 1
+            pos = end
+        if pos != len(data):
+            # an interrupted append left a partial record: cut it before appending again
+            try:
+                with open(self.path + JOURNAL_SUFFIX, 'r+b') as f:
+                    f.truncate(pos)
+            except OSError:
+                pass
+
+    def __len__(self):
+        with self.lock:
+            return self._count + self._journal_count + sum(len(s) for s in self._recent.values())
+
+    def _stored(self, h):
+        """SSIDs stored in the file (and its journal) for the 3 byte hash ``h``."""
+        bucket = (h[0] << 8) | h[1]
+        data = self._data
+        pos = _RECORDS_START + self._index[bucket]
+        end = _RECORDS_START + self._index[bucket + 1]
+        found = []
+        while pos < end:
+            size = data[pos + 1]
+            if data[pos] == h[2]:
+                found.append(data[pos + 2:pos + 2 + size].decode('utf-8', 'replace'))
+            pos += 2 + size
+        journal = self._journal.get(h)
+        if journal:
+            found.extend(s for s in sorted(journal) if s not in found)
+        return found
+
+    def lookup(self, hashp):
+        """
+        :param hashp: Hex string (``'1a2b3c'``) or 3 ``bytes`` of SHA256(SSID).
+        :returns: ``list`` of known SSIDs with this hash.
+        """
+        h = bytes.fromhex(hashp) if isinstance(hashp, str) else bytes(hashp)
+        if len(h) != 3:
+            return []
+        with self.lock:
+            found = self._stored(h)
+            recent = self._recent.get(h)
+        if recent:
+            found.extend(s for s in sorted(recent) if s not in found)
+        return found
+
+    def get(self, hashp, default=None):
+        # several SSIDs per hash are rare with a few thousand networks
+        found = self.lookup(hashp)
+        return '/'.join(found) if found else default
+
+    def __getitem__(self, hashp):
+        ssid = self.get(hashp)
+        if ssid is None:
+            raise KeyError(hashp)
+        return ssid
+
+    def __contains__(self, hashp):
+        return bool(self.lookup(hashp))
+
+    def add(self, ssids):
+        """
+        Remember ``ssids`` (an iterable of ``str``). Empty, hidden (NUL
+        filled) and over-long names are skipped.
+
+        :returns: Number of SSIDs that were not known yet.
+        """
+        added = 0
+        with self.lock:
+            for ssid in ssids:
+                if not ssid:
+                    continue
+                raw = ssid.encode('utf-8')
+                if len(raw) > MAX_SSID_LEN or not raw.strip(b'\x00'):
+                    continue
+                h = ssid_hash(raw)
+                if ssid in self._stored(h):
+                    continue
+                recent = self._recent.setdefault(h, set())
+                if ssid not in recent:
+                    recent.add(ssid)
+                    added += 1
+        return added
+
+    def import_file(self, path):
+        """
+        Add the SSIDs of a corpus file: one SSID per line, or a CSV file with
+        an ``SSID`` / ``ESSID`` column (e.g. WiGLE or airodump-ng exports).
+
+        :returns: Number of new SSIDs.
+        """
+        with open(path, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+            first = f.readline()
+            f.seek(0)
+            columns = [c.strip().upper() for c in first.split(',')]
+            column = next((c for c in ('SSID', 'ESSID') if c in columns), None)
+            if column is None:
+                return self.add(line.rstrip('\r\n') for line in f)
+            reader = csv.reader(f)
+            position = columns.index(column)
+            next(reader)
+            return self.add(row[position].strip() for row in reader if len(row) > position)
+
+    def flush(self):
+        """
+        Save the SSIDs added since the last flush: appended to the journal,
+        or merged into the index file when the journal is large.
+        """
+        with self.lock:
+            if not self._recent:
+                return
+            added = sum(len(s) for s in self._recent.values())
+            if self._journal_count + added > max(COMPACT_MIN, self._count // 4):
+                self._compact()
+                return
+            journal = bytearray()
+            for h, ssids in self._recent.items():
+                for ssid in ssids:
+                    raw = ssid.encode('utf-8')
+                    journal += h + bytes((len(raw),)) + raw
+                self._journal.setdefault(h, set()).update(ssids)
+            if self.path:
+                with open(self.path + JOURNAL_SUFFIX, 'ab') as f:
+                    f.write(journal)
+            self._journal_count += added
+            self._recent = {}
+
+    def _compact(self):
+        """Rewrite the sorted index file with the journal and the recent SSIDs."""
+        with self.lock:
+            records = []
+            data = self._data
+            index = self._index
+            for b in range(0x10000):
+                pos = _RECORDS_START + index[b]
+                end = _RECORDS_START + index[b + 1]
+                prefix = bytes((b >> 8, b & 0xff))
+                while pos < end:
+                    size = data[pos + 1]
+                    records.append(prefix + data[pos:pos + 2 + size])
+                    pos += 2 + size
+            for pending in (self._journal, self._recent):
+                for h, ssids in pending.items():
+                    for ssid in ssids:
+                        raw = ssid.encode('utf-8')
+                        records.append(h + bytes((len(raw),)) + raw)
+            # a compaction interrupted before removing the journal leaves duplicates
+            records = sorted(set(records))
+
+            index = [0] * (0x10000 + 1)
+            body = bytearray()
+            bucket = -1
+            for record in records:
+                b = (record[0] << 8) | record[1]
+                while bucket < b:
+                    bucket += 1
+                    index[bucket] = len(body)
+                # the bucket (first two hash bytes) is implied by the index
+                body += record[2:]
+            for b in range(bucket + 1, 0x10000 + 1):
+                index[b] = len(body)
+
+            data = _HEADER.pack(MAGIC, VERSION, len(records)) + _INDEX.pack(*index) + bytes(body)
+            if self.path:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+                try:
+                    os.remove(self.path + JOURNAL_SUFFIX)
+                except OSError:
+                    pass
+            self._data = data
+            self._index = tuple(index)
+            self._count = len(records)
+            self._journal = {}
+            self._journal_count = 0
+            self._recent = {}
+
+    def stats(self):
+        with self.lock:
+            return {'path': self.path, 'stored': self._count, 'journal': self._journal_count,
+                    'unsaved': sum(len(s) for s in self._recent.values())}
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) >= 4 and sys.argv[1] == 'import':
+        index = SSIDHashIndex(sys.argv[2])
+        for corpus in sys.argv[3:]:
+            print('%s: %d new SSIDs' % (corpus, index.import_file(corpus)))
+        index.flush()
+        print('%d SSIDs in %s' % (len(index), sys.argv[2]))
+    elif len(sys.argv) == 4 and sys.argv[1] == 'lookup':
+        for ssid in SSIDHashIndex(sys.argv[2]).lookup(sys.argv[3]):
+            print(ssid)
+    else:
+        print('Usage: %s import index.bin corpus.txt [...]\n       %s lookup index.bin hash'
+              % (sys.argv[0], sys.argv[0]))
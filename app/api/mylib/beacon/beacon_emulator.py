@@ -1,108 +1,198 @@
 #!/usr/bin/env python3
-import subprocess
 import time
-import threading
-import os
 
-# 全局變量來追踪廣播狀態
-broadcasting_thread = None
-stop_event = threading.Event()
+from ..apple_bleee.utils.hci_adapter import get_adapter
 
-def start_ibeacon(uuid="AA 21 98 B2 46 30 11 EE BE 56 02 42 AC 12 00 02", 
-                  major="00 01", 
-                  minor="00 02", 
-                  power="C8"):
+# 藍牙介面 ID（hci0 為 0）
+DEV_ID = 0
+
+# 廣播間隔，單位為 0.625 ms（160 = 100 ms）
+DEFAULT_INTERVAL = 160
+
+# Flags (LE General Discoverable, BR/EDR not supported) + Apple 製造商資料標頭 + iBeacon 類型/長度
+IBEACON_PREFIX = bytes.fromhex("02 01 06 1A FF 4C 00 02 15")
+
+# 非連線式廣播 (ADV_NONCONN_IND)
+ADV_NONCONN_IND = 0x03
+
+# 控制器由 HCIAdapter 統一管理（掃描與廣播共用 hci0，不再互相重置）；
+# device_lock 保護 HCI socket，beacon_rotator 與 Continuity 廣播也共用
+_adapter = get_adapter(DEV_ID)
+device_lock = _adapter.lock
+_current = None  # 目前在控制器上的 (payload, interval)
+last_latency_ms = {"start": None, "stop": None}
+
+
+def build_ibeacon_payload(uuid, major, minor, power):
+    """
+    建立 iBeacon 廣播資料（只在參數改變時呼叫一次）
+
+    參數皆為空格分隔的十六進制字符串，與 beacon_profiles.json 的格式相同
+
+    返回:
+        30 bytes 的廣播資料
+    """
+    fields = (
+        ("uuid", uuid, 16),
+        ("major", major, 2),
+        ("minor", minor, 2),
+        ("power", power, 1),
+    )
+    payload = bytearray(IBEACON_PREFIX)
+    for name, value, size in fields:
+        raw = bytes.fromhex(value.replace("-", ""))
+        if len(raw) != size:
+            raise ValueError(f"{name} 必須為 {size} bytes，收到 {len(raw)} bytes")
+        payload += raw
+    return bytes(payload)
+
+
+def open_device():
+    """取得共用的 HCI 指令 socket；在啟動/停止之間重複使用（呼叫前需持有 device_lock）"""
+    return _adapter.command_socket()
+
+
+def close_device():
+    """指令出錯時呼叫：丟棄 HCI socket，下次使用時重新開啟（不會重置控制器）"""
+    _adapter.command_failed()
+
+
+def _restore(sock):
+    """控制器因錯誤被重置後，重新送出目前的廣播"""
+    if _current is not None:
+        from ..apple_bleee.utils.bluetooth_utils import start_le_advertising
+        payload, interval = _current
+        start_le_advertising(sock, min_interval=interval, max_interval=interval,
+                             adv_type=ADV_NONCONN_IND, data=payload)
+
+
+_adapter.add_reset_listener(_restore)
+
+
+def start_ibeacon(uuid="AA 21 98 B2 46 30 11 EE BE 56 02 42 AC 12 00 02",
+                  major="00 01",
+                  minor="00 02",
+                  power="C8",
+                  interval=DEFAULT_INTERVAL):
     """
     開始 iBeacon 廣播
-    
+
+    直接透過 HCI socket 設定控制器：廣播由控制器持續送出，不需要每秒重送指令。
+    若已在廣播且參數相同則不做任何事；只有廣播資料改變時只更新資料。
+
     參數:
         uuid: iBeacon UUID (空格分隔的十六進制字符串)
         major: iBeacon Major 值 (空格分隔的十六進制字符串)
         minor: iBeacon Minor 值 (空格分隔的十六進制字符串)
         power: 發射功率校準值 (十六進制字符串)
-        
+        interval: 廣播間隔（單位 0.625 ms）
+
     返回:
         成功返回 True，失敗返回 False
     """
-    global broadcasting_thread, stop_event
-    
-    # 如果已經在廣播，先停止
-    if broadcasting_thread and broadcasting_thread.is_alive():
-        stop_ibeacon()
-    
-    # 重置停止事件
-    stop_event.clear()
-    
+    global _current
+
+    started = time.perf_counter()
     try:
-        # 重置藍牙設備
-        subprocess.run(["sudo", "hciconfig", "hci0", "down"], check=True)
-        subprocess.run(["sudo", "hciconfig", "hci0", "up"], check=True)
-        
-        # 設置為廣播模式
-        subprocess.run(["sudo", "hciconfig", "hci0", "leadv", "3"], check=True)
-        
-        # 創建廣播線程
-        def broadcast_loop():
-            while not stop_event.is_set():
-                cmd = ["sudo", "hcitool", "-i", "hci0", "cmd", "0x08", "0x0008", 
-                      "1E", "02", "01", "06", "1A", "FF", "4C", "00", "02", "15"] + uuid.split() + major.split() + minor.split() + [power]
-                try:
-                    subprocess.run(cmd, check=True)
-                except subprocess.SubprocessError:
-                    if not stop_event.is_set():  # 只有當不是因為停止事件才輸出錯誤
-                        print("廣播命令執行失敗")
-                time.sleep(1)  # 每秒發送一次
-        
-        # 啟動廣播線程
-        broadcasting_thread = threading.Thread(target=broadcast_loop)
-        broadcasting_thread.daemon = True  # 設為守護線程，主程序結束時自動終止
-        broadcasting_thread.start()
-        
-        print(f"開始廣播 iBeacon: UUID={uuid}, Major={major}, Minor={minor}")
-        return True
-        
-    except Exception as e:
-        print(f"啟動 iBeacon 廣播時出錯: {e}")
-        # 嘗試清理
-        try:
-            subprocess.run(["sudo", "hciconfig", "hci0", "reset"], check=False)
-        except:
-            pass
+        payload = build_ibeacon_payload(uuid, major, minor, power)
+    except ValueError as e:
+        print(f"iBeacon 參數錯誤: {e}")
         return False
 
-def stop_ibeacon():
+    with device_lock:
+        try:
+            # 使用 legacy 廣播指令；hci0 正以 extended 廣播時會被拒絕
+            _adapter.claim_advertising(__name__)
+        except Exception as e:
+            print(f"無法啟動 iBeacon 廣播: {e}")
+            return False
+        try:
+            from ..apple_bleee.utils.bluetooth_utils import (
+                start_le_advertising, stop_le_advertising, set_le_advertising_data)
+            sock = open_device()
+
+            if _current == (payload, interval):
+                pass
+            elif _current is not None and _current[1] == interval:
+                # 只有資料改變，直接替換廣播內容
+                set_le_advertising_data(sock, payload)
+            else:
+                if _current is not None:
+                    stop_le_advertising(sock)
+                start_le_advertising(sock, min_interval=interval, max_interval=interval,
+                                     adv_type=ADV_NONCONN_IND, data=payload)
+            _current = (payload, interval)
+
+        except Exception as e:
+            print(f"啟動 iBeacon 廣播時出錯: {e}")
+            # socket 可能已失效，下次重新開啟
+            _current = None
+            _adapter.release_advertising(__name__)
+            close_device()
+            return False
+
+    last_latency_ms["start"] = (time.perf_counter() - started) * 1000
+    print(f"開始廣播 iBeacon: UUID={uuid}, Major={major}, Minor={minor} "
+          f"({last_latency_ms['start']:.1f} ms)")
+    return True
+
+
+def stop_ibeacon(force=False):
     """
     停止 iBeacon 廣播
-    
+
+    參數:
+        force: 即使本程序沒有啟動廣播也送出停止指令（例如從命令列停止）
+
     返回:
         成功返回 True，失敗返回 False
     """
-    global broadcasting_thread, stop_event
-    
-    try:
-        # 設置停止事件
-        stop_event.set()
-        
-        # 等待廣播線程結束（最多等待 3 秒）
-        if broadcasting_thread and broadcasting_thread.is_alive():
-            broadcasting_thread.join(timeout=3)
-        
-        # 停止廣播
-        subprocess.run(["sudo", "hciconfig", "hci0", "noleadv"], check=False)
-        # 重置藍牙設備
-        subprocess.run(["sudo", "hciconfig", "hci0", "reset"], check=True)
-        
-        print("iBeacon 廣播已停止")
-        return True
-        
-    except Exception as e:
-        print(f"停止 iBeacon 廣播時出錯: {e}")
-        return False
+    global _current
+
+    started = time.perf_counter()
+    with device_lock:
+        try:
+            if _current is not None or force:
+                from ..apple_bleee.utils.bluetooth_utils import stop_le_advertising
+                stop_le_advertising(open_device())
+            _current = None
+
+        except Exception as e:
+            print(f"停止 iBeacon 廣播時出錯: {e}")
+            _current = None
+            close_device()
+            return False
+        finally:
+            _adapter.release_advertising(__name__)
+
+    last_latency_ms["stop"] = (time.perf_counter() - started) * 1000
+    print(f"iBeacon 廣播已停止 ({last_latency_ms['stop']:.1f} ms)")
+    return True
+
+
+def is_advertising():
+    """返回目前是否正在廣播"""
+    return _current is not None
+
+
+def get_status():
+    """
+    返回廣播狀態與最近一次啟動/停止的延遲（毫秒）
+    """
+    current = _current
+    return {
+        "advertising": current is not None,
+        "payload": current[0].hex() if current else None,
+        "interval_ms": current[1] * 0.625 if current else None,
+        "start_latency_ms": last_latency_ms["start"],
+        "stop_latency_ms": last_latency_ms["stop"],
+    }
+
 
 # 測試代碼
 if __name__ == "__main__":
     import sys
-    
+
     if len(sys.argv) > 1 and sys.argv[1] == "start":
         # 可以指定自定義參數
         if len(sys.argv) > 2:
@@ -112,6 +202,6 @@ if __name__ == "__main__":
         input("按 Enter 鍵停止廣播...")
         stop_ibeacon()
     elif len(sys.argv) > 1 and sys.argv[1] == "stop":
-        stop_ibeacon()
+        stop_ibeacon(force=True)
     else:
-        print("用法: python3 ibeacon.py [start|stop] [optional_uuid]")
\ No newline at end of file
+        print("用法: python3 -m api.mylib.beacon.beacon_emulator [start|stop] [optional_uuid]")
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import heapq
+import threading
+import time
+
+from .beacon_emulator import (DEV_ID, DEFAULT_INTERVAL, ADV_NONCONN_IND, build_ibeacon_payload,
+                              open_device, close_device, device_lock)
+from . import beacon_emulator
+from ..apple_bleee.utils.hci_adapter import get_adapter
+
+# 輪播模式下每個時間槽的長度（毫秒）；至少要涵蓋數次廣播事件，接收端才收得到
+DEFAULT_SLOT_MS = 300
+
+# 廣播間隔的合法範圍（單位 0.625 ms）
+MIN_INTERVAL = 0x0020
+MAX_EXT_INTERVAL = 0xFFFFFF
+
+MODE_EXTENDED = "extended"
+MODE_SWAP = "swap"
+
+
+class BeaconRotator:
+    """
+    在同一個藍牙控制器上同時模擬多個 iBeacon
+
+    控制器支援 LE Extended Advertising 時，每個 profile 使用一個獨立的廣播集
+    (advertising set)，由控制器自行依各自的間隔送出；否則退回在單一廣播上
+    依時間槽快速替換廣播資料。兩種模式都只使用 beacon_emulator 的 HCI socket。
+
+    控制器用過 extended 指令後會拒絕 legacy 廣播/掃描指令（直到重置），
+    因此模式透過 HCIAdapter.claim_advertising 登記：hci0 正在掃描或有其他
+    legacy 廣播時不使用延伸廣播；切換指令集時才由 HCIAdapter 重置 hci0。
+    """
+
+    def __init__(self, slot_ms=DEFAULT_SLOT_MS, interval=DEFAULT_INTERVAL):
+        """
+        初始化 BeaconRotator
+
+        Args:
+            slot_ms: 替換模式下每個時間槽的長度（毫秒）
+            interval: duty 為 1 時的廣播間隔（單位 0.625 ms）
+        """
+        self.slot_ms = slot_ms
+        self.interval = interval
+        self.mode = None
+        self._entries = []
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._started_at = None
+        self._swaps = 0
+        self._max_jitter_ms = 0.0
+        self._adapter = get_adapter(DEV_ID)
+        self._adapter.add_reset_listener(self._restore)
+
+    @property
+    def is_running(self):
+        return self.mode is not None
+
+    def start(self, entries, use_extended=None):
+        """
+        開始輪播
+
+        Args:
+            entries: [(profile, duty), ...]，profile 為 beacon_profiles.json 中的設定檔，
+                     duty 為 0 < duty <= 1 的佔用比例。延伸廣播模式下 duty 決定廣播間隔
+                     (interval / duty)；替換模式下決定分配到的時間槽比例。
+            use_extended: True/False 強制指定模式，None 則自動偵測
+
+        Returns:
+            str: 實際使用的模式 ("extended" 或 "swap")
+        """
+        if not entries:
+            raise ValueError("至少需要一個 profile")
+        prepared = []
+        for profile, duty in entries:
+            duty = float(duty)
+            if not 0 < duty <= 1:
+                raise ValueError(f"{profile['name']} 的 duty 必須介於 0 到 1 之間")
+            payload = build_ibeacon_payload(profile["uuid"], profile["major"],
+                                            profile["minor"], profile["power"])
+            prepared.append({"name": profile["name"], "duty": duty, "payload": payload, "sent": 0})
+
+        self.stop()
+        # 單一 beacon 模擬與輪播共用控制器，不能同時進行
+        beacon_emulator.stop_ibeacon()
+
+        from ..apple_bleee.utils.bluetooth_utils import read_le_num_adv_sets
+
+        adapter = self._adapter
+        with device_lock:
+            try:
+                auto = use_extended is None
+                if auto:
+                    # 支援度以 LE 功能位元判斷，讀取廣播集數量本身就是 extended 指令
+                    use_extended = (adapter.can_claim(self, extended=True)
+                                    and adapter.supports_extended_advertising())
+                if use_extended:
+                    adapter.claim_advertising(self, extended=True)
+                    num_sets = read_le_num_adv_sets(open_device())
+                    if len(prepared) > num_sets:
+                        if not auto:
+                            raise ValueError(f"控制器只支援 {num_sets} 個廣播集")
+                        use_extended = False
+                if not use_extended:
+                    adapter.claim_advertising(self, extended=False)
+                # 切換指令集時控制器已被重置，重新取得 socket
+                sock = open_device()
+                if use_extended:
+                    self._start_extended(sock, prepared)
+                else:
+                    self._start_swap(sock, prepared)
+            except (RuntimeError, ValueError):
+                adapter.release_advertising(self)
+                raise
+            except Exception:
+                adapter.release_advertising(self)
+                close_device()
+                raise
+
+        self._entries = prepared
+        self._started_at = time.monotonic()
+        return self.mode
+
+    def _start_extended(self, sock, entries):
+        from ..apple_bleee.utils.bluetooth_utils import (
+            set_ext_advertising_parameters, set_ext_advertising_data,
+            set_ext_advertising_enable, clear_ext_advertising_sets)
+
+        # 廣播集啟用中時無法清除
+        set_ext_advertising_enable(sock, False, [])
+        clear_ext_advertising_sets(sock)
+        for handle, entry in enumerate(entries):
+            interval = min(MAX_EXT_INTERVAL, max(MIN_INTERVAL, round(self.interval / entry["duty"])))
+            entry["interval"] = interval
+            set_ext_advertising_parameters(sock, handle, min_interval=interval,
+                                           max_interval=interval, sid=handle)
+            set_ext_advertising_data(sock, handle, entry["payload"])
+        set_ext_advertising_enable(sock, True, list(range(len(entries))))
+        self.mode = MODE_EXTENDED
+
+    def _start_swap(self, sock, entries):
+        from ..apple_bleee.utils.bluetooth_utils import start_le_advertising
+
+        for entry in entries:
+            entry["interval"] = self.interval
+        start_le_advertising(sock, min_interval=self.interval, max_interval=self.interval,
+                             adv_type=ADV_NONCONN_IND, data=entries[0]["payload"])
+        self._swaps = 0
+        self._max_jitter_ms = 0.0
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._swap_loop, args=(entries,))
+        self._thread.daemon = True
+        self.mode = MODE_SWAP
+        self._thread.start()
+
+    def _restore(self, sock):
+        """控制器因錯誤被重置後，重新設定廣播（替換模式的執行緒會接著替換資料）"""
+        from ..apple_bleee.utils.bluetooth_utils import start_le_advertising
+
+        if self.mode == MODE_EXTENDED:
+            self._start_extended(sock, self._entries)
+        elif self.mode == MODE_SWAP:
+            start_le_advertising(sock, min_interval=self.interval, max_interval=self.interval,
+                                 adv_type=ADV_NONCONN_IND, data=self._entries[0]["payload"])
+
+    def _swap_loop(self, entries):
+        """
+        以 stride scheduling 分配時間槽：每次選出 pass 值最小的 profile，
+        其 pass 再加上 1/duty，因此各 profile 的時間槽數與 duty 成正比且分布平均。
+        以絕對時間計算下一個時間槽，避免誤差累積。
+        """
+        from ..apple_bleee.utils.bluetooth_utils import set_le_advertising_data
+
+        slot = self.slot_ms / 1000.0
+        heap = [(0.0, i) for i in range(len(entries))]
+        heapq.heapify(heap)
+        current = None
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            pass_value, i = heapq.heappop(heap)
+            heapq.heappush(heap, (pass_value + 1.0 / entries[i]["duty"], i))
+            if i != current:
+                try:
+                    with device_lock:
+                        set_le_advertising_data(open_device(), entries[i]["payload"])
+                except Exception as e:
+                    # 丟棄 socket，下一個時間槽重新開啟；不重置控制器
+                    print(f"替換 beacon 廣播資料時出錯: {e}")
+                    close_device()
+                    current = None
+                else:
+                    current = i
+                    self._swaps += 1
+            entries[i]["sent"] += 1
+
+            jitter = (time.monotonic() - deadline) * 1000
+            if jitter > self._max_jitter_ms:
+                self._max_jitter_ms = jitter
+            deadline += slot
+            self._stop_event.wait(max(0.0, deadline - time.monotonic()))
+
+    def stop(self):
+        """
+        停止輪播
+
+        Returns:
+            bool: 是否有正在進行的輪播被停止
+        """
+        if self.mode is None:
+            return False
+
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=1)
+        self._thread = None
+
+        from ..apple_bleee.utils.bluetooth_utils import (
+            stop_le_advertising, set_ext_advertising_enable, clear_ext_advertising_sets)
+
+        with device_lock:
+            try:
+                sock = open_device()
+                if self.mode == MODE_EXTENDED:
+                    set_ext_advertising_enable(sock, False, [])
+                    clear_ext_advertising_sets(sock)
+                else:
+                    stop_le_advertising(sock)
+            except Exception as e:
+                print(f"停止 beacon 輪播時出錯: {e}")
+                close_device()
+            self._adapter.release_advertising(self)
+        self.mode = None
+        return True
+
+    def status(self):
+        """
+        返回輪播狀態
+
+        Returns:
+            Dict: 模式、各 profile 的間隔與已分配時間槽數，以及替換模式下的實際替換速率
+        """
+        if self.mode is None:
+            return {"status": "not_running"}
+
+        elapsed = time.monotonic() - self._started_at
+        result = {
+            "status": "running",
+            "mode": self.mode,
+            "uptime": round(elapsed, 1),
+            "profiles": [
+                {
+                    "name": e["name"],
+                    "duty": e["duty"],
+                    "interval_ms": e["interval"] * 0.625,
+                    "slots": e["sent"] if self.mode == MODE_SWAP else None,
+                }
+                for e in self._entries
+            ],
+        }
+        if self.mode == MODE_SWAP:
+            result["slot_ms"] = self.slot_ms
+            result["swaps_per_sec"] = round(self._swaps / elapsed, 2) if elapsed else 0.0
+            result["max_jitter_ms"] = round(self._max_jitter_ms, 2)
+        return result
@@ -5,10 +5,13 @@ import asyncio
 import json
 import logging
 import subprocess
-import re
 import time
 from typing import List, Dict, Any, Optional
 
+from .beacon_decoder import decode_advertisement
+from .device_table import DeviceTable
+from ..apple_bleee.utils.hci_adapter import get_adapter
+
 # 設定日誌
 logging.basicConfig(
     level=logging.INFO,
@@ -19,179 +22,119 @@ logger = logging.getLogger("BeaconScanner")
 class BeaconScanner:
     """
     使用 BlueZ 掃描附近的 BLE Beacon
+
+    直接從 HCI socket 讀取 LE Advertising Report：socket 註冊在 asyncio 事件迴圈上，
+    有資料時一次讀完所有待處理的事件並更新記憶體中的裝置表，不需要額外的執行緒；
+    scan() 只回傳目前的快照，不需要等待掃描時間。
+    掃描由 HCIAdapter 統一管理，可與 Continuity 追蹤及各種廣播同時進行。
     """
     
-    def __init__(self, scan_duration: int = 5, device_id: int = 0):
+    def __init__(self, scan_duration: int = 5, device_id: int = 0, idle_timeout: int = 30,
+                 max_devices: int = 512):
         """
         初始化 BeaconScanner
 
         Args:
-            scan_duration: 掃描持續時間（秒）
+            scan_duration: 裝置在多少秒內沒有再收到廣播就不列入結果
             device_id: 藍牙介面 ID（hci0 為 0）
+            idle_timeout: 超過多少秒沒有人呼叫 scan() 就自動停止掃描
+            max_devices: 裝置表最多保留的裝置數量
         """
         self.scan_duration = scan_duration
         self.device_id = device_id
+        self.idle_timeout = idle_timeout
         self.is_scanning = False
-        self._last_scan_result = []
+        self.devices = DeviceTable(ttl=scan_duration, max_devices=max_devices)
+        self.adapter = get_adapter(device_id)
+        self._watchdog: Optional[asyncio.TimerHandle] = None
+        self._last_poll = 0.0
 
-    async def scan(self) -> List[Dict[str, Any]]:
+    def start(self):
         """
-        執行藍牙掃描，尋找附近的 Beacon 設備
-
-        Returns:
-            List[Dict[str, Any]]: 找到的 Beacon 列表
+        向 HCIAdapter 註冊並開始被動掃描（需在事件迴圈中呼叫）
         """
         if self.is_scanning:
-            logger.info("已有掃描進行中，返回上次結果")
-            return self._last_scan_result
+            return
+        
+        loop = asyncio.get_running_loop()
+        self.adapter.add_scan_handler(self._on_advertisement)
         
+        self._last_poll = time.monotonic()
         self.is_scanning = True
-        try:
-            # 啟動 hcitool 掃描
-            logger.info(f"開始掃描 BLE 裝置，持續 {self.scan_duration} 秒")
-            
-            # 使用 hcitool 掃描 BLE 設備
-            cmd = [
-                "sudo", "timeout", str(self.scan_duration),
-                "hcitool", "-i", f"hci{self.device_id}", "lescan", "--duplicate"
-            ]
-            
-            # 使用 tee 將輸出同時導向標準輸出和文件
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            # 同時啟動另一個進程來捕獲 hcidump 數據
-            dump_cmd = [
-                "sudo", "hcidump", "-i", f"hci{self.device_id}", "--raw"
-            ]
-            
-            dump_process = subprocess.Popen(
-                dump_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            # 等待掃描完成
-            await asyncio.sleep(self.scan_duration + 1)
-            
-            # 強制終止進程
-            process.terminate()
-            dump_process.terminate()
-            
-            # 獲取 hcitool 輸出
-            stdout, stderr = process.communicate()
-            dump_stdout, dump_stderr = dump_process.communicate()
-            
-            # 解析 hcitool 輸出獲取設備列表
-            devices = self._parse_lescan_output(stdout)
-            
-            # 解析 hcidump 輸出以獲取更多廣告數據（如UUID）
-            beacon_data = self._parse_hcidump_output(dump_stdout)
-            
-            # 合併數據
-            result = self._merge_device_data(devices, beacon_data)
-            
-            # 過濾，只保留可能是 Beacon 的設備
-            beacons = self._filter_beacons(result)
-            
-            self._last_scan_result = beacons
-            return beacons
-            
-        except Exception as e:
-            logger.error(f"掃描時發生錯誤: {str(e)}")
-            return []
-        finally:
+        self._watchdog = loop.call_later(1.0, self._idle_watchdog)
+        logger.info(f"開始掃描 BLE 裝置 (hci{self.device_id})")
+
+    def stop(self):
+        """
+        停止掃描；其他功能仍在掃描時控制器會繼續掃描
+        """
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        self.adapter.remove_scan_handler(self._on_advertisement)
+        if self.is_scanning:
             self.is_scanning = False
-    
-    def _parse_lescan_output(self, output: str) -> List[Dict[str, Any]]:
-        """解析 hcitool lescan 的輸出"""
-        devices = []
-        lines = output.strip().split('\n')
-        
-        # 第一行是標題，跳過
-        for line in lines[1:]:
-            parts = line.strip().split(' ', 1)
-            if len(parts) >= 2:
-                mac_address = parts[0]
-                name = parts[1] if len(parts) > 1 else "Unknown"
-                
-                devices.append({
-                    "mac_address": mac_address,
-                    "name": name,
-                    "rssi": -90  # 默認值，將從 hcidump 更新
-                })
-        
-        return devices
-    
-    def _parse_hcidump_output(self, output: str) -> Dict[str, Dict[str, Any]]:
-        """解析 hcidump 的輸出獲取更多設備信息"""
-        devices_data = {}
-        current_mac = None
-        
-        # 正則表達式匹配 MAC 地址
-        mac_pattern = re.compile(r'> ([0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2})')
-        
-        # 匹配 RSSI 值
-        rssi_pattern = re.compile(r'RSSI: (-\d+)')
-        
-        # 匹配 UUID
-        uuid_pattern = re.compile(r'([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})')
-        
-        lines = output.strip().split('\n')
-        
-        for line in lines:
-            # 尋找 MAC 地址
-            mac_match = mac_pattern.search(line)
-            if mac_match:
-                current_mac = mac_match.group(1).lower()
-                if current_mac not in devices_data:
-                    devices_data[current_mac] = {}
-                continue
-            
-            # 如果找到當前設備，尋找 RSSI
-            if current_mac:
-                rssi_match = rssi_pattern.search(line)
-                if rssi_match:
-                    devices_data[current_mac]["rssi"] = int(rssi_match.group(1))
-                
-                # 尋找 UUID
-                uuid_match = uuid_pattern.search(line)
-                if uuid_match:
-                    devices_data[current_mac]["uuid"] = uuid_match.group(1)
-        
-        return devices_data
-    
-    def _merge_device_data(self, devices: List[Dict[str, Any]], beacon_data: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """合併從不同來源獲取的設備數據"""
-        merged_devices = []
-        
-        for device in devices:
-            mac = device["mac_address"].lower()
-            if mac in beacon_data:
-                # 更新 RSSI
-                if "rssi" in beacon_data[mac]:
-                    device["rssi"] = beacon_data[mac]["rssi"]
-                
-                # 添加 UUID
-                if "uuid" in beacon_data[mac]:
-                    device["uuid"] = beacon_data[mac]["uuid"]
-            
-            merged_devices.append(device)
+            logger.info("BLE 掃描已停止")
+
+    def _idle_watchdog(self):
+        """沒有人讀取結果時停止掃描，避免無意義地佔用藍牙"""
+        self._watchdog = None
+        if time.monotonic() - self._last_poll > self.idle_timeout:
+            logger.info("長時間沒有讀取掃描結果，停止掃描")
+            self.stop()
+        else:
+            self._watchdog = asyncio.get_running_loop().call_later(1.0, self._idle_watchdog)
+
+    def _on_advertisement(self, mac: str, adv_type: int, data: bytes, rssi: int):
+        """處理一筆 LE Advertising Report（在事件迴圈中呼叫）"""
+        self.devices.update(mac.lower(), rssi, decode_advertisement(data))
+
+    def load_capture(self, path: str) -> int:
+        """
+        將錄下的廣播（pcap / btsnoop）直接送進裝置表，用於離線分析與效能測試
+
+        Args:
+            path: 擷取檔路徑
+
+        Returns:
+            int: 處理的廣播筆數
+        """
+        from ..apple_bleee.utils.adv_capture import replay
+        return replay(path, self._on_advertisement)
+
+    async def scan(self) -> List[Dict[str, Any]]:
+        """
+        取得附近的 Beacon 設備（從記憶體中的裝置表直接回傳）
+
+        Returns:
+            List[Dict[str, Any]]: 找到的 Beacon 列表
+        """
+        self._last_poll = time.monotonic()
+        if not self.is_scanning:
+            try:
+                self.start()
+            except Exception as e:
+                logger.error(f"啟動掃描時發生錯誤: {str(e)}")
+                return []
         
-        return merged_devices
+        return self._filter_beacons(self.devices.snapshot())
+
+    def get_device(self, mac: str) -> Optional[Dict[str, Any]]:
+        """
+        取得裝置表中某個裝置目前的資料
+
+        Args:
+            mac: 裝置 MAC 位址
+        """
+        return self.devices.get(mac.lower())
     
     def _filter_beacons(self, devices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """過濾設備列表，只保留 Beacon"""
         beacons = []
         
         for device in devices:
-            # 簡單過濾：包含 UUID 的設備很可能是 Beacon
-            if "uuid" in device:
+            # 廣播資料中解析出 iBeacon / AltBeacon / Eddystone 框架
+            if "beacon_type" in device:
                 beacons.append(device)
                 continue
             
@@ -280,12 +223,28 @@ class BeaconScanner:
         return beacons
 
 
+def replay_main(path: str):
+    """以擷取檔測試解析速度並列出找到的 Beacon"""
+    from ..apple_bleee.utils.adv_capture import benchmark
+
+    # 擷取檔的時間戳記可能很舊，不依 TTL 移除裝置
+    scanner = BeaconScanner(scan_duration=float("inf"))
+    result = benchmark(path, scanner._on_advertisement)
+    print(f"{result['reports']} 筆廣播，{result['reports_per_sec']:,.0f} reports/sec")
+    for beacon in scanner._filter_beacons(scanner.devices.snapshot()):
+        print(f"{beacon['mac_address']} {beacon.get('beacon_type', '')} RSSI={beacon['rssi']}")
+
+
 async def main():
     """測試函數"""
     scanner = BeaconScanner()
     print("開始掃描附近的 Beacon...")
     
+    # 第一次呼叫會啟動背景掃描，等待一段時間後再讀取結果
+    await scanner.scan()
+    await asyncio.sleep(scanner.scan_duration)
     beacons = await scanner.scan()
+    scanner.stop()
     
     print(f"找到 {len(beacons)} 個 Beacon:")
     for i, beacon in enumerate(beacons, 1):
@@ -297,5 +256,9 @@ async def main():
 
 
 if __name__ == "__main__":
-    # 直接執行此文件時運行測試函數
-    asyncio.run(main())
\ No newline at end of file
+    # 直接執行此文件時運行測試函數 (在 app 目錄下: python3 -m api.mylib.beacon.beacon_scanner [capture.pcap])
+    import sys
+    if len(sys.argv) > 1:
+        replay_main(sys.argv[1])
+    else:
+        asyncio.run(main())
\ No newline at end of file
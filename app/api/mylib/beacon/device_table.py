@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# 1 公尺處的預設 RSSI（廣播中沒有 tx power 時使用）
+DEFAULT_MEASURED_POWER = -59
+# 0 公尺處的發射功率（AD 0x0A、Eddystone）換算到 1 公尺的路徑損耗 (dB)
+LOSS_AT_1M = 41
+# 路徑損耗指數：空曠處約 2，室內約 2.5-4
+DEFAULT_PATH_LOSS = 2.5
+
+SMOOTHING_KALMAN = "kalman"
+SMOOTHING_EMA = "ema"
+
+
+class DeviceRecord:
+    """
+    單一裝置的狀態；使用 __slots__ 讓每筆紀錄只佔固定的少量記憶體
+    """
+    __slots__ = ("mac", "name", "info", "rssi", "raw_rssi", "variance",
+                 "first_seen", "last_seen", "count", "interval")
+
+    def __init__(self, mac: str, rssi: int, now: float):
+        self.mac = mac
+        self.name = "Unknown"
+        self.info = None
+        self.rssi = float(rssi)
+        self.raw_rssi = rssi
+        self.variance = 1.0
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 1
+        self.interval = 0.0
+
+
+class DeviceTable:
+    """
+    即時 BLE 裝置表
+
+    每收到一筆廣播只做 O(1) 的更新：RSSI 以 Kalman 濾波（或 EMA）平滑，並估算廣播頻率。
+    過期的裝置由依時間排序的 heap 移除，不需要每次掃過整張表；heap 中每個裝置只有
+    一個項目，heap 的時間只在取出時才更新，因此 heap 大小永遠等於裝置數量。
+    """
+
+    def __init__(self, ttl: float = 10.0, max_devices: int = 512,
+                 smoothing: str = SMOOTHING_KALMAN, alpha: float = 0.25,
+                 process_noise: float = 0.05, measurement_noise: float = 4.0,
+                 path_loss: float = DEFAULT_PATH_LOSS):
+        """
+        初始化 DeviceTable
+
+        Args:
+            ttl: 裝置多少秒沒有廣播就移除
+            max_devices: 最多保留的裝置數量，超過時移除最久沒有出現的裝置
+            smoothing: "kalman" 或 "ema"
+            alpha: EMA 的平滑係數
+            process_noise: Kalman 濾波的過程雜訊（數值越大越快跟上變化）
+            measurement_noise: Kalman 濾波的量測雜訊（RSSI 的抖動程度, dB²）
+            path_loss: 距離估算使用的路徑損耗指數
+        """
+        self.ttl = ttl
+        self.max_devices = max_devices
+        self.smoothing = smoothing
+        self.alpha = alpha
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.path_loss = path_loss
+        self._records: Dict[str, DeviceRecord] = {}
+        self._expiry: List = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def update(self, mac: str, rssi: int, info: Optional[Dict[str, Any]] = None,
+               now: Optional[float] = None) -> DeviceRecord:
+        """
+        記錄一筆廣播
+
+        Args:
+            mac: 裝置 MAC 位址
+            rssi: 本次收到的 RSSI
+            info: 解析出的廣播內容（名稱、beacon 欄位等），None 表示沒有變化
+            now: 收到的時間，預設為目前時間
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            record = self._records.get(mac)
+            if record is None:
+                if len(self._records) >= self.max_devices:
+                    self._evict_oldest()
+                record = DeviceRecord(mac, rssi, now)
+                self._records[mac] = record
+                heapq.heappush(self._expiry, (now, mac))
+            else:
+                self._smooth(record, rssi)
+                dt = now - record.last_seen
+                if dt > 0:
+                    record.interval = dt if record.count == 1 else record.interval * 0.9 + dt * 0.1
+                record.count += 1
+                record.raw_rssi = rssi
+                record.last_seen = now
+            if info:
+                # 廣播與 scan response 內容不同，合併而不是覆蓋
+                if record.info is None:
+                    record.info = dict(info)
+                else:
+                    record.info.update(info)
+                if "name" in info:
+                    record.name = info["name"]
+            return record
+
+    def _smooth(self, record: DeviceRecord, rssi: int):
+        if self.smoothing == SMOOTHING_EMA:
+            record.rssi += self.alpha * (rssi - record.rssi)
+            return
+        # 一維 Kalman 濾波（假設 RSSI 近似定值，只有緩慢漂移）
+        variance = record.variance + self.process_noise
+        gain = variance / (variance + self.measurement_noise)
+        record.rssi += gain * (rssi - record.rssi)
+        record.variance = (1 - gain) * variance
+
+    def _evict_oldest(self):
+        """移除最久沒有出現的裝置（呼叫前需持有鎖）"""
+        while self._expiry:
+            key, mac = heapq.heappop(self._expiry)
+            record = self._records.get(mac)
+            if record is None:
+                continue
+            if record.last_seen > key:
+                # heap 中的時間已過時，以真正的時間放回
+                heapq.heappush(self._expiry, (record.last_seen, mac))
+                continue
+            del self._records[mac]
+            return
+
+    def evict(self, now: Optional[float] = None) -> int:
+        """
+        移除超過 ttl 沒有廣播的裝置
+
+        Returns:
+            int: 移除的裝置數量
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.ttl
+        removed = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < cutoff:
+                key, mac = heapq.heappop(self._expiry)
+                record = self._records.get(mac)
+                if record is None:
+                    continue
+                if record.last_seen >= cutoff:
+                    heapq.heappush(self._expiry, (record.last_seen, mac))
+                    continue
+                del self._records[mac]
+                removed += 1
+        return removed
+
+    def distance(self, record: DeviceRecord) -> float:
+        """
+        以 log-distance 路徑損耗模型估算距離（公尺）
+        """
+        measured = DEFAULT_MEASURED_POWER
+        info = record.info
+        if info and "tx_power" in info:
+            # iBeacon / AltBeacon 的校準功率即為 1 公尺處的 RSSI
+            measured = info["tx_power"]
+            # Eddystone 的 tx power 是 0 公尺處的值，換算到 1 公尺約少 41 dB
+            if info.get("beacon_type", "").startswith("eddystone"):
+                measured -= LOSS_AT_1M
+        elif info and "tx_power_level" in info:
+            # AD 0x0A (TX Power Level) 同樣是 0 公尺處的發射功率
+            measured = info["tx_power_level"] - LOSS_AT_1M
+        return 10 ** ((measured - record.rssi) / (10 * self.path_loss))
+
+    def to_dict(self, record: DeviceRecord) -> Dict[str, Any]:
+        """將裝置紀錄轉為 API 回傳的格式"""
+        result = dict(record.info) if record.info else {}
+        result.update({
+            "mac_address": record.mac,
+            "name": record.name,
+            "rssi": round(record.rssi, 1),
+            "raw_rssi": record.raw_rssi,
+            "distance": round(self.distance(record), 2),
+            "adv_rate": round(1.0 / record.interval, 2) if record.interval else 0.0,
+            "count": record.count,
+            "first_seen": record.first_seen,
+            "last_seen": record.last_seen,
+        })
+        return result
+
+    def get(self, mac: str) -> Optional[Dict[str, Any]]:
+        """取得某個裝置目前的資料"""
+        with self._lock:
+            record = self._records.get(mac)
+            return self.to_dict(record) if record else None
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """先移除過期的裝置，再回傳所有裝置的資料"""
+        self.evict()
+        with self._lock:
+            return [self.to_dict(r) for r in self._records.values()]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._expiry = []
@@ -0,0 +1,320 @@
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# WPA/WPA2 PSK 的長度限制（位元組）
+WPA_MIN_LEN = 8
+WPA_MAX_LEN = 63
+
+# 每個排序區塊的預設記憶體預算，512 MB 的 Pi 上保留足夠空間給 FastAPI 本身
+DEFAULT_CHUNK_BYTES = 32 * 1024 * 1024
+# 每個 dict 項目的估計額外開銷 (bytes 物件 + list + dict slot)
+ENTRY_OVERHEAD = 160
+INDEX_SUFFIX = '.idx'
+# 每輪合併最多同時開啟的區塊數，超過時先合併成中間區塊（檔案數與讀取緩衝都有上限）
+MAX_FAN_IN = 64
+# 合併時每個區塊的讀取緩衝；64 路 x 64 KB = 4 MB
+RUN_READ_BUFFER = 64 * 1024
+
+ProgressCallback = Callable[[str, float], None]
+
+
+def index_path_for(wordlist_path: str) -> str:
+    """回傳字典檔對應的索引檔路徑"""
+    return wordlist_path + INDEX_SUFFIX
+
+
+def load_index(wordlist_path: str) -> Optional[Dict]:
+    """
+    讀取字典檔的索引檔
+
+    只有在索引比字典檔新的情況下才視為有效，避免使用者手動修改字典檔後拿到錯誤的行數。
+
+    Returns:
+        Optional[Dict]: 索引內容，不存在或已過期則回傳 None
+    """
+    idx_path = index_path_for(wordlist_path)
+    try:
+        if os.path.getmtime(idx_path) < os.path.getmtime(wordlist_path):
+            return None
+        with open(idx_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _iter_words(path: str, min_len: Optional[int], max_len: Optional[int]) -> Iterator[bytes]:
+    """逐行讀取字典檔（以 bytes 處理，避免編碼錯誤），依長度過濾"""
+    with open(path, 'rb') as f:
+        for line in f:
+            word = line.rstrip(b'\r\n')
+            if not word:
+                continue
+            if min_len is not None and len(word) < min_len:
+                continue
+            if max_len is not None and len(word) > max_len:
+                continue
+            yield word
+
+
+def _write_run(records, tmp_dir: str, run_files: List[str]):
+    """將一個已排序的區塊寫入暫存檔，每行格式為 word\\tcount\\tfirst"""
+    fd, run_path = tempfile.mkstemp(prefix='run-', suffix='.tmp', dir=tmp_dir)
+    with os.fdopen(fd, 'wb', buffering=1024 * 1024) as f:
+        for word, count, first in records:
+            f.write(b'%s\t%x\t%x\n' % (word, count, first))
+    run_files.append(run_path)
+
+
+def _read_run(run_path: str, consumed: Optional[List[int]] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    讀取暫存區塊；密碼本身可能包含 tab，所以從右邊切割
+
+    consumed 為共用計數器，累加已讀取的位元組數，用於回報合併進度
+    """
+    with open(run_path, 'rb', buffering=RUN_READ_BUFFER) as f:
+        for line in f:
+            if consumed is not None:
+                consumed[0] += len(line)
+            word, count, first = line[:-1].rsplit(b'\t', 2)
+            yield word, int(count, 16), int(first, 16)
+
+
+def _read_freq_run(run_path: str, consumed: Optional[List[int]] = None) -> Iterator[Tuple[int, int, bytes]]:
+    """讀取依頻率排序的暫存區塊，key 為 (-count, first)"""
+    for word, count, first in _read_run(run_path, consumed):
+        yield -count, first, word
+
+
+def _merge_freq_runs(run_files: List[str],
+                     consumed: Optional[List[int]] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """多路合併依頻率排序的區塊，輸出格式與 _read_run 相同"""
+    for count, first, word in heapq.merge(*[_read_freq_run(p, consumed) for p in run_files]):
+        yield word, -count, first
+
+
+def _merge_passes(runs: int) -> int:
+    """在 MAX_FAN_IN 限制下，將 runs 個區塊合併到可一次合併所需的輪數"""
+    passes = 0
+    while runs > MAX_FAN_IN:
+        runs = -(-runs // MAX_FAN_IN)
+        passes += 1
+    return passes
+
+
+def _reduce_runs(run_files: List[str], work_dir: str,
+                 merge: Callable[[List[str]], Iterator[Tuple[bytes, int, int]]]) -> List[str]:
+    """
+    多輪合併，每次最多 MAX_FAN_IN 個區塊寫成一個中間區塊，直到剩下的區塊可以一次合併
+
+    Args:
+        merge: 合併一組區塊的函式，輸出 (word, count, first) 並保持區塊的排序
+    """
+    while len(run_files) > MAX_FAN_IN:
+        next_runs = []
+        for i in range(0, len(run_files), MAX_FAN_IN):
+            group = run_files[i:i + MAX_FAN_IN]
+            if len(group) == 1:
+                next_runs.append(group[0])
+                continue
+            _write_run(merge(group), work_dir, next_runs)
+            for run_path in group:
+                os.remove(run_path)
+        run_files = next_runs
+    return run_files
+
+
+def _merge_runs(run_files: List[str], consumed: Optional[List[int]] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """多路合併已排序的區塊，合併相同的密碼並累加出現次數"""
+    streams = [_read_run(p, consumed) for p in run_files]
+    current = None
+    count = 0
+    first = 0
+    for word, c, f in heapq.merge(*streams, key=lambda r: r[0]):
+        if word == current:
+            count += c
+            if f < first:
+                first = f
+            continue
+        if current is not None:
+            yield current, count, first
+        current, count, first = word, c, f
+    if current is not None:
+        yield current, count, first
+
+
+def _write_output(words: Iterator[bytes], output_path: str) -> Dict:
+    """寫出最終字典檔並同時統計行數與長度範圍"""
+    lines = 0
+    pos = 0
+    min_seen = None
+    max_seen = 0
+    with open(output_path, 'wb', buffering=1024 * 1024) as f:
+        for word in words:
+            f.write(word + b'\n')
+            pos += len(word) + 1
+            lines += 1
+            wlen = len(word)
+            if min_seen is None or wlen < min_seen:
+                min_seen = wlen
+            if wlen > max_seen:
+                max_seen = wlen
+    return {
+        'lines': lines,
+        'size': pos,
+        'min_length': min_seen or 0,
+        'max_length': max_seen,
+    }
+
+
+def merge_wordlists(sources: List[str],
+                    output_path: str,
+                    wpa_filter: bool = True,
+                    preserve_frequency: bool = True,
+                    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                    tmp_dir: Optional[str] = None,
+                    progress: Optional[ProgressCallback] = None) -> Dict:
+    """
+    以外部排序合併多個字典檔並去除重複
+
+    記憶體用量只受 chunk_bytes 限制，與字典檔大小無關：先將輸入切成數個區塊，
+    每個區塊在記憶體中去重後排序寫入暫存檔，最後以多路合併產生結果。
+
+    Args:
+        sources: 要合併的字典檔路徑列表
+        output_path: 輸出字典檔路徑
+        wpa_filter: 是否只保留長度 8-63 的密碼 (WPA PSK)
+        preserve_frequency: 是否依出現次數排序（次數相同則保留第一次出現的順序），
+                            否則依字典序輸出
+        chunk_bytes: 每個區塊的記憶體預算
+        tmp_dir: 暫存目錄（預設使用輸出檔所在目錄，避免 /tmp 為 tmpfs 時佔用記憶體）
+        progress: 進度回呼函式 progress(phase, percent)
+
+    Returns:
+        Dict: 寫入索引檔的統計資訊
+    """
+    min_len, max_len = (WPA_MIN_LEN, WPA_MAX_LEN) if wpa_filter else (None, None)
+    total_bytes = sum(os.path.getsize(p) for p in sources) or 1
+    out_dir = os.path.dirname(os.path.abspath(output_path))
+    work_dir = tempfile.mkdtemp(prefix='wordlist-merge-', dir=tmp_dir or out_dir)
+
+    def report(phase, percent):
+        if progress:
+            progress(phase, min(100.0, percent))
+
+    try:
+        # 第一階段：切成區塊，區塊內去重後依密碼排序寫出
+        run_files = []
+        chunk = {}
+        used = 0
+        read_bytes = 0
+        seq = 0
+        words_in = 0
+        for path in sources:
+            for word in _iter_words(path, min_len, max_len):
+                words_in += 1
+                entry = chunk.get(word)
+                if entry is None:
+                    chunk[word] = [1, seq]
+                    used += len(word) + ENTRY_OVERHEAD
+                else:
+                    entry[0] += 1
+                seq += 1
+                if used >= chunk_bytes:
+                    _write_run(((w, e[0], e[1]) for w, e in sorted(chunk.items())), work_dir, run_files)
+                    chunk = {}
+                    used = 0
+                if seq % 65536 == 0:
+                    report('split', read_bytes * 100.0 / total_bytes)
+            read_bytes += os.path.getsize(path)
+            report('split', read_bytes * 100.0 / total_bytes)
+        if chunk:
+            _write_run(((w, e[0], e[1]) for w, e in sorted(chunk.items())), work_dir, run_files)
+            chunk = {}
+
+        # 第二階段：合併區塊；區塊太多時先分輪合併，限制同時開啟的檔案數與緩衝
+        # 合併進度 0-50 依已讀取的區塊位元組數估算（每一輪約讀取全部區塊一次）
+        report('merge', 0)
+        run_bytes = sum(os.path.getsize(p) for p in run_files) or 1
+        passes = _merge_passes(len(run_files))
+        if preserve_frequency:
+            # 合併後的串流 + 頻率區塊的分輪合併（以相同輪數估計）
+            passes = 2 * passes + 1
+        consumed = [0]
+        merged_records = [0]
+
+        def tracked(records):
+            for record in records:
+                merged_records[0] += 1
+                if merged_records[0] & 0x3fff == 0 and passes:
+                    report('merge', min(50.0, consumed[0] * 50.0 / (run_bytes * passes)))
+                yield record
+
+        run_files = _reduce_runs(run_files, work_dir, lambda group: tracked(_merge_runs(group, consumed)))
+
+        if preserve_frequency:
+            merged = tracked(_merge_runs(run_files, consumed))
+            # 第三階段：再以 (-count, first) 做一次外部排序
+            freq_runs = []
+            batch = []
+            used = 0
+            for word, count, first in merged:
+                batch.append((-count, first, word))
+                used += len(word) + ENTRY_OVERHEAD
+                if used >= chunk_bytes:
+                    batch.sort()
+                    _write_run(((w, -c, f) for c, f, w in batch), work_dir, freq_runs)
+                    batch = []
+                    used = 0
+            if batch:
+                batch.sort()
+                _write_run(((w, -c, f) for c, f, w in batch), work_dir, freq_runs)
+                batch = []
+            for run_path in run_files:
+                os.remove(run_path)
+            freq_runs = _reduce_runs(freq_runs, work_dir,
+                                     lambda group: tracked(_merge_freq_runs(group, consumed)))
+            report('merge', 50)
+            ordered = (r[0] for r in _merge_freq_runs(freq_runs))
+        else:
+            report('merge', 50)
+            ordered = (r[0] for r in _merge_runs(run_files))
+
+        # 先寫到暫存檔再改名，避免破解程式讀到寫到一半的字典
+        tmp_output = os.path.join(work_dir, 'output.txt')
+        report('write', 0)
+        stats = _write_output(ordered, tmp_output)
+        stats.update({
+            'sources': [os.path.basename(p) for p in sources],
+            'input_words': words_in,
+            'wpa_filter': wpa_filter,
+            'frequency_order': preserve_frequency,
+        })
+        os.replace(tmp_output, output_path)
+        with open(index_path_for(output_path), 'w') as f:
+            json.dump(stats, f)
+        report('done', 100)
+        return stats
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# 使用範例
+if __name__ == "__main__":
+    import sys
+    import time
+
+    if len(sys.argv) < 3:
+        print("用法: python3 wordlist_merge.py <output.txt> <input1.txt> [input2.txt ...]")
+        sys.exit(1)
+
+    started = time.time()
+    result = merge_wordlists(
+        sys.argv[2:], sys.argv[1],
+        progress=lambda phase, pct: print(f"\r{phase}: {pct:5.1f}%", end="")
+    )
+    print()
+    print(f"輸入 {result['input_words']} 筆，輸出 {result['lines']} 筆，耗時 {time.time() - started:.1f} 秒")